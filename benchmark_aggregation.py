@@ -0,0 +1,88 @@
+# coding=utf-8
+from __future__ import absolute_import, division, print_function
+
+import time
+import argparse
+from collections import OrderedDict
+
+import torch
+from utils.sharded_aggregation import ShardedAggregator, ShardedServerOptimizer
+
+
+def synthetic_model(num_params, layer_size):
+    """ Layers of layer_size parameters (plus a remainder), about the layout of a MLP-Mixer / ViT block """
+    sizes = [layer_size] * (num_params // layer_size) + ([num_params % layer_size] if num_params % layer_size else [])
+    return OrderedDict(('layer_%d' % index, torch.nn.Parameter(torch.randn(size))) for index, size in enumerate(sizes))
+
+
+def make_optimizer(args, params):
+    if args.server_optimizer_type == 'sgd':
+        return torch.optim.SGD(list(params.values()), lr=1.0, momentum=0.9, nesterov=True)
+    return torch.optim.Adam(list(params.values()), eps=1e-8, betas=(0.9, 0.999), lr=1e-3)
+
+
+def stack_aggregation(args, global_params, deltas, weights):
+    """ Reference: the per layer torch.stack of aggregate_server followed by a single optimizer step """
+    optimizer = make_optimizer(args, global_params)
+    weights = torch.tensor(weights)
+    start = time.time()
+    for _ in range(args.repeats):
+        aggregated = [torch.sum(torch.stack(layer, dim=-1) * weights, dim=-1) for layer in zip(*deltas)]
+        optimizer.zero_grad()
+        for param, diff in zip(global_params.values(), aggregated):
+            param.grad = diff
+        optimizer.step()
+    return (time.time() - start) / args.repeats
+
+
+def sharded_aggregation(args, global_params, deltas, weights, num_workers):
+    aggregator = ShardedAggregator(num_workers)
+    optimizer = ShardedServerOptimizer(aggregator, global_params, lambda params: make_optimizer(args, params))
+    start = time.time()
+    for _ in range(args.repeats):
+        optimizer.step(deltas, weights)
+    elapsed = (time.time() - start) / args.repeats
+    aggregator.pool.shutdown()
+    return elapsed, optimizer.flat
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time of the FedOpt server aggregation (weighted delta sum + server optimizer step) "
+                                                 "with the per layer torch.stack and with the sharded aggregator.")
+    parser.add_argument("--num_params", default=60000000, type=int, help="Size of the synthetic model (MLPMixer-B16 has about 60M).")
+    parser.add_argument("--layer_size", default=768 * 3072, type=int, help="Parameters per synthetic layer.")
+    parser.add_argument("--num_clients", default=20, type=int, help="Client deltas aggregated per round.")
+    parser.add_argument("--workers", type=int, nargs='+', default=[1, 2, 4, 8], help="Numbers of aggregator workers compared.")
+    parser.add_argument("--server_optimizer_type", default="adam", choices=["adam", "sgd"], type=str, help="Server optimizer.")
+    parser.add_argument("--repeats", default=3, type=int, help="Aggregations timed per configuration.")
+    parser.add_argument('--seed', type=int, default=42, help="random seed")
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+    deltas = [list(synthetic_model(args.num_params, args.layer_size).values()) for _ in range(args.num_clients)]
+    deltas = [[delta.detach() for delta in client] for client in deltas]
+    weights = torch.rand(args.num_clients)
+    weights = (weights / weights.sum()).tolist()
+    model_mb = args.num_params * 4 / 2 ** 20
+    print('%d clients, model of %.1fM parameters (%.1fMB), %s server optimizer, %d threads' % (
+        args.num_clients, args.num_params / 1e6, model_mb, args.server_optimizer_type, torch.get_num_threads()))
+
+    reference_params = synthetic_model(args.num_params, args.layer_size)
+    initial = [param.detach().clone() for param in reference_params.values()]
+    reference_time = stack_aggregation(args, reference_params, deltas, weights)
+    reference = torch.cat([param.detach().reshape(-1) for param in reference_params.values()])
+    # the stack of the largest layer over all the clients, on top of the aggregated copy of the model
+    stack_mb = args.num_clients * args.layer_size * 4 / 2 ** 20 + model_mb
+    print('{:<10} {:>10} {:>10} {:>14} {:>12}'.format('mode', 'time (s)', 'speedup', 'extra MB', 'max diff'))
+    print('{:<10} {:>10.3f} {:>10.2f} {:>14.1f} {:>12}'.format('stack', reference_time, 1.0, stack_mb, '-'))
+
+    for num_workers in args.workers:
+        params = OrderedDict(('layer_%d' % index, torch.nn.Parameter(value.clone())) for index, value in enumerate(initial))
+        elapsed, flat = sharded_aggregation(args, params, deltas, weights, num_workers)
+        # gradient buffer of each shard, allocated by the workers at the same time
+        print('{:<10} {:>10.3f} {:>10.2f} {:>14.1f} {:>12.2e}'.format(
+            'shards=%d' % num_workers, elapsed, reference_time / elapsed, model_mb, (flat - reference).abs().max().item()))
+
+
+if __name__ == "__main__":
+    main()
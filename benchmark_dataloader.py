@@ -0,0 +1,149 @@
+# coding=utf-8
+from __future__ import absolute_import, division, print_function
+
+import os
+import csv
+import json
+import time
+import argparse
+import itertools
+from types import SimpleNamespace
+
+import torch
+from torch.utils.data import DataLoader, RandomSampler
+from utils.data_utils import DatasetFLViT, create_dataset_and_evalmetrix, loader_config_path
+from utils.model_registry import create_model
+
+DATASET_CLASSES = {'cifar10': 10, 'pacs': 7, 'gldk23': 203, 'isic19': 8}
+
+
+def model_samples_per_second(args, model, batch_size, repeats=5):
+    """ Training throughput of the model alone, on synthetic batches already on the device """
+    x = torch.randn(batch_size, 3, args.img_size, args.img_size, device=args.device)
+    y = torch.randint(0, args.num_classes, (batch_size,), device=args.device)
+    loss_fct = torch.nn.CrossEntropyLoss()
+    model.train()
+
+    for step in range(repeats + 1):
+        if step == 1:
+            if args.device.type == 'cuda':
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+        loss_fct(model(x), y).backward()
+        model.zero_grad(set_to_none=True)
+    if args.device.type == 'cuda':
+        torch.cuda.synchronize()
+    return batch_size * repeats / (time.perf_counter() - start)
+
+
+def loader_samples_per_second(dataset, batch_size, num_workers, prefetch_factor, pin_memory, num_batches):
+    """ Throughput of the DataLoader alone, the first batch (worker start-up) is timed separately """
+    kwargs = {'prefetch_factor': prefetch_factor} if num_workers > 0 else {}
+    loader = DataLoader(dataset, sampler=RandomSampler(dataset), batch_size=batch_size, num_workers=num_workers,
+                        pin_memory=pin_memory, drop_last=True, **kwargs)
+
+    start = time.perf_counter()
+    iterator = iter(loader)
+    next(iterator)
+    startup = time.perf_counter() - start
+
+    start = time.perf_counter()
+    samples = 0
+    for x, y in itertools.islice(iterator, num_batches):
+        samples += x.shape[0]
+    elapsed = time.perf_counter() - start
+    del iterator
+    return samples / max(elapsed, 1e-9), startup
+
+
+def stall_fraction(loader_rate, model_rate):
+    # loading overlaps with the training step, the step waits only for the part of the load that is slower
+    load_time, step_time = 1. / max(loader_rate, 1e-9), 1. / max(model_rate, 1e-9)
+    return max(0., load_time - step_time) / max(load_time, step_time)
+
+
+def benchmark_split(args, model, split_type, writer):
+    data_args = SimpleNamespace(dataset=args.dataset, data_path=args.data_path, split_type=split_type,
+                                img_size=args.img_size, num_classes=args.num_classes,
+                                best_acc={}, current_acc={}, current_test_acc={})
+    loaded_npy = create_dataset_and_evalmetrix(data_args)
+    # the largest client gives the longest epochs
+    data_args.single_client = max(data_args.clients_with_len, key=data_args.clients_with_len.get)
+    dataset = DatasetFLViT(data_args, loaded_npy, phase='train')
+    print('Dataset %s, split %s, client %s: %d samples' % (args.dataset, split_type, data_args.single_client, len(dataset)))
+
+    best = {}
+    for batch_size in args.batch_sizes:
+        model_rate = model_samples_per_second(args, model, batch_size)
+        num_batches = max(1, min(args.num_batches, len(dataset) // batch_size - 1))
+
+        for num_workers, prefetch_factor, pin_memory in itertools.product(args.workers, args.prefetch_factors, args.pin_memory):
+            if num_workers == 0 and prefetch_factor != args.prefetch_factors[0]:
+                continue
+            loader_rate, startup = loader_samples_per_second(dataset, batch_size, num_workers, prefetch_factor, pin_memory, num_batches)
+            stall = stall_fraction(loader_rate, model_rate)
+            result = {'dataset': args.dataset, 'split_type': split_type, 'FL_platform': args.FL_platform, 'batch_size': batch_size,
+                      'num_workers': num_workers, 'prefetch_factor': prefetch_factor, 'pin_memory': pin_memory,
+                      'loader_samples_s': loader_rate, 'model_samples_s': model_rate, 'startup_s': startup, 'stall_fraction': stall}
+            writer.writerow(result)
+            print('bs {:>4} workers {:>3} prefetch {:>2} pin {:<5} loader {:>9.1f}/s model {:>9.1f}/s startup {:>6.2f}s stall {:>5.2f}'.format(
+                batch_size, num_workers, prefetch_factor, str(pin_memory), loader_rate, model_rate, startup, stall))
+
+            # best: the highest effective rate, ties (within 5%) go to the cheapest configuration
+            rate = min(loader_rate, model_rate)
+            current = best.get(batch_size)
+            if current is None or rate > 1.05 * current['rate'] or \
+                    (rate >= current['rate'] / 1.05 and (num_workers, prefetch_factor) < (current['num_workers'], current['prefetch_factor'])):
+                best[batch_size] = {'num_workers': num_workers, 'prefetch_factor': prefetch_factor, 'pin_memory': pin_memory,
+                                    'stall_fraction': stall, 'rate': rate}
+
+    path = loader_config_path(args.output_dir, args.dataset, split_type, args.FL_platform, args.img_size)
+    os.makedirs(args.output_dir, exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump({str(batch_size): config for batch_size, config in best.items()}, f, indent=2)
+
+    for batch_size, config in best.items():
+        bound = 'input-bound' if config['stall_fraction'] > 0 else 'compute-bound'
+        print('Best for batch size %d: %d workers, prefetch %d, pin_memory %s, stall fraction %.2f (%s)' % (
+            batch_size, config['num_workers'], config['prefetch_factor'], config['pin_memory'], config['stall_fraction'], bound))
+    print('Saved to', path, '(used by the train scripts with --auto_loader)')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dataset", choices=["cifar10", "celeba", "pacs", "gldk23", "isic19"], default="cifar10", help="Which dataset.")
+    parser.add_argument("--data_path", type=str, default='./data/', help="Where is dataset located.")
+    parser.add_argument("--split_types", type=str, nargs='+', default=["split_3"], help="Data partitions to benchmark.")
+    parser.add_argument("--FL_platform", type=str, default="ViT-FedAVG", help="Architecture whose step rate the loader has to sustain.")
+    parser.add_argument("--norm", type=str, default=None, help="Normalization variant of the architecture.")
+    parser.add_argument("--img_size", default=224, type=int, help="Final train resolution")
+    parser.add_argument("--batch_sizes", type=int, nargs='+', default=[32], help="Batch sizes to sweep.")
+    parser.add_argument("--workers", type=int, nargs='+', default=[0, 2, 4, 8], help="num_workers values to sweep.")
+    parser.add_argument("--prefetch_factors", type=int, nargs='+', default=[2, 4], help="prefetch_factor values to sweep.")
+    parser.add_argument("--pin_memory", type=int, nargs='+', default=[0, 1], help="pin_memory values to sweep (0/1).")
+    parser.add_argument("--num_batches", default=50, type=int, help="Batches timed per configuration.")
+    parser.add_argument("--output_dir", type=str, default="loader_configs", help="Where the best configurations are saved.")
+    parser.add_argument("--output_file", type=str, default="dataloader_benchmark.csv", help="Where the full report is written.")
+    parser.add_argument("--gpu_ids", type=str, default='0', help="gpu ids: e.g. 0  0,1,2")
+    parser.add_argument('--seed', type=int, default=42, help="random seed")
+    args = parser.parse_args()
+
+    args.pin_memory = [bool(value) for value in args.pin_memory]
+    args.device = torch.device("cuda:{gpu_id}".format(gpu_id=args.gpu_ids) if torch.cuda.is_available() else "cpu")
+    args.num_classes = DATASET_CLASSES.get(args.dataset, 2)
+    args.pretrained = False
+    args.model_cache_dir = None
+
+    torch.manual_seed(args.seed)
+    model = create_model(args).to(args.device)
+
+    with open(args.output_file, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=['dataset', 'split_type', 'FL_platform', 'batch_size', 'num_workers', 'prefetch_factor',
+                                               'pin_memory', 'loader_samples_s', 'model_samples_s', 'startup_s', 'stall_fraction'])
+        writer.writeheader()
+        for split_type in args.split_types:
+            benchmark_split(args, model, split_type, writer)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+# coding=utf-8
+from __future__ import absolute_import, division, print_function
+
+import time
+import argparse
+import itertools
+from types import SimpleNamespace
+
+import torch
+from torch.utils.data import DataLoader, RandomSampler
+from utils.data_utils import DatasetFLViT, create_dataset_and_evalmetrix
+from utils.model_registry import create_model
+from utils.memory_budget import forward_backward
+from utils.dp import dp_backward
+
+
+def naive_dp_backward(args, model, loss_fct, x, y):
+    """ Reference: one backward per sample, clipped and summed by hand """
+    params = [param for param in model.parameters() if param.requires_grad]
+    summed = [torch.zeros_like(param) for param in params]
+    for x_sample, y_sample in zip(x, y):
+        loss = loss_fct(model(x_sample.unsqueeze(0)), y_sample.view(-1))
+        grads = torch.autograd.grad(loss, params)
+        norm = torch.sqrt(sum(grad.pow(2).sum() for grad in grads))
+        scale = min(1., args.dp_clip / (norm.item() + 1e-6))
+        for total, grad in zip(summed, grads):
+            total += scale * grad
+    for param, total in zip(params, summed):
+        param.grad = (total + torch.randn_like(total) * args.dp_noise_multiplier * args.dp_clip) / x.shape[0]
+
+
+def samples_per_second(args, model, loader, backward):
+    """ Local SGD steps on the batches of loader, the first step (warm up) is not timed """
+    optimizer = torch.optim.SGD([param for param in model.parameters() if param.requires_grad], lr=1e-3)
+    loss_fct = torch.nn.CrossEntropyLoss()
+    model.train()
+
+    samples, start = 0, None
+    for step, (x, y) in enumerate(itertools.islice(loader, args.num_batches + 1)):
+        if step == 1:
+            if args.device.type == 'cuda':
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+        x, y = x.to(args.device), y.to(args.device)
+        backward(args, model, loss_fct, x, y)
+        optimizer.step()
+        optimizer.zero_grad()
+        if step > 0:
+            samples += x.shape[0]
+    if args.device.type == 'cuda':
+        torch.cuda.synchronize()
+    return samples / max(time.perf_counter() - start, 1e-9)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local training throughput with and without DP-SGD on the clients of CIFAR-10 splits.")
+    parser.add_argument("--data_path", type=str, default='./data/', help="Where is dataset located.")
+    parser.add_argument("--split_types", type=str, nargs='+', default=["split_1", "split_2", "split_3"], help="CIFAR-10 partitions to benchmark.")
+    parser.add_argument("--FL_platform", type=str, default="ViT-FedAVG", help="Architecture from the model registry (no batch norm).")
+    parser.add_argument("--norm", type=str, default=None, help="Normalization variant of the architecture.")
+    parser.add_argument("--img_size", default=224, type=int, help="Final train resolution")
+    parser.add_argument("--batch_size", default=32, type=int, help="Local batch size.")
+    parser.add_argument("--micro_batch_size", default=0, type=int, help="Per-sample gradients computed by micro-batches of this size (0: whole batch).")
+    parser.add_argument("--num_batches", default=10, type=int, help="Batches timed per mode.")
+    parser.add_argument("--dp_clip", default=1.0, type=float, help="L2 bound of every per-sample gradient.")
+    parser.add_argument("--dp_noise_multiplier", default=1.0, type=float, help="Std of the noise relative to --dp_clip.")
+    parser.add_argument('--naive', action='store_true', default=False, help="Also time the per-sample backward loop.")
+    parser.add_argument("--gpu_ids", type=str, default='0', help="gpu ids: e.g. 0  0,1,2")
+    parser.add_argument('--seed', type=int, default=42, help="random seed")
+    args = parser.parse_args()
+
+    args.device = torch.device("cuda:{gpu_id}".format(gpu_id=args.gpu_ids) if torch.cuda.is_available() else "cpu")
+    args.dataset = 'cifar10'
+    args.num_classes = 10
+    args.pretrained = False
+    args.model_cache_dir = None
+
+    torch.manual_seed(args.seed)
+    model = create_model(args).to(args.device)
+
+    modes = [('non-DP', forward_backward), ('DP vmap', dp_backward)] + ([('DP naive', naive_dp_backward)] if args.naive else [])
+    print('{:<10} {:<10} {:>12} {:>10}'.format('split', 'mode', 'samples/s', 'slowdown'))
+    for split_type in args.split_types:
+        data_args = SimpleNamespace(dataset=args.dataset, data_path=args.data_path, split_type=split_type,
+                                    img_size=args.img_size, num_classes=args.num_classes,
+                                    best_acc={}, current_acc={}, current_test_acc={})
+        loaded_npy = create_dataset_and_evalmetrix(data_args)
+        data_args.single_client = max(data_args.clients_with_len, key=data_args.clients_with_len.get)
+        dataset = DatasetFLViT(data_args, loaded_npy, phase='train')
+        loader = DataLoader(dataset, sampler=RandomSampler(dataset), batch_size=args.batch_size, drop_last=True)
+
+        reference = None
+        for name, backward in modes:
+            rate = samples_per_second(args, model, loader, backward)
+            reference = reference or rate
+            print('{:<10} {:<10} {:>12.1f} {:>9.2f}x'.format(split_type, name, rate, reference / rate))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+# coding=utf-8
+from __future__ import absolute_import, division, print_function
+
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+ENTRY_POINTS = ['train_FedAVG', 'train_FedProx', 'train_FedOpt', 'train_SCAFFOLD']
+
+
+def parse_importtime(stderr):
+    """
+    Parse the output of `python -X importtime`. Returns the total import time (ms) and the
+    cumulative time of every top level package, e.g. {'torch': 950.2, 'numpy': 80.1}.
+    """
+    top_level = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        # nested imports are indented below the package that triggered them
+        if name.startswith('  '):
+            continue
+        name = name.strip()
+        top_level[name] = top_level.get(name, 0) + int(cumulative_us) / 1000
+    return sum(top_level.values()), top_level
+
+
+def measure(command, repeats):
+    totals, wall_times, packages = [], [], {}
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, '-X', 'importtime'] + command, capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+        wall_times.append((time.perf_counter() - start) * 1000)
+        total, top_level = parse_importtime(result.stderr)
+        totals.append(total)
+        packages = top_level
+    # the minimum is the least noisy estimate of the startup cost
+    return min(totals), min(wall_times), packages
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return 'unknown'
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeats", default=3, type=int, help="Runs per entry point, the fastest one is reported.")
+    parser.add_argument("--top", default=8, type=int, help="Number of heaviest top level imports to show.")
+    parser.add_argument("--history_file", type=str, default="import_time_history.csv", help="CSV where every measurement is appended to track startup latency over time.")
+    parser.add_argument("--max_ms", default=None, type=float, help="Exit with an error if a --help invocation takes longer than this.")
+    args = parser.parse_args()
+
+    revision = git_revision()
+    stamp = time.strftime('%Y-%m-%d %H:%M:%S')
+    rows = []
+    too_slow = []
+
+    for entry_point in ENTRY_POINTS:
+        for mode, command in [('import', ['-c', 'import ' + entry_point]), ('help', [entry_point + '.py', '--help'])]:
+            total, wall, packages = measure(command, args.repeats)
+            heaviest = sorted(packages.items(), key=lambda item: item[1], reverse=True)[:args.top]
+            print('{:<16} {:<6} imports {:8.1f} ms  wall {:8.1f} ms  | {}'.format(
+                entry_point, mode, total, wall, ', '.join('%s %.0f' % (name, ms) for name, ms in heaviest)))
+            rows.append([stamp, revision, entry_point, mode, '%.1f' % total, '%.1f' % wall])
+            if mode == 'help' and args.max_ms is not None and wall > args.max_ms:
+                too_slow.append(entry_point)
+
+    new_file = not os.path.exists(args.history_file)
+    with open(args.history_file, 'a+') as history:
+        if new_file:
+            history.write('time,revision,entry_point,mode,import_ms,wall_ms\n')
+        for row in rows:
+            history.write(','.join(row) + '\n')
+    print('Appended results to', args.history_file)
+
+    if too_slow:
+        sys.exit('--help slower than %.0f ms for: %s' % (args.max_ms, ', '.join(too_slow)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+# coding=utf-8
+from __future__ import absolute_import, division, print_function
+
+import time
+import argparse
+from copy import deepcopy
+
+import torch
+import torch.nn as nn
+from timm.layers.norm_act import BatchNormAct2d
+from utils.architectures_modifications import GroupNormAct2d, convert_to_group_norm, functional_act
+from utils.model_registry import create_model
+
+
+def set_fused(model, fused):
+    for module in model.modules():
+        if isinstance(module, GroupNormAct2d):
+            module.fused = fused
+
+
+def check_conversion(model_bn, model_gn):
+    """ Every converted layer keeps the affine parameters (and activation) of the layer it replaces """
+    bn_layers = {name: m for name, m in model_bn.named_modules() if isinstance(m, nn.BatchNorm2d)}
+    gn_layers = {name: m for name, m in model_gn.named_modules() if isinstance(m, nn.GroupNorm)}
+    assert bn_layers.keys() == gn_layers.keys(), 'some normalization layers were not converted'
+
+    for name, bn in bn_layers.items():
+        gn = gn_layers[name]
+        assert torch.equal(bn.weight, gn.weight) and torch.equal(bn.bias, gn.bias), 'affine parameters lost in %s' % name
+        if isinstance(bn, BatchNormAct2d):
+            assert isinstance(gn, GroupNormAct2d) and type(gn.act) is type(bn.act), 'activation lost in %s' % name
+    print('Converted %d layers, affine parameters and activations preserved' % len(bn_layers))
+
+
+def report_compiles(model):
+    """ Graphs compiled for the fused layers of a forward pass: one per (activation, eps), not one per layer """
+    layers = [m for m in model.modules() if isinstance(m, GroupNormAct2d) and functional_act(m.act) is not None]
+    variants = set((functional_act(m.act), m.eps) for m in layers)
+    graphs = torch._dynamo.utils.counters['stats']['unique_graphs']
+    print('Fused GroupNorm: %d graph(s) compiled for %d layers (%d activation / eps variants)' % (graphs, len(layers), len(variants)))
+    if graphs > len(variants):
+        print('Warning: the fused layers recompile per layer, see TORCH_LOGS=recompiles')
+
+
+def time_step(model, x, y, steps):
+    loss_fct = torch.nn.CrossEntropyLoss()
+    model.train()
+    for step in range(steps + 1):
+        if step == 1:
+            # the first step includes compilation and allocator warmup
+            start = time.perf_counter()
+        loss = loss_fct(model(x), y)
+        loss.backward()
+        model.zero_grad(set_to_none=True)
+    return (time.perf_counter() - start) / steps * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--FL_platform", type=str, default="CoAtNet-FedAVG", help="Architecture with BN layers to convert.")
+    parser.add_argument("--norm", type=str, default="BN", help="Normalization variant used as the BN baseline.")
+    parser.add_argument("--img_size", default=224, type=int, help="Input resolution")
+    parser.add_argument("--batch_size", default=32, type=int, help="Batch size of the timed steps.")
+    parser.add_argument("--steps", default=5, type=int, help="Number of timed forward/backward steps.")
+    parser.add_argument("--num_classes", default=10, type=int, help="Size of the classification head.")
+    args = parser.parse_args()
+    args.pretrained = False
+    args.model_cache_dir = None
+
+    torch.manual_seed(0)
+    model_bn = create_model(args)
+    model_gn = deepcopy(model_bn)
+    convert_to_group_norm(model_gn, norm_types=(BatchNormAct2d, nn.BatchNorm2d))
+    check_conversion(model_bn, model_gn)
+
+    x = torch.randn(args.batch_size, 3, args.img_size, args.img_size)
+    y = torch.randint(0, args.num_classes, (args.batch_size,))
+
+    model_gn.eval()
+    torch._dynamo.reset()
+    torch._dynamo.utils.counters.clear()
+    with torch.no_grad():
+        set_fused(model_gn, False)
+        eager_out = model_gn(x)
+        set_fused(model_gn, True)
+        fused_out = model_gn(x)
+    print('Fused vs eager GroupNorm max abs difference: %.2e' % (fused_out - eager_out).abs().max().item())
+    report_compiles(model_gn)
+
+    results = {'BN': time_step(model_bn, x, y, args.steps)}
+    set_fused(model_gn, False)
+    results['GN eager'] = time_step(model_gn, x, y, args.steps)
+    set_fused(model_gn, True)
+    results['GN fused'] = time_step(model_gn, x, y, args.steps)
+
+    for name, ms in results.items():
+        print('{:<10} {:8.1f} ms / step  ({:.2f}x BN)'.format(name, ms, ms / results['BN']))
+
+
+if __name__ == "__main__":
+    main()
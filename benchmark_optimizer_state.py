@@ -0,0 +1,80 @@
+# coding=utf-8
+from __future__ import absolute_import, division, print_function
+
+import argparse
+from copy import deepcopy
+
+import torch
+from utils.model_registry import create_model
+from utils.optim_state import pack_optimizer_state, unpack_optimizer_state, optimizer_state_nbytes
+from utils.util import optimization_fun
+
+
+def run(args, base_model, data, labels, precision):
+    """ Local training of one client over several rounds, the optimizer state is packed between the rounds """
+    torch.manual_seed(args.seed)
+    model = deepcopy(base_model)
+    optimizer = optimization_fun(args, model)
+    loss_fct = torch.nn.CrossEntropyLoss()
+
+    packed_bytes = 0
+    for communication_round in range(args.rounds):
+        unpack_optimizer_state(optimizer, 'cpu')
+        for step in range(args.local_steps):
+            index = torch.randint(0, data.shape[0], (args.batch_size,))
+            loss = loss_fct(model(data[index]), labels[index])
+            loss.backward()
+            optimizer.step()
+            optimizer.zero_grad()
+        pack_optimizer_state(optimizer, precision)
+        packed_bytes = optimizer_state_nbytes(optimizer)
+
+    model.eval()
+    with torch.no_grad():
+        logits = torch.cat([model(chunk) for chunk in data.split(args.batch_size)])
+    accuracy = (logits.argmax(dim=-1) == labels).float().mean().item()
+    return model, packed_bytes, accuracy, loss_fct(logits, labels).item()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--FL_platform", type=str, default="ConvNeXt-FedAVG", help="Architecture from the model registry.")
+    parser.add_argument("--norm", type=str, default=None, help="Normalization variant of the architecture.")
+    parser.add_argument("--img_size", default=64, type=int, help="Resolution of the synthetic images.")
+    parser.add_argument("--num_samples", default=256, type=int, help="Size of the synthetic client dataset.")
+    parser.add_argument("--batch_size", default=16, type=int, help="Local batch size.")
+    parser.add_argument("--rounds", default=10, type=int, help="Communication rounds, the state is packed after each one.")
+    parser.add_argument("--local_steps", default=10, type=int, help="Local steps per round.")
+    parser.add_argument("--learning_rate", default=3e-2, type=float, help="Learning rate for SGD, AdamW uses a tenth of it.")
+    parser.add_argument("--num_classes", default=10, type=int, help="Number of synthetic classes.")
+    parser.add_argument('--seed', type=int, default=42, help="random seed")
+    args = parser.parse_args()
+    args.pretrained = False
+    args.model_cache_dir = None
+    args.weight_decay = 0
+
+    torch.manual_seed(args.seed)
+    base_model = create_model(args)
+    data = torch.randn(args.num_samples, 3, args.img_size, args.img_size)
+    labels = torch.randint(0, args.num_classes, (args.num_samples,))
+    learning_rate = args.learning_rate
+
+    print('{:<6} {:<5} {:>12} {:>8} {:>10} {:>10} {:>14}'.format('optim', 'state', 'host MB', 'saved', 'train acc', 'loss', 'rel. param diff'))
+    for optimizer_type in ['sgd', 'adamw']:
+        args.optimizer_type = optimizer_type
+        args.learning_rate = learning_rate if optimizer_type == 'sgd' else learning_rate / 10
+
+        reference = None
+        for precision in ['fp32', 'bf16', 'int8']:
+            model, nbytes, accuracy, loss = run(args, base_model, data, labels, precision)
+            if reference is None:
+                reference, reference_bytes = model, nbytes
+
+            diff = sum((p - q).norm() ** 2 for p, q in zip(model.parameters(), reference.parameters())) ** 0.5
+            norm = sum(q.norm() ** 2 for q in reference.parameters()) ** 0.5
+            print('{:<6} {:<5} {:>12.1f} {:>7.1f}% {:>10.4f} {:>10.4f} {:>14.2e}'.format(
+                optimizer_type, precision, nbytes / 2 ** 20, 100 * (1 - nbytes / reference_bytes), accuracy, loss, (diff / norm).item()))
+
+
+if __name__ == "__main__":
+    main()
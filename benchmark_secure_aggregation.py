@@ -0,0 +1,64 @@
+# coding=utf-8
+from __future__ import absolute_import, division, print_function
+
+import time
+import argparse
+from types import SimpleNamespace
+
+import torch
+from utils.secure_aggregation import SecureAggregator
+
+
+def plain_weighted_sum(tensor_lists, weights, like):
+    return [sum(weight * tensors[index] for tensors, weight in zip(tensor_lists, weights)) for index in range(len(like))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CPU, memory and upload overhead of the secure aggregation simulation against the plain weighted sum.")
+    parser.add_argument("--num_params", default=100000, type=int, help="Size of the flattened client update.")
+    parser.add_argument("--layer_size", default=65536, type=int, help="Parameters per synthetic layer.")
+    parser.add_argument("--num_clients", type=int, nargs='+', default=[10, 100, 1000], help="Clients per round.")
+    parser.add_argument("--neighbors", type=int, nargs='+', default=[0, 16], help="Mask graph degrees (0: complete graph).")
+    parser.add_argument("--dropouts", type=float, nargs='+', default=[0., 0.1], help="Client dropout rates.")
+    parser.add_argument("--precision_bits", default=24, type=int, help="Fractional bits of the fixed point encoding.")
+    parser.add_argument("--chunk_mb", default=64, type=int, help="Working memory of the masking.")
+    parser.add_argument("--max_pairs", default=200000, type=int, help="Skip configurations with more mask pairs than this per round.")
+    parser.add_argument('--seed', type=int, default=42, help="random seed")
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+    sizes = [args.layer_size] * (args.num_params // args.layer_size) + ([args.num_params % args.layer_size] if args.num_params % args.layer_size else [])
+    like = [torch.zeros(size) for size in sizes]
+
+    print('{:>8} {:>6} {:>8} {:>10} {:>12} {:>12} {:>11} {:>10} {:>10}'.format(
+        'clients', 'graph', 'dropout', 'plain (s)', 'client (s)', 'server (s)', 'memory MB', 'upload', 'max err'))
+    for num_clients in args.num_clients:
+        tensor_lists = [[torch.randn(size) * 0.01 for size in sizes] for _ in range(num_clients)]
+        weights = torch.rand(num_clients)
+        weights = (weights / weights.sum()).tolist()
+
+        start = time.process_time()
+        reference = plain_weighted_sum(tensor_lists, weights, like)
+        plain_time = time.process_time() - start
+
+        for neighbors in args.neighbors:
+            degree = num_clients - 1 if neighbors <= 0 or neighbors >= num_clients - 1 else neighbors
+            if num_clients * degree // 2 > args.max_pairs:
+                continue
+            for dropout in args.dropouts:
+                secagg_args = SimpleNamespace(seed=args.seed, secagg_neighbors=neighbors, secagg_dropout=dropout,
+                                              secagg_precision_bits=args.precision_bits, secagg_chunk_mb=args.chunk_mb)
+                aggregator = SecureAggregator(secagg_args)
+                result = aggregator.weighted_sum(tensor_lists, weights, like)
+
+                chunk = min(args.num_params, args.chunk_mb * 2 ** 20 // (8 + 4 * num_clients))
+                memory = chunk * (3 * 8 + 4 * num_clients) / 2 ** 20
+                # exact sum when nobody dropped, the survivors' renormalized sum otherwise
+                error = max((r - q).abs().max().item() for r, q in zip(result, reference)) if dropout == 0 else float('nan')
+                print('{:>8} {:>6} {:>8.2f} {:>10.4f} {:>12.4f} {:>12.4f} {:>11.2f} {:>9}x {:>10.2e}'.format(
+                    num_clients, 'full' if degree == num_clients - 1 else '%d-reg' % degree, dropout, plain_time,
+                    aggregator.last_client_time, aggregator.last_server_time, memory, 8 // like[0].element_size(), error))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+# coding=utf-8
+from __future__ import absolute_import, division, print_function
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+
+def create_once(args):
+    """ Runs inside a fresh interpreter so that imports are part of the measured cold start """
+    start = time.perf_counter()
+    import torch
+    from utils.model_registry import time_model_creation
+    import_time = time.perf_counter() - start
+
+    torch.manual_seed(args.seed)
+    model, create_time = time_model_creation(args)
+    num_params = sum(p.numel() for p in model.parameters()) / 1000000
+
+    print(json.dumps({'import_s': import_time, 'create_s': create_time, 'params_M': num_params}))
+
+
+def run_variant(args, FL_platform, norm, use_cache):
+    command = [sys.executable, os.path.abspath(__file__), '--worker',
+               '--FL_platform', FL_platform, '--num_classes', str(args.num_classes), '--seed', str(args.seed)]
+    if norm:
+        command += ['--norm', norm]
+    if use_cache:
+        command += ['--use_cache', '--model_cache_dir', args.model_cache_dir]
+
+    start = time.perf_counter()
+    result = subprocess.run(command, capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    wall_time = time.perf_counter() - start
+
+    if result.returncode != 0:
+        print(result.stderr.strip().splitlines()[-1] if result.stderr.strip() else 'failed')
+        return None
+
+    timings = json.loads(result.stdout.strip().splitlines()[-1])
+    timings['wall_s'] = wall_time
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_cache_dir", type=str, default="model_cache", help="Where the model snapshots are stored.")
+    parser.add_argument("--num_classes", default=10, type=int, help="Size of the classification head.")
+    parser.add_argument("--architectures", type=str, nargs='*', default=None, help="Subset of registry keys to benchmark. All if not set.")
+    parser.add_argument("--output_file", type=str, default="startup_benchmark.csv", help="Where the report is written.")
+    parser.add_argument('--seed', type=int, default=42, help="random seed for initialization")
+
+    # internal: single model creation in a fresh process
+    parser.add_argument("--worker", action='store_true', default=False, help=argparse.SUPPRESS)
+    parser.add_argument("--FL_platform", type=str, default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--norm", type=str, default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--use_cache", action='store_true', default=False, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    args.pretrained = True
+
+    if args.worker:
+        if not args.use_cache:
+            args.model_cache_dir = None
+        create_once(args)
+        return
+
+    from utils.model_registry import ARCHITECTURES
+
+    rows = []
+    for arch in ARCHITECTURES:
+        if args.architectures and arch.key not in args.architectures:
+            continue
+        for norm in arch.norms:
+            name = arch.key + ('-' + norm if norm else '')
+            # first run fills the snapshot cache, the second one reads from it
+            cold = run_variant(args, arch.key, norm, use_cache=False)
+            run_variant(args, arch.key, norm, use_cache=True)
+            warm = run_variant(args, arch.key, norm, use_cache=True)
+
+            if cold is None or warm is None:
+                print('{:<22} failed to build, skipped'.format(name))
+                rows.append([name] + ['nan'] * 6)
+                continue
+
+            print('{:<22} params {:6.1f}M | imports {:5.2f}s | cold: create {:6.2f}s wall {:6.2f}s | cached: create {:6.2f}s wall {:6.2f}s'.format(
+                name, cold['params_M'], cold['import_s'], cold['create_s'], cold['wall_s'], warm['create_s'], warm['wall_s']))
+            rows.append([name, '%.1f' % cold['params_M'], '%.3f' % cold['import_s'], '%.3f' % cold['create_s'], '%.3f' % cold['wall_s'],
+                         '%.3f' % warm['create_s'], '%.3f' % warm['wall_s']])
+
+    with open(args.output_file, 'wt') as report:
+        report.write('architecture,params_M,import_s,cold_create_s,cold_wall_s,cached_create_s,cached_wall_s\n')
+        for row in rows:
+            report.write(','.join(row) + '\n')
+    print('Report written to', args.output_file)
+
+
+if __name__ == "__main__":
+    main()
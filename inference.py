@@ -0,0 +1,224 @@
+# coding=utf-8
+from __future__ import absolute_import, division, print_function
+
+import os
+import csv
+import time
+import argparse
+
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.utils.data import Dataset, DataLoader, SequentialSampler
+from utils.data_utils import DatasetFLViT, build_transform, create_dataset_and_evalmetrix
+from utils.model_registry import create_model, find_architecture
+from utils.adapters import inject_lora, merge_lora
+from utils.checkpoint_store import CheckpointStore
+
+DATASET_CLASSES = {'cifar10': 10, 'pacs': 7, 'gldk23': 203, 'isic19': 8}
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.webp')
+
+
+class ImageFiles(Dataset):
+    """ Image files (or the images of directories, recursively) with the evaluation transform, label -1 """
+    def __init__(self, args, paths):
+        self.files = []
+        for path in paths:
+            if os.path.isdir(path):
+                for root, _, names in sorted(os.walk(path)):
+                    self.files.extend(os.path.join(root, name) for name in sorted(names) if name.lower().endswith(IMAGE_EXTENSIONS))
+            else:
+                self.files.append(path)
+        self.transform = build_transform(args, 'test')
+
+    def __getitem__(self, index):
+        from PIL import Image
+        return self.transform(Image.open(self.files[index]).convert('RGB')), -1
+
+    def __len__(self):
+        return len(self.files)
+
+
+def load_checkpoint(args):
+    """ state_dict of a .pth checkpoint, or of a client of a --checkpoint_store directory (default: the best client) """
+    if not os.path.isdir(args.checkpoint):
+        return torch.load(args.checkpoint, map_location='cpu')
+
+    store = CheckpointStore(args.checkpoint)
+    client = args.client
+    if client is None:
+        client = max(store.latest, key=lambda name: store.latest[name].get('best_acc', 0.))
+    print('Client %s of the checkpoint store, version %s' % (client, 'latest' if args.version is None else args.version))
+    return store.load(client, args.version)
+
+
+def fold_batch_norms(model):
+    """ Fold every eval mode BatchNorm following a convolution into its weights, returns the number of folded layers """
+    from torch.nn.utils.fusion import fuse_conv_bn_eval
+    try:
+        # traced graph: finds conv -> bn pairs wherever the modules live (e.g. conv1 / bn1 attributes of ResNet blocks)
+        from torch.fx.experimental.optimization import fuse
+        num_bn = sum(isinstance(module, nn.modules.batchnorm._BatchNorm) for module in model.modules())
+        fused = fuse(model)
+        return fused, num_bn - sum(isinstance(module, nn.modules.batchnorm._BatchNorm) for module in fused.modules())
+    except Exception as error:
+        print('Model cannot be traced (%s), folding the conv / bn pairs of nn.Sequential only' % type(error).__name__)
+
+    folded = 0
+    for module in model.modules():
+        if not isinstance(module, nn.Sequential):
+            continue
+        names = list(module._modules)
+        for name, next_name in zip(names, names[1:]):
+            conv, bn = module._modules[name], module._modules[next_name]
+            if isinstance(conv, nn.Conv2d) and isinstance(bn, nn.BatchNorm2d):
+                module._modules[name] = fuse_conv_bn_eval(conv, bn)
+                module._modules[next_name] = nn.Identity()
+                folded += 1
+    return model, folded
+
+
+def load_weights(args, model, state_dict):
+    """ Every weight of the model comes from the checkpoint: a wrong --FL_platform / --norm / --dataset raises instead of running a random head """
+    missing, unexpected = model.load_state_dict(state_dict, strict=False)
+    if missing or unexpected:
+        raise ValueError('Checkpoint %s does not match %s (--norm %s, %d classes): %d missing keys %s, %d unexpected keys %s' % (
+            args.checkpoint, args.FL_platform, args.norm, args.num_classes, len(missing), missing[:3], len(unexpected), unexpected[:3]))
+
+
+def prepare_model(args):
+    model = create_model(args)
+    state_dict = load_checkpoint(args)
+    if all(name.startswith('model.') for name in state_dict):
+        # --freeze_backbone run: the checkpoint is the one of the TrainableTail wrapping the model
+        state_dict = {name[len('model.'):]: value for name, value in state_dict.items()}
+    if any('lora_A' in name for name in state_dict):
+        # adapter run: the adapters are merged into the base weights, the network is the plain architecture again
+        targets = set(name.split('.')[-2] for name in state_dict if name.endswith('lora_A'))
+        inject_lora(model, targets, args.lora_rank, args.lora_alpha)
+        load_weights(args, model, state_dict)
+        merge_lora(model)
+    else:
+        load_weights(args, model, state_dict)
+    model.eval()
+
+    if args.fold_bn:
+        model, folded = fold_batch_norms(model)
+        print('Folded %d batch norms into their convolutions' % folded)
+    if args.quantize:
+        model = torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+        print('Dynamic int8 quantization of %d linear layers' % sum(
+            isinstance(module, torch.ao.nn.quantized.dynamic.Linear) for module in model.modules()))
+    model.to(args.device)
+    if args.channels_last:
+        model.to(memory_format=torch.channels_last)
+    return model
+
+
+def build_loader(args):
+    if args.images:
+        dataset = ImageFiles(args, args.images)
+    else:
+        # packed dataset of the training scripts: union test / val set of a split
+        args.best_acc, args.current_acc, args.current_test_acc = {}, {}, {}
+        loaded_npy = create_dataset_and_evalmetrix(args)
+        args.single_client = args.dis_cvs_files[0]
+        dataset = DatasetFLViT(args, loaded_npy, phase=args.phase)
+    kwargs = {'prefetch_factor': args.prefetch_factor} if args.num_workers > 0 else {}
+    return DataLoader(dataset, sampler=SequentialSampler(dataset), batch_size=args.batch_size, num_workers=args.num_workers, **kwargs)
+
+
+def run(args, model, loader):
+    latencies, predictions, labels = [], [], []
+    wall_start = time.perf_counter()
+    with torch.inference_mode():
+        for step, (x, y) in enumerate(loader):
+            x = x.to(args.device)
+            if args.channels_last:
+                x = x.contiguous(memory_format=torch.channels_last)
+            start = time.perf_counter()
+            logits = model(x)
+            if args.device.type == 'cuda':
+                torch.cuda.synchronize()
+            if step >= args.warmup_batches:
+                latencies.append((time.perf_counter() - start, x.shape[0]))
+            else:
+                wall_start = time.perf_counter()
+            predictions.append(torch.argmax(logits, dim=-1).cpu().numpy())
+            labels.append(np.asarray(y).reshape(-1))
+    wall = time.perf_counter() - wall_start
+    return latencies, wall, np.concatenate(predictions), np.concatenate(labels)
+
+
+def report(args, latencies, wall, predictions, labels):
+    if not latencies:
+        print('Not enough batches to time after the %d warm up batches' % args.warmup_batches)
+        return
+    times = np.array([latency for latency, _ in latencies])
+    sizes = np.array([size for _, size in latencies])
+    samples = sizes.sum()
+    print('{:>12} {:>10} {:>10} {:>10} {:>10}'.format('', 'p50', 'p90', 'p99', 'max'))
+    print('{:>12} {:>10.2f} {:>10.2f} {:>10.2f} {:>10.2f}'.format('batch ms', *(np.percentile(times, [50, 90, 99, 100]) * 1000)))
+    print('{:>12} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.3f}'.format('image ms', *(np.percentile(times / sizes, [50, 90, 99, 100]) * 1000)))
+    # throughput of the slow batches: p90 / p99 are the 10% / 1% lowest rates
+    print('{:>12} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.1f}'.format('images/s', *np.percentile(sizes / times, [50, 10, 1, 0])))
+    print('Throughput: %.1f images/s model only, %.1f images/s with data loading (%d timed images)' % (
+        samples / times.sum(), samples / max(wall, 1e-9), samples))
+    if (labels >= 0).all():
+        print('Accuracy: %.4f on %d images' % ((predictions == labels).mean(), len(labels)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Batched inference of a trained checkpoint, with latency and throughput percentiles.")
+    parser.add_argument("--checkpoint", type=str, required=True, help="Checkpoint of --save_model_flag: a .pth file or a --checkpoint_store directory.")
+    parser.add_argument("--client", type=str, default=None, help="Client of the checkpoint store (default: the one with the best val accuracy).")
+    parser.add_argument("--version", type=int, default=None, help="Version of the client checkpoint in the store (default: latest).")
+    parser.add_argument("--FL_platform", type=str, default="ViT-FedAVG", help="Architecture of the checkpoint, as in the training scripts.")
+    parser.add_argument("--norm", type=str, default=None, help="Normalization variant of the architecture.")
+    parser.add_argument("--dataset", choices=["cifar10", "pacs", "celeba", "gldk23", "isic19"], default="cifar10", help="Dataset of the checkpoint (number of classes) and of --split_type.")
+    parser.add_argument("--lora_rank", default=8, type=int, help="Rank of the LoRA adapters of an --adapter lora checkpoint")
+    parser.add_argument("--lora_alpha", default=16, type=float, help="Scaling of the LoRA update (alpha / rank)")
+    parser.add_argument("--images", type=str, nargs='+', default=None, help="Image files or directories to classify, instead of a packed dataset.")
+    parser.add_argument("--data_path", type=str, default='./data/', help="Where is dataset located.")
+    parser.add_argument("--split_type", type=str, default="central", help="Split of the packed dataset.")
+    parser.add_argument("--phase", choices=["test", "val"], default="test", help="Union set of the packed dataset to run.")
+    parser.add_argument("--img_size", default=224, type=int, help="Final train resolution")
+    parser.add_argument("--batch_size", default=256, type=int, help="Inference batch size.")
+    parser.add_argument("--num_workers", default=4, type=int, help="DataLoader worker processes.")
+    parser.add_argument("--prefetch_factor", default=4, type=int, help="Batches prefetched by every worker.")
+    parser.add_argument("--warmup_batches", default=2, type=int, help="Batches run before the timing starts.")
+    parser.add_argument('--quantize', action='store_true', default=False, help="Dynamic int8 quantization of the linear layers (CPU).")
+    parser.add_argument('--fold_bn', action='store_true', default=False, help="Fold the batch norms into the preceding convolutions.")
+    parser.add_argument("--threads", default=0, type=int, help="torch intra-op threads (0: torch default).")
+    parser.add_argument("--device", type=str, default="cpu", help="cpu or cuda:<id>")
+    parser.add_argument("--output", type=str, default=None, help="CSV file of the predictions.")
+    args = parser.parse_args()
+
+    args.device = torch.device(args.device)
+    if args.quantize and args.device.type != 'cpu':
+        raise ValueError('--quantize uses the dynamic quantized kernels of the CPU')
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    args.num_classes = DATASET_CLASSES.get(args.dataset, 2)
+    args.pretrained = False
+    args.model_cache_dir = None
+    args.channels_last = find_architecture(args.FL_platform).channels_last
+
+    model = prepare_model(args)
+    loader = build_loader(args)
+    print('============ Inference of %s on %d images, batch size %d, %d threads ============' % (
+        args.FL_platform, len(loader.dataset), args.batch_size, torch.get_num_threads()))
+    latencies, wall, predictions, labels = run(args, model, loader)
+    report(args, latencies, wall, predictions, labels)
+
+    if args.output:
+        with open(args.output, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['index', 'file', 'prediction'])
+            files = getattr(loader.dataset, 'files', None)
+            for index, prediction in enumerate(predictions):
+                writer.writerow([index, files[index] if files else '', int(prediction)])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+# coding=utf-8
+from __future__ import absolute_import, division, print_function
+
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Start a train script on several gloo ranks, the selected clients of every round are split between the ranks. "
+                                                 "Example: python launch_distributed.py --nproc_per_node 4 train_FedAVG.py --dataset cifar10 ...")
+    parser.add_argument("--nproc_per_node", default=2, type=int, help="Ranks started on this host.")
+    parser.add_argument("--nnodes", default=1, type=int, help="Number of hosts.")
+    parser.add_argument("--node_rank", default=0, type=int, help="Index of this host.")
+    parser.add_argument("--master_addr", type=str, default="127.0.0.1", help="Address of the host of rank 0.")
+    parser.add_argument("--master_port", default=29500, type=int, help="Free port on the host of rank 0.")
+    parser.add_argument("script", type=str, help="train_FedAVG.py, train_FedProx.py, train_FedOpt.py or train_SCAFFOLD.py")
+    parser.add_argument("script_args", nargs=argparse.REMAINDER, help="Arguments of the train script.")
+    args = parser.parse_args()
+
+    world_size = args.nnodes * args.nproc_per_node
+    processes = []
+    for local_rank in range(args.nproc_per_node):
+        env = dict(os.environ)
+        env.update({
+            'MASTER_ADDR': args.master_addr,
+            'MASTER_PORT': str(args.master_port),
+            'WORLD_SIZE': str(world_size),
+            'RANK': str(args.node_rank * args.nproc_per_node + local_rank),
+            'LOCAL_RANK': str(local_rank),
+            'LOCAL_WORLD_SIZE': str(args.nproc_per_node),
+        })
+        processes.append(subprocess.Popen([sys.executable, args.script] + args.script_args, env=env))
+
+    # a failing rank would leave the others blocked in a collective, stop them all
+    exit_code = 0
+    while processes:
+        for process in list(processes):
+            code = process.poll()
+            if code is None:
+                continue
+            processes.remove(process)
+            if code != 0:
+                exit_code = code
+                for other in processes:
+                    other.terminate()
+        time.sleep(0.5)
+    sys.exit(exit_code)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+# coding=utf-8
+from __future__ import absolute_import, division, print_function
+
+import os
+import time
+import argparse
+
+import numpy as np
+from utils.partition import PARTITION_DATASETS, base_pool, make_partition, save_partition
+
+
+def partition_name(args, num_clients):
+    if args.method in ['dirichlet', 'quantity_skew']:
+        setting = 'alpha_%g' % args.alpha
+    elif args.method == 'label_skew':
+        setting = 'classes_%d' % args.classes_per_client
+    else:
+        setting = 'iid'
+    return '%s_%s_%s_%d_clients_seed_%d.npz' % (args.dataset, args.method, setting, num_clients, args.seed)
+
+
+def describe(indices, offsets, targets):
+    sizes = np.diff(offsets)
+    num_labels = int(targets.max()) + 1
+    # label histogram of every client at once: (client, label) pairs counted with a single bincount
+    client_of = np.repeat(np.arange(len(sizes)), sizes)
+    histogram = np.bincount(client_of * num_labels + targets[indices], minlength=len(sizes) * num_labels).reshape(len(sizes), num_labels)
+    classes_per_client = (histogram > 0).sum(axis=1)
+    print('  samples per client: min %d, median %d, max %d | classes per client: mean %.2f | size on disk %.2fMB' % (
+        sizes.min(), np.median(sizes), sizes.max(), classes_per_client.mean(), (indices.nbytes + offsets.nbytes) / 2 ** 20))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dataset", choices=PARTITION_DATASETS, default="cifar10", help="Which dataset.")
+    parser.add_argument("--data_path", type=str, default='./data/', help="Where is dataset located.")
+    parser.add_argument("--source_split", type=str, default="central", help="Split of the .npy whose training samples form the pool that is partitioned.")
+    parser.add_argument("--method", choices=["dirichlet", "label_skew", "quantity_skew", "iid"], default="dirichlet", help="Partition scheme.")
+    parser.add_argument("--num_clients", type=int, nargs='+', default=[100], help="One partition is generated for each value.")
+    parser.add_argument("--alpha", default=0.5, type=float, help="Dirichlet concentration (dirichlet: label skew, quantity_skew: size skew).")
+    parser.add_argument("--classes_per_client", default=2, type=int, help="Classes held by each client with label_skew.")
+    parser.add_argument("--min_size", default=1, type=int, help="Minimum number of samples per client.")
+    parser.add_argument("--output_dir", type=str, default=None, help="Where the partitions are saved (default: <data_path>/<dataset>/partitions).")
+    parser.add_argument('--seed', type=int, default=42, help="random seed")
+    args = parser.parse_args()
+
+    output_dir = args.output_dir or os.path.join(args.data_path, args.dataset, 'partitions')
+    data_all = np.load(os.path.join(args.data_path, args.dataset, args.dataset + '.npy'), allow_pickle=True).item()
+    images, targets = base_pool(data_all, args.source_split)
+    print('Pool of %d samples from split %s' % (len(targets), args.source_split))
+
+    for num_clients in args.num_clients:
+        start = time.time()
+        indices, offsets = make_partition(targets, num_clients, args.method, args.alpha, args.classes_per_client, args.min_size, args.seed)
+        meta = {'dataset': args.dataset, 'source_split': args.source_split, 'method': args.method, 'alpha': args.alpha,
+                'classes_per_client': args.classes_per_client, 'min_size': args.min_size, 'seed': args.seed, 'num_clients': num_clients}
+        path = os.path.join(output_dir, partition_name(args, num_clients))
+        save_partition(path, indices, offsets, meta)
+        print('%d clients in %.2fs -> %s' % (num_clients, time.time() - start, path))
+        describe(indices, offsets, targets)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+# coding=utf-8
+from __future__ import absolute_import, division, print_function
+
+import os
+import csv
+import sys
+import time
+import argparse
+import importlib
+import itertools
+import multiprocessing
+
+import numpy as np
+import torch
+from utils.data_utils import make_resident
+
+INDEX_FIELDS = ['run_id', 'script', 'args', 'status', 'exit_code', 'start', 'seconds', 'output_dir', 'avg_val_acc', 'avg_test_acc']
+
+
+def parse_grid(grid):
+    """ ["seed=42,43", "mu=0.01,0.1"] -> [[("seed", "42"), ("mu", "0.01")], ...], one list per combination """
+    axes = []
+    for entry in grid:
+        name, _, values = entry.partition('=')
+        axes.append([(name, value) for value in values.split(',')])
+    return [list(combination) for combination in itertools.product(*axes)]
+
+
+def run_id(script, overrides):
+    stem = os.path.splitext(os.path.basename(script))[0]
+    return '_'.join([stem] + ['%s_%s' % (name, value) for name, value in overrides])
+
+
+def data_args(script_args):
+    """ Dataset options of a run, the ones that decide what is made resident """
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("--dataset", default="cifar10")
+    parser.add_argument("--data_path", default='./data/')
+    parser.add_argument("--split_type", default="split_3")
+    parser.add_argument("--img_size", default=224, type=int)
+    return parser.parse_known_args(script_args)[0]
+
+
+def read_index(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return {row['run_id']: row for row in csv.DictReader(f)}
+
+
+def write_index(path, index):
+    with open(path + '.tmp', 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=INDEX_FIELDS)
+        writer.writeheader()
+        for row in index.values():
+            writer.writerow(row)
+    os.replace(path + '.tmp', path)
+
+
+def last_round_mean(path):
+    """ Mean over the clients of the last round of val_acc.csv / test_acc.csv """
+    if not os.path.exists(path):
+        return ''
+    import pandas as pd
+    records = pd.read_csv(path, index_col=0)
+    if records.empty:
+        return ''
+    return float(np.nanmean(pd.to_numeric(records.iloc[-1], errors='coerce')))
+
+
+def run_child(script, script_args, log_path, threads):
+    """ Body of a forked run: the dataset pages and the imported modules are the ones of the executor """
+    log = open(log_path, 'w', buffering=1)
+    os.dup2(log.fileno(), 1)
+    os.dup2(log.fileno(), 2)
+    sys.stdout = sys.stderr = log
+    torch.set_num_threads(threads)
+    sys.argv = [script] + script_args
+    importlib.import_module(os.path.splitext(os.path.basename(script))[0]).main(script_args)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a sweep of a train script on a pool of worker processes that share the resident dataset. "
+                                                 "Example: python sweep.py --script train_FedProx.py --grid seed=42,43 mu=0.01,0.1 -- --dataset cifar10 ...")
+    parser.add_argument("--script", type=str, default="train_FedAVG.py", help="train_FedAVG.py, train_FedProx.py, train_FedOpt.py or train_SCAFFOLD.py")
+    parser.add_argument("--grid", nargs='+', default=[], help="name=v1,v2,... per swept option (without the dashes), one run per combination")
+    parser.add_argument("--workers", default=2, type=int, help="Runs executed at the same time.")
+    parser.add_argument("--threads", default=0, type=int, help="torch intra-op threads of every run (0: the cpus split between the workers)")
+    parser.add_argument("--sweep_dir", type=str, default="output/sweep", help="Run index (runs.csv), one output directory and log per run.")
+    parser.add_argument('--resident_eval', action='store_true', default=False, help="Also decode the union val / test sets once, the runs only normalize them")
+    parser.add_argument('--rerun', action='store_true', default=False, help="Run again the runs already done in the index")
+    parser.add_argument("script_args", nargs=argparse.REMAINDER, help="Arguments common to every run, after --")
+    args = parser.parse_args()
+
+    script_args = args.script_args[1:] if args.script_args[:1] == ['--'] else args.script_args
+    if '--model_cache_dir' not in script_args:
+        # the initialized models are built once per architecture, the other runs load the snapshot
+        script_args = script_args + ['--model_cache_dir', os.path.join(args.sweep_dir, 'model_cache')]
+    os.makedirs(args.sweep_dir, exist_ok=True)
+    index_path = os.path.join(args.sweep_dir, 'runs.csv')
+    index = read_index(index_path)
+    threads = args.threads or max(1, (os.cpu_count() or 1) // args.workers)
+
+    queue = []
+    for overrides in parse_grid(args.grid):
+        identifier = run_id(args.script, overrides)
+        if index.get(identifier, {}).get('status') == 'done' and not args.rerun:
+            continue
+        output_dir = os.path.join(args.sweep_dir, identifier)
+        # the last occurrence of an option wins with argparse: the swept values and the output directory override the common ones
+        run_args = script_args + [token for name, value in overrides for token in ('--' + name, value)] + ['--output_dir', output_dir]
+        index[identifier] = {'run_id': identifier, 'script': args.script, 'args': ' '.join(run_args), 'status': 'queued', 'exit_code': '',
+                             'start': '', 'seconds': '', 'output_dir': output_dir, 'avg_val_acc': '', 'avg_test_acc': ''}
+        queue.append((identifier, run_args))
+    write_index(index_path, index)
+
+    # loaded (and imported) once here, inherited by every forked run
+    for dataset in {tuple(sorted(vars(data_args(run_args)).items())) for _, run_args in queue}:
+        make_resident(argparse.Namespace(**dict(dataset)), ('val', 'test') if args.resident_eval else ())
+    importlib.import_module(os.path.splitext(os.path.basename(args.script))[0])
+    # the scripts import torch and the training modules after parsing their arguments, preloaded for the forks here
+    for module in ('utils.start_config', 'utils.util'):
+        importlib.import_module(module)
+    print('============ Sweep of %d runs of %s on %d workers, %d threads each ============' % (len(queue), args.script, args.workers, threads))
+
+    context = multiprocessing.get_context('fork')
+    running = {}
+    while queue or running:
+        while queue and len(running) < args.workers:
+            identifier, run_args = queue.pop(0)
+            os.makedirs(index[identifier]['output_dir'], exist_ok=True)
+            log_path = os.path.join(index[identifier]['output_dir'], 'sweep.log')
+            # one process per run: a crash, a leak or a global set by a run never reaches the others
+            process = context.Process(target=run_child, args=(args.script, run_args, log_path, threads))
+            process.start()
+            running[identifier] = (process, time.time())
+            index[identifier].update(status='running', start=time.strftime('%Y-%m-%d %H:%M:%S'))
+            write_index(index_path, index)
+            print('Started %s (log %s)' % (identifier, log_path))
+
+        for identifier, (process, start) in list(running.items()):
+            if process.is_alive():
+                continue
+            process.join()
+            del running[identifier]
+            output_dir = index[identifier]['output_dir']
+            index[identifier].update(status='done' if process.exitcode == 0 else 'failed', exit_code=process.exitcode,
+                                     seconds='%.1f' % (time.time() - start),
+                                     avg_val_acc=last_round_mean(os.path.join(output_dir, 'val_acc.csv')),
+                                     avg_test_acc=last_round_mean(os.path.join(output_dir, 'test_acc.csv')))
+            write_index(index_path, index)
+            print('Finished %s: %s in %ss' % (identifier, index[identifier]['status'], index[identifier]['seconds']))
+        time.sleep(0.5)
+
+    failed = [identifier for identifier, row in index.items() if row['status'] == 'failed']
+    print('============ Sweep done, index in %s, %d failed runs ============' % (index_path, len(failed)))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
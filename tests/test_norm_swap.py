@@ -0,0 +1,107 @@
+import pytest
+import timm
+import torch
+import torch.nn as nn
+from timm.layers.norm_act import BatchNormAct2d
+
+import utils.architectures_modifications as modifications
+from utils.architectures_modifications import (GROUP_NORM_LOOKUP, GroupNormAct2d, convert_to_group_norm, group_norm_act,
+                                               functional_act, num_groups_for)
+
+# (timm model, normalization layers replaced by the conversion of the repo)
+MODELS = [
+    ('resnet18', (nn.BatchNorm2d,)),
+    ('coatnet_bn_0_rw_224', (BatchNormAct2d, nn.BatchNorm2d)),
+    ('poolformer_s12', (nn.GroupNorm,)),
+]
+
+
+def norm_layers(model, norm_types):
+    return {name: module for name, module in model.named_modules() if isinstance(module, norm_types)}
+
+
+@pytest.mark.parametrize('model_name, norm_types', MODELS)
+def test_every_norm_layer_is_replaced(model_name, norm_types):
+    model = timm.create_model(model_name, pretrained=False)
+    with torch.no_grad():
+        # non default affine parameters, a copy can not pass by chance
+        for module in norm_layers(model, norm_types).values():
+            module.weight.uniform_(0.5, 1.5)
+            module.bias.uniform_(-0.5, 0.5)
+    before = {name: (type(module), module.weight.clone(), module.bias.clone(), getattr(module, 'act', None), getattr(module, 'drop', None))
+              for name, module in norm_layers(model, norm_types).items()}
+    assert before
+
+    replaced = convert_to_group_norm(model, norm_types=norm_types)
+
+    assert replaced == len(before)
+    after = dict(model.named_modules())
+    for name, (old_type, weight, bias, act, drop) in before.items():
+        new = after[name]
+        assert isinstance(new, nn.GroupNorm), name
+        assert new.num_channels == weight.numel()
+        assert new.num_groups == num_groups_for(new.num_channels)
+        assert torch.equal(new.weight, weight) and torch.equal(new.bias, bias), name
+        if act is not None:
+            assert isinstance(new, GroupNormAct2d), name
+            assert new.act is act and new.drop is drop, name
+        else:
+            assert type(new) is nn.GroupNorm, name
+    # none of the original layer types is left besides the new group norms
+    assert all(type(module) in (nn.GroupNorm, GroupNormAct2d) for module in norm_layers(model, norm_types).values())
+
+
+def test_num_groups_for_table_and_other_channel_counts():
+    for num_channels, num_groups in GROUP_NORM_LOOKUP.items():
+        assert num_groups_for(num_channels) == num_groups
+
+    for num_channels in (8, 24, 40, 48, 72, 100, 1000, 1280):
+        num_groups = num_groups_for(num_channels)
+        assert num_channels % num_groups == 0
+        assert 1 <= num_groups <= 32
+        assert num_groups == 1 or num_channels // num_groups >= 8
+    # fewer than 8 channels: a single group
+    assert num_groups_for(6) == 1
+
+
+@pytest.mark.parametrize('act_layer', [nn.SiLU, nn.GELU, nn.ReLU, nn.Identity])
+def test_fused_matches_eager_forward_and_backward(monkeypatch, act_layer):
+    monkeypatch.setattr(modifications, '_compiled_group_norm_act', None)
+    torch.manual_seed(0)
+    fused = GroupNormAct2d(4, 32, act_layer=act_layer, fused=True)
+    with torch.no_grad():
+        fused.weight.uniform_(0.5, 1.5)
+        fused.bias.uniform_(-0.5, 0.5)
+    eager = GroupNormAct2d(4, 32, act_layer=act_layer, weight=fused.weight, bias=fused.bias, fused=False)
+    assert functional_act(fused.act) is not None
+
+    x = torch.randn(2, 32, 7, 7)
+    x_fused, x_eager = x.clone().requires_grad_(), x.clone().requires_grad_()
+    out_fused, out_eager = fused(x_fused), eager(x_eager)
+    torch.testing.assert_close(out_fused, out_eager, rtol=1e-5, atol=1e-5)
+
+    grad = torch.randn_like(out_eager)
+    out_fused.backward(grad)
+    out_eager.backward(grad)
+    torch.testing.assert_close(x_fused.grad, x_eager.grad, rtol=1e-4, atol=1e-5)
+    torch.testing.assert_close(fused.weight.grad, eager.weight.grad, rtol=1e-4, atol=1e-5)
+    torch.testing.assert_close(fused.bias.grad, eager.bias.grad, rtol=1e-4, atol=1e-5)
+
+
+def test_failed_compilation_falls_back_to_eager(monkeypatch):
+    def failing_compile(function, **kwargs):
+        def compiled(*args):
+            raise torch._dynamo.exc.BackendCompilerFailed(failing_compile, RuntimeError('no compiler'))
+        return compiled
+
+    monkeypatch.setattr(modifications, '_compiled_group_norm_act', None)
+    monkeypatch.setattr(torch, 'compile', failing_compile)
+    layer = GroupNormAct2d(8, 64, act_layer=nn.SiLU, fused=True)
+    x = torch.randn(2, 64, 5, 5)
+
+    out = layer(x)
+
+    torch.testing.assert_close(out, group_norm_act(x, 8, layer.weight, layer.bias, layer.eps, nn.functional.silu))
+    assert modifications._compiled_group_norm_act is False
+    # later calls stay on the eager path
+    torch.testing.assert_close(layer(x), out)
@@ -1,41 +1,85 @@
 # coding=utf-8
-from __future__ import absolute_import, division, print_function
+from __future__ import absolute_import, division, print_function, annotations
 
 import os
 import argparse
 import numpy as np
 from copy import deepcopy
-import torch
-from torch.utils.data import DataLoader, RandomSampler, SequentialSampler
-from utils.data_utils import DatasetFLViT, create_dataset_and_evalmetrix
-from utils.util import Partial_Client_Selection, valid, average_model, optimizer_to
-from utils.start_config import initization_configure
+from functools import partial
 from typing import List, Tuple, Union, OrderedDict
-import wandb
-import pandas as pd
 
 def train(args, model):
     """ Train the model """
+    # heavy dependencies are only imported once the arguments are parsed (keeps --help and argument errors fast)
+    import pandas as pd
+    import torch
+    from torch.utils.data import DataLoader, RandomSampler, SequentialSampler
+    from utils.data_utils import create_dataset, create_dataset_and_evalmetrix, loader_kwargs, eval_loader_kwargs
+    from utils.util import Partial_Client_Selection, average_model, shared_frozen_memo
+    from utils.compile_utils import CompiledExecutor
+    from utils.optim_state import pack_optimizer_state, unpack_optimizer_state
+    from utils.feature_cache import FeatureCache
+    from utils.adapters import add_adapters
+    from utils.client_state import ClientStateManager
+    from utils.distributed import rank_share, client_seed, sync_client_metrics, is_main_process, cleanup_distributed
+    from utils.memory_budget import plan_micro_batches, forward_backward
+    from utils.dp import check_dp_support, dp_backward, PrivacyAccountant
+    from utils.topology import build_topology
+    from utils.async_eval import AsyncEvaluator
+    from utils.eval_policy import build_eval_policy, evaluate_client
+    from utils.checkpoint_store import checkpoint_store
+    from utils.param_groups import build_param_policy
 
     os.makedirs(args.output_dir, exist_ok=True)
 
     # Prepare dataset
     loaded_npy = create_dataset_and_evalmetrix(args)
 
+    # adapter fine-tuning: the base weights are frozen, only the LoRA adapters and the head are trained and exchanged
+    if args.adapter == 'lora':
+        model = add_adapters(args, model)
+
+    # frozen backbone: the prefix features are computed once and only the tail of the network is trained
+    feature_cache = FeatureCache(args, model) if args.freeze_backbone else None
+    if feature_cache is not None:
+        model = feature_cache.tail
+
     print('Loading testset, phase test')
-    testset = DatasetFLViT(args, loaded_npy, phase = 'test')
-    test_loader = DataLoader(testset, sampler=SequentialSampler(testset), batch_size=args.batch_size, num_workers=args.num_workers)
+    testset = create_dataset(args, loaded_npy, 'test', feature_cache)
+    test_loader = DataLoader(testset, sampler=SequentialSampler(testset), batch_size=args.batch_size, **eval_loader_kwargs(args))
 
 
     # if not celeba then get the union val dataset,
     if args.dataset not in ['celeba', 'gldk23', 'isic19']:
         print('Loading valset, phase val')
-        valset = DatasetFLViT(args, loaded_npy, phase = 'val')
-        val_loader = DataLoader(valset, sampler=SequentialSampler(valset), batch_size=args.batch_size, num_workers=args.num_workers)
+        valset = create_dataset(args, loaded_npy, 'val', feature_cache)
+        val_loader = DataLoader(valset, sampler=SequentialSampler(valset), batch_size=args.batch_size, **eval_loader_kwargs(args))
+
+    # global / local / frozen parameter groups, only the global group is exchanged and averaged
+    args.param_policy = build_param_policy(args, model)
+
+    # memory budget: activation checkpointing and gradient accumulation over micro-batches of each local batch
+    plan_micro_batches(args, model, testset[0][0])
+
+    # DP-SGD: vectorized per-sample clipping and a per client privacy budget
+    if args.dp:
+        check_dp_support(args, model)
+    accountant = PrivacyAccountant(args) if args.dp else None
 
     # Configuration for FedAVG, prepare model, optimizer, scheduler
     model_all, optimizer_all, scheduler_all = Partial_Client_Selection(args, model)
-    model_avg = deepcopy(model).cpu()
+    executor = CompiledExecutor(args, model) if args.compile else None
+    # lazy per-client state (optimizer, scheduler, local parameters) for federations with many clients
+    client_states = ClientStateManager(args, model, optimizer_all, scheduler_all) if args.client_state == 'lazy' else None
+    # flat server or aggregation tree (edge aggregators averaging more often than the root)
+    topology = build_topology(args)
+    # subsampled val every round, full val / test passes only when a new best is plausible (shared with the evaluation thread)
+    eval_policy = build_eval_policy(args)
+    # deduplicated best client checkpoints (--checkpoint_store), created before the evaluation thread copies args
+    store = checkpoint_store(args) if args.save_model_flag else None
+    # evaluation of round r overlapped with the training of round r + 1
+    evaluator = AsyncEvaluator(args, model) if args.async_eval else None
+    model_avg = deepcopy(model, shared_frozen_memo(model)).cpu()
 
     # Train
     print("=============== Running training ===============")
@@ -44,10 +88,40 @@ def train(args, model):
     epoch = -1
 
 
+    def record_round(epoch, round_pairs, metrics):
+        """ Metrics of the evaluated round: records, csv files and wandb (metrics: extra wandb entries) """
+        sync_client_metrics(args, round_pairs)
+
+        args.record_val_acc = pd.concat([args.record_val_acc, pd.DataFrame([args.current_acc])], ignore_index=True)
+        args.record_test_acc  = pd.concat([args.record_test_acc, pd.DataFrame([args.current_test_acc])], ignore_index=True)
+
+        if is_main_process(args):
+            args.record_val_acc.to_csv(os.path.join(args.output_dir, 'val_acc.csv'))
+            args.record_test_acc.to_csv(os.path.join(args.output_dir, 'test_acc.csv'))
+            np.save(args.output_dir + '/learning_rate.npy', args.learning_rate_record)
+
+        # save test acc
+        tmp_round_acc = [val for val in args.current_test_acc.values() if type(val) != list]
+        scalar_test_acc = np.asarray(tmp_round_acc).mean()
+        # save al acc 
+        tmp_round_val_acc =  [val for val in args.current_acc.values() if type(val) != list]
+        scalar_val_acc = np.asarray(tmp_round_val_acc).mean()
+        
+        print("Epoch {}: Avg test acc {}, Avg Val acc {}".format(epoch, scalar_test_acc, scalar_val_acc))
+
+
+        # log on wandb 
+        if args.use_wandb and is_main_process(args):
+            import wandb
+            metrics.update({"train/avg_test_acc": scalar_test_acc, 'train/avg_val_acc': scalar_val_acc})
+            wandb.log(metrics, step=epoch)
+
     while True:
         epoch += 1
         # randomly select partial clients
-        if args.num_local_clients == len(args.dis_cvs_files):
+        if client_states is not None:
+            cur_selected_clients = client_states.select_clients()
+        elif args.num_local_clients == len(args.dis_cvs_files):
             # just use all the local clients
             cur_selected_clients = args.proxy_clients
         else:
@@ -58,20 +132,24 @@ def train(args, model):
         for client in cur_selected_clients:
             cur_tot_client_Lens += args.clients_with_len[client]
 
+        # (client, proxy) pairs trained by this process: all of them, or this rank's share in distributed runs
+        round_pairs = rank_share(args, cur_selected_clients)
+        args.local_proxies = [proxy for client, proxy in round_pairs]
+
         val_loader_proxy_clients = {}
 
-        for cur_single_client, proxy_single_client in zip(cur_selected_clients, args.proxy_clients):
+        for cur_single_client, proxy_single_client in round_pairs:
             args.single_client = cur_single_client
             args.clients_weightes[proxy_single_client] = args.clients_with_len[cur_single_client] / cur_tot_client_Lens
 
             print('Loading trainset, phase train')
-            trainset = DatasetFLViT(args, loaded_npy, phase='train')
-            train_loader = DataLoader(trainset, sampler=RandomSampler(trainset), batch_size=args.batch_size, num_workers=args.num_workers)
+            trainset = create_dataset(args, loaded_npy, 'train', feature_cache)
+            train_loader = DataLoader(trainset, sampler=RandomSampler(trainset), batch_size=args.batch_size, **loader_kwargs(args))
 
             if args.dataset == 'celeba' or  args.dataset == 'gldk23' or args.dataset == 'isic19':
-                valset = DatasetFLViT(args, loaded_npy, phase='val')
+                valset = create_dataset(args, loaded_npy, 'val', feature_cache)
                 val_loader_proxy_clients[proxy_single_client] = DataLoader(valset, sampler=SequentialSampler(valset), batch_size=args.batch_size,
-                                          num_workers=args.num_workers)
+                                          **eval_loader_kwargs(args))
             else:
                 # for Cifar10 datasets we use union validation dataset
                 val_loader_proxy_clients[proxy_single_client] = val_loader
@@ -79,15 +157,22 @@ def train(args, model):
             model = model_all[proxy_single_client]
             optimizer = optimizer_all[proxy_single_client]
             scheduler = scheduler_all[proxy_single_client]
+            if client_states is not None:
+                client_states.load(cur_single_client, proxy_single_client, model, optimizer, scheduler)
 
-            model = model.to(args.device).train()
+            topology.load_edge_model(cur_single_client, proxy_single_client, model)
+            unpack_optimizer_state(optimizer, args.device)
+            if args.compile:
+                model = executor.bind(model, optimizer).train()
+            else:
+                model = model.to(args.device).train()
             model_avg = model_avg.to(args.device)
-            optimizer_to(optimizer, args.device)
 
             if args.decay_type == 'step':
                 scheduler.step()
 
             print('Train the client', cur_single_client, 'of communication round', epoch)
+            client_seed(args, epoch, cur_single_client)
 
 
             for inner_epoch in range(args.local_epochs):
@@ -96,21 +181,26 @@ def train(args, model):
                     batch = tuple(t.to(args.device) for t in batch)
 
                     x, y = batch
-                    predict = model(x)
 
                     # === Proximal Term === #
-                    proximal_term = 0.0
+                    def proximal_loss():
+                        proximal_term = 0.0
 
-                    for w, w_t in zip(model.parameters(), model_avg.parameters()):
-                        proximal_term += (w - w_t).norm(2)
+                        for w, w_t in zip(model.parameters(), model_avg.parameters()):
+                            if w.requires_grad:
+                                proximal_term += (w - w_t).norm(2)
 
-                    loss = loss_fct(predict.view(-1, args.num_classes), y.view(-1)) + (args.mu / 2) * proximal_term
+                        return (args.mu / 2) * proximal_term
 
                     # === =============== === #
-                    
-                    loss.backward()
 
-                    if args.grad_clip:
+                    if args.dp:
+                        loss = dp_backward(args, model, loss_fct, x, y, proximal_loss)
+                    else:
+                        loss = forward_backward(args, model, loss_fct, x, y, proximal_loss)
+
+                    # with --dp the per-sample clipping bounds the update already
+                    if args.grad_clip and not args.dp:
                         torch.nn.utils.clip_grad_norm_(model.parameters(), args.max_grad_norm)
 
                     optimizer.step()
@@ -125,56 +215,65 @@ def train(args, model):
                               args.max_communication_rounds, 'loss', loss.item(), 'lr', optimizer.param_groups[0]['lr'])
 
 
-            # we use frequent transfer of model between GPU and CPU due to limitation of GPU memory
-            model.to('cpu')
-            optimizer_to(optimizer, 'cpu')
-
-        average_model(args, model_avg, model_all) # updates client model param
-
-        # then evaluate
-        for cur_single_client, proxy_single_client in zip(cur_selected_clients, args.proxy_clients):
-            args.single_client = cur_single_client
-            model = model_all[proxy_single_client]
-            model.to(args.device)
-            valid(args, model, val_loader_proxy_clients[proxy_single_client], test_loader, TestFlag=True)
-            model.cpu()
-
-        args.record_val_acc = pd.concat([args.record_val_acc, pd.DataFrame([args.current_acc])], ignore_index=True)
-        args.record_val_acc.to_csv(os.path.join(args.output_dir, 'val_acc.csv'))
+            if accountant is not None:
+                accountant.record(cur_single_client, min(1., args.batch_size / len(trainset)), args.local_epochs * len(train_loader))
 
+            if args.compile:
+                model = executor.unbind(model_all[proxy_single_client], optimizer)
 
-        args.record_test_acc  = pd.concat([args.record_test_acc, pd.DataFrame([args.current_test_acc])], ignore_index=True)
-        args.record_test_acc.to_csv(os.path.join(args.output_dir, 'test_acc.csv'))
-
-        np.save(args.output_dir + '/learning_rate.npy', args.learning_rate_record)
-
-        # save test acc
-        tmp_round_acc = [val for val in args.current_test_acc.values() if type(val) != list]
-        scalar_test_acc = np.asarray(tmp_round_acc).mean()
-        # save al acc 
-        tmp_round_val_acc =  [val for val in args.current_acc.values() if type(val) != list]
-        scalar_val_acc = np.asarray(tmp_round_val_acc).mean()
-        
-        print("Epoch {}: Avg test acc {}, Avg Val acc {}".format(epoch, scalar_test_acc, scalar_val_acc))
-
+            # we use frequent transfer of model between GPU and CPU due to limitation of GPU memory
+            model.to('cpu')
+            pack_optimizer_state(optimizer, args.optimizer_state_precision)
+            if client_states is not None:
+                client_states.store(cur_single_client, model, optimizer, scheduler)
 
-        # log on wandb 
-        if args.use_wandb: 
-            metrics = {"train/avg_test_acc": scalar_test_acc, 'train/avg_val_acc': scalar_val_acc}
-            wandb.log(metrics, step=epoch)
+        if topology.is_root_round(epoch):
+            average_model(args, model_avg, model_all) # updates client model param
+            topology.reset()
+        else:
+            topology.aggregate(epoch, round_pairs, model_all)
 
-        if args.global_step_per_client[proxy_single_client] >= args.t_total[proxy_single_client]:
+        # then evaluate, in the background with --async_eval (the records are still written in round order)
+        round_metrics = {'train/dp_epsilon': accountant.max_epsilon()} if accountant is not None else {}
+        if evaluator is not None:
+            evaluator.submit(epoch, round_pairs, model_all, val_loader_proxy_clients, test_loader, partial(record_round, epoch, round_pairs, round_metrics))
+        else:
+            for cur_single_client, proxy_single_client in round_pairs:
+                args.single_client = cur_single_client
+                model = model_all[proxy_single_client]
+                if args.compile:
+                    evaluate_client(args, executor.bind(model), val_loader_proxy_clients[proxy_single_client], test_loader, epoch)
+                else:
+                    model.to(args.device)
+                    evaluate_client(args, model, val_loader_proxy_clients[proxy_single_client], test_loader, epoch)
+                    model.cpu()
+            record_round(epoch, round_pairs, round_metrics)
+        if accountant is not None:
+            accountant.report(epoch)
+
+        # same proxy on every rank (the last one of the round)
+        if args.global_step_per_client[args.proxy_clients[-1]] >= args.t_total[args.proxy_clients[-1]]:
             break
 
 
 
+    if evaluator is not None:
+        evaluator.close()
+    if eval_policy is not None:
+        eval_policy.report()
+    if store is not None:
+        store.close()
     print("================End training! ================ ")
+    if client_states is not None:
+        client_states.close()
 
-    if args.use_wandb:
+    if args.use_wandb and is_main_process(args):
+        import wandb
         wandb.finish()
+    cleanup_distributed(args)
 
 
-def main():
+def main(argv=None):
     parser = argparse.ArgumentParser()
     # General DL parameters
     parser.add_argument("--FL_platform", type = str, default="ViT-FedAVG",  help="Choose of different FL platform. ")
@@ -187,9 +286,34 @@ def main():
 
     parser.add_argument('--pretrained', type=bool, default=True, help="Whether use pretrained or not")
     parser.add_argument("--pretrained_dir", type=str, default="checkpoint/swin_tiny_patch4_window7_224.pth", help="Where to search for pretrained ViT models. [ViT-B_16.npz,  imagenet21k+imagenet2012_R50+ViT-B_16.npz]")
-    parser.add_argument("--output_dir", default="output", type=str, help="The output directory where checkpoints/results/logs will be written.")
+    parser.add_argument("--model_cache_dir", type=str, default=None, help="Local cache of initialized model snapshots (architecture + norm + num_classes). Disabled if not set.")
+    parser.add_argument("--output_dir", default=None, type=str, help="The output directory where checkpoints/results/logs will be written (default: output/<FL_platform>/<dataset>/<run name>).")
     parser.add_argument("--optimizer_type", default="sgd",choices=["sgd", "adamw"], type=str, help="Ways for optimization.")
+    parser.add_argument("--optimizer_state_precision", default="fp32", choices=["fp32", "bf16", "int8"], type=str, help="Storage precision of the optimizer state of idle clients (int8 uses block-wise absmax scaling).")
     parser.add_argument("--num_workers", default=8, type=int, help="num_workers")
+    parser.add_argument("--resource_plan", default="off", choices=["off", "auto", "calibrate"], type=str, help="Pick threads, loader workers and cpu pinning from the cpu topology (auto: saved plan or heuristic, calibrate: time the thread counts and save the plan)")
+    parser.add_argument("--resource_plan_dir", type=str, default="resource_plans", help="Where the calibrated resource plans are saved, one per architecture")
+    parser.add_argument("--prefetch_factor", default=2, type=int, help="Batches loaded in advance by each DataLoader worker")
+    parser.add_argument('--pin_memory', action='store_true', default=False, help="Page-locked DataLoader batches")
+    parser.add_argument('--auto_loader', action='store_true', default=False, help="Use the DataLoader configuration measured by benchmark_dataloader.py (overrides the three options above and --num_workers)")
+    parser.add_argument("--loader_config_dir", type=str, default="loader_configs", help="Where benchmark_dataloader.py saves the DataLoader configurations")
+    parser.add_argument('--freeze_backbone', action='store_true', default=False, help="Freeze the backbone, cache its features once per sample and train only the tail of the network")
+    parser.add_argument("--trainable_blocks", default=0, type=int, help="With --freeze_backbone: number of last blocks trained with the head (0: head only, >0 needs ViT/DeiT/MLP-Mixer like models)")
+    parser.add_argument("--feature_cache_dir", type=str, default="feature_cache", help="Where the memory mapped frozen features are stored")
+    parser.add_argument("--adapter", default="none", choices=["none", "lora"], type=str, help="Adapter fine-tuning: freeze the base weights and train only LoRA adapters and the head (transformer backbones)")
+    parser.add_argument("--lora_rank", default=8, type=int, help="Rank of the LoRA adapters")
+    parser.add_argument("--lora_alpha", default=16, type=float, help="Scaling of the LoRA update (alpha / rank)")
+    parser.add_argument("--lora_dropout", default=0., type=float, help="Dropout on the input of the LoRA adapters")
+    parser.add_argument("--lora_targets", type=str, default="qkv,proj,fc1,fc2", help="Comma separated names of the linear layers (attention / MLP) that get an adapter")
+    parser.add_argument("--local_groups", nargs='*', default=[], choices=["norm", "head"], help="Parameter groups kept local to each client and never averaged (norm: FedBN style normalization layers)")
+    parser.add_argument("--local_params", type=str, default="", help="Regex on the parameter names, matching parameters are kept local to each client")
+    parser.add_argument("--frozen_params", type=str, default="", help="Regex on the parameter names, matching parameters are neither trained nor exchanged")
+    parser.add_argument('--grad_checkpointing', action='store_true', default=False, help="Activation checkpointing on the backbone blocks")
+    parser.add_argument("--memory_budget_mb", default=0, type=int, help="Memory budget of the local training, enables checkpointing and picks the micro-batch size (0: off)")
+    parser.add_argument("--micro_batch_size", default=0, type=int, help="Split each local batch in micro-batches of this size and accumulate the gradients (0: whole batch, or set by --memory_budget_mb)")
+    parser.add_argument('--compile', action='store_true', default=False, help="Compile the model once with torch.compile and share the compiled copy between all the clients")
+    parser.add_argument("--compile_mode", default="default", choices=["default", "reduce-overhead", "max-autotune"], type=str, help="torch.compile mode")
+    parser.add_argument("--compile_cache_dir", type=str, default="compile_cache", help="On-disk cache of the compiled kernels, reused across restarts")
     parser.add_argument("--weight_decay", default=0, choices=[0.05, 0], type=float, help="Weight deay if we apply some. 0 for SGD and 0.05 for AdamW in paper")
     parser.add_argument('--grad_clip', action='store_true', default=True, help="whether gradient clip to 1 or not")
 
@@ -214,11 +338,43 @@ def main():
     ## FL related parameters
     parser.add_argument("--local_epochs", default=1, type=int, help="Local training epoch in FL")
     parser.add_argument("--max_communication_rounds", default=100, type=int,  help="Total communication rounds")
-    parser.add_argument("--num_local_clients", default=-1, choices=[10, 20, -1], type=int, help="Num of local clients joined in each FL train. -1 indicates all clients")
+    parser.add_argument("--num_local_clients", default=-1, type=int, help="Num of local clients joined in each FL train. -1 indicates all clients")
     parser.add_argument("--split_type", type=str, choices=["split_1", "split_2", "split_3", "real", "central"], default="split_3", help="Which data partitions to use")
-
-
-    args = parser.parse_args()
+    parser.add_argument("--partition_file", type=str, default=None, help="Partition generated by make_partitions.py (cifar10, pacs), replaces the clients of --split_type")
+    parser.add_argument("--client_state", default="proxy", choices=["proxy", "lazy"], type=str, help="proxy: optimizer / scheduler state belongs to the proxy slots, lazy: every client keeps its own state, materialized when sampled")
+    parser.add_argument("--client_cache_size", default=64, type=int, help="With --client_state lazy: clients whose state is kept in RAM, the others are spilled to disk")
+    parser.add_argument("--client_state_dir", type=str, default=None, help="With --client_state lazy: where cold client states are spilled (default: <output_dir>/client_states)")
+    parser.add_argument('--per_client_seed', action='store_true', default=False, help="Reseed torch before each local training from (seed, round, client), always on in distributed runs: use it for single process reference runs")
+    parser.add_argument("--topology", default="flat", choices=["flat", "tree"], type=str, help="Aggregation topology: flat single server, or a tree of edge / intermediate aggregators given by --aggregation_levels")
+    parser.add_argument("--aggregation_levels", nargs='+', default=["4:1", "1:2"], help="With --topology tree: groups:period of every level from the edges to the root (one group), the period is in rounds. With gloo ranks the edges are the ranks")
+    parser.add_argument("--aggregation_workers", default=1, type=int, help="Split the aggregation (and the FedOpt server optimizer step) by parameter chunks over this many worker threads (single process runs)")
+    parser.add_argument("--robust_aggregation", default="none", choices=["none", "median", "trimmed_mean", "krum"], type=str, help="Robust aggregation rule over the flattened client updates (single process runs), none: weighted mean")
+    parser.add_argument("--trim_ratio", default=0.1, type=float, help="With trimmed_mean: share of the clients dropped at each end of every coordinate")
+    parser.add_argument("--krum_byzantine", default=1, type=int, help="With krum: number of byzantine clients tolerated")
+    parser.add_argument("--krum_selected", default=1, type=int, help="With krum: clients kept and averaged (1: Krum, more: Multi-Krum)")
+    parser.add_argument("--robust_chunk_mb", default=64, type=int, help="Working memory of the robust rules, a chunk of the flattened updates of every client")
+    parser.add_argument('--robust_memmap', action='store_true', default=False, help="FedOpt / SCAFFOLD with a robust rule: spill the client updates of the round to a memory-mapped file")
+    parser.add_argument("--robust_memmap_dir", type=str, default=None, help="Where the spilled client updates are written (default: <output_dir>/robust_updates)")
+    parser.add_argument('--secure_aggregation', action='store_true', default=False, help="Simulate secure aggregation: the server only sums pairwise masked fixed point client updates (single process runs)")
+    parser.add_argument("--secagg_neighbors", default=0, type=int, help="With --secure_aggregation: masks shared with this many clients (random k-regular graph, an odd k needs an even number of clients per round), 0: every other client")
+    parser.add_argument("--secagg_dropout", default=0., type=float, help="With --secure_aggregation: probability that a client drops after the key agreement, its masks are recovered from the survivors")
+    parser.add_argument("--secagg_precision_bits", default=24, type=int, help="With --secure_aggregation: fractional bits of the fixed point encoding over Z_2^64")
+    parser.add_argument("--secagg_chunk_mb", default=64, type=int, help="With --secure_aggregation: working memory, the updates are masked and summed chunk by chunk")
+    parser.add_argument('--async_eval', action='store_true', default=False, help="Evaluate round r in a background thread on a snapshot of the weights while round r + 1 trains (single process runs)")
+    parser.add_argument("--eval_max_pending", default=1, type=int, help="With --async_eval: rounds whose evaluation can be queued before the training waits")
+    parser.add_argument("--eval_subsample", default=1.0, type=float, help="Fraction of the val set (stratified) scored every round, 1: full evaluation every round")
+    parser.add_argument("--eval_confidence", default=0.99, type=float, help="With --eval_subsample: confidence of the interval that decides the full evaluation")
+    parser.add_argument("--full_eval_every", default=10, type=int, help="With --eval_subsample: rounds between two forced full evaluations")
+    parser.add_argument("--checkpoint_store", action='store_true', default=False, help="With --save_model_flag: content addressed checkpoints, identical tensors stored once and superseded versions kept as compressed deltas")
+    parser.add_argument("--checkpoint_compression_level", default=6, type=int, help="zlib level of the deltas of --checkpoint_store")
+    parser.add_argument('--dp', action='store_true', default=False, help="DP-SGD local training: per-sample gradients (torch.func) clipped and noised, privacy budget tracked per client")
+    parser.add_argument("--dp_clip", default=1.0, type=float, help="With --dp: L2 bound of every per-sample gradient")
+    parser.add_argument("--dp_noise_multiplier", default=1.0, type=float, help="With --dp: std of the Gaussian noise relative to --dp_clip")
+    parser.add_argument("--dp_delta", default=1e-5, type=float, help="With --dp: delta of the reported (epsilon, delta) budget")
+
+
+    args = parser.parse_args(argv)
+    from utils.start_config import initization_configure
 
     # Initialization
 
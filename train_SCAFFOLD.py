@@ -1,29 +1,74 @@
 # coding=utf-8
-from __future__ import absolute_import, division, print_function
+from __future__ import absolute_import, division, print_function, annotations
 
 import os
+import time
 import argparse
 import numpy as np
 from copy import deepcopy
-import torch
-from torch.utils.data import DataLoader, RandomSampler, SequentialSampler
-from utils.data_utils import DatasetFLViT, create_dataset_and_evalmetrix
-from utils.util import Partial_Client_Selection, valid, trainable_params
-from utils.start_config import initization_configure
-from typing import Dict, List, OrderedDict
-import wandb
-import pandas as pd
+from functools import partial
+from typing import List, OrderedDict
 
 def average_model(args, model_all, global_params_dict, client_num_in_total, c_global, y_delta_cache: List[List[torch.Tensor]], c_delta_cache: List[List[torch.Tensor]]):
-    
-    for param, y_delta in zip(trainable_params(global_params_dict), zip(*y_delta_cache)):
-        x_delta = torch.stack(y_delta, dim=-1).mean(dim=-1)
-        param.data += args.global_lr * x_delta
-
-    print("Pre c_global", c_global)
-    for c_global, c_delta in zip(c_global, zip(*c_delta_cache)):
-        c_delta = torch.stack(c_delta, dim=-1).sum(dim=-1)
-        c_global.data += (1 / client_num_in_total) * c_delta.data
+    import torch
+    from utils.distributed import all_reduce_weighted_sum
+    from utils.sharded_aggregation import sharded_aggregator
+    from utils.robust_aggregation import robust_aggregate
+    from utils.secure_aggregation import secure_aggregator
+    from utils.param_groups import aggregation_report
+    start_time = time.time()
+
+    if args.robust_aggregation != 'none':
+        # robust rule on the model deltas (chunk by chunk over the flattened deltas), the control variates stay averaged
+        robust_aggregate(args, y_delta_cache, [args.clients_weightes[proxy] for proxy in args.local_proxies], list(global_params_dict.values()),
+                         scale=args.global_lr, accumulate=True)
+
+        print("Pre c_global", c_global)
+        for c_global, c_delta in zip(c_global, zip(*c_delta_cache)):
+            c_delta = torch.stack(c_delta, dim=-1).sum(dim=-1)
+            c_global.data += (1 / client_num_in_total) * c_delta.data
+
+    elif getattr(args, 'world_size', 1) > 1:
+        # sums over the clients of every rank, one all_reduce each for the model and the control variate deltas
+        x_deltas = all_reduce_weighted_sum(args, y_delta_cache, [1. / client_num_in_total] * len(y_delta_cache), list(global_params_dict.values()))
+        for param, x_delta in zip(global_params_dict.values(), x_deltas):
+            param.data += args.global_lr * x_delta
+
+        print("Pre c_global", c_global)
+        c_deltas = all_reduce_weighted_sum(args, c_delta_cache, [1. / client_num_in_total] * len(c_delta_cache), c_global)
+        for c, c_delta in zip(c_global, c_deltas):
+            c.data += c_delta
+
+    elif secure_aggregator(args) is not None:
+        # the server only gets the sums of the pairwise masked deltas, as means over the clients that did not drop
+        # (the same clients for both sums: one mask graph and one dropout draw per round)
+        round_state = secure_aggregator(args).begin_round(len(y_delta_cache))
+        x_deltas = secure_aggregator(args).weighted_sum(y_delta_cache, [1.] * len(y_delta_cache), list(global_params_dict.values()), round_state)
+        for param, x_delta in zip(global_params_dict.values(), x_deltas):
+            param.data += args.global_lr * x_delta
+
+        print("Pre c_global", c_global)
+        c_deltas = secure_aggregator(args).weighted_sum(c_delta_cache, [1.] * len(c_delta_cache), c_global, round_state)
+        for c, c_delta in zip(c_global, c_deltas):
+            c.data += (len(c_delta_cache) / client_num_in_total) * c_delta
+
+    elif sharded_aggregator(args) is not None:
+        # same updates, reduced in place chunk by chunk on the aggregator workers
+        sharded_aggregator(args).weighted_sum(y_delta_cache, [args.global_lr / len(y_delta_cache)] * len(y_delta_cache),
+                                              list(global_params_dict.values()), accumulate=True)
+
+        print("Pre c_global", c_global)
+        sharded_aggregator(args).weighted_sum(c_delta_cache, [1. / client_num_in_total] * len(c_delta_cache), c_global, accumulate=True)
+
+    else:
+        for param, y_delta in zip(global_params_dict.values(), zip(*y_delta_cache)):
+            x_delta = torch.stack(y_delta, dim=-1).mean(dim=-1)
+            param.data += args.global_lr * x_delta
+
+        print("Pre c_global", c_global)
+        for c_global, c_delta in zip(c_global, zip(*c_delta_cache)):
+            c_delta = torch.stack(c_delta, dim=-1).sum(dim=-1)
+            c_global.data += (1 / client_num_in_total) * c_delta.data
 
     print('Update each client model parameters----')
 
@@ -32,48 +77,128 @@ def average_model(args, model_all, global_params_dict, client_num_in_total, c_gl
         for name, param in global_params_dict.items():
             tmp_params[name].data.copy_(param.data)
 
+    aggregation_report(args, start_time, len(args.proxy_clients))
+
 
 def train(args, model):
     """ Train the model """
+    # heavy dependencies are only imported once the arguments are parsed (keeps --help and argument errors fast)
+    import pandas as pd
+    import torch
+    from torch.utils.data import DataLoader, RandomSampler, SequentialSampler
+    from utils.data_utils import create_dataset, create_dataset_and_evalmetrix, loader_kwargs, eval_loader_kwargs
+    from utils.util import Partial_Client_Selection
+    from utils.compile_utils import CompiledExecutor
+    from utils.optim_state import pack_optimizer_state, unpack_optimizer_state
+    from utils.feature_cache import FeatureCache
+    from utils.adapters import add_adapters
+    from utils.client_state import ClientStateManager
+    from utils.distributed import rank_share, client_seed, sync_client_metrics, is_main_process, cleanup_distributed
+    from utils.memory_budget import plan_micro_batches, forward_backward
+    from utils.topology import build_topology
+    from utils.async_eval import AsyncEvaluator
+    from utils.eval_policy import build_eval_policy, evaluate_client
+    from utils.checkpoint_store import checkpoint_store
+    from utils.robust_aggregation import SpilledUpdates
+    from utils.param_groups import build_param_policy, global_params
 
     os.makedirs(args.output_dir, exist_ok=True)
 
     # Prepare dataset
     loaded_npy = create_dataset_and_evalmetrix(args)
 
-    testset = DatasetFLViT(args, loaded_npy, phase = 'test')
-    test_loader = DataLoader(testset, sampler=SequentialSampler(testset), batch_size=args.batch_size, num_workers=args.num_workers)
+    # adapter fine-tuning: the base weights are frozen, only the LoRA adapters and the head are trained and exchanged
+    if args.adapter == 'lora':
+        model = add_adapters(args, model)
+
+    # frozen backbone: the prefix features are computed once and only the tail of the network is trained
+    feature_cache = FeatureCache(args, model) if args.freeze_backbone else None
+    if feature_cache is not None:
+        model = feature_cache.tail
+
+    testset = create_dataset(args, loaded_npy, 'test', feature_cache)
+    test_loader = DataLoader(testset, sampler=SequentialSampler(testset), batch_size=args.batch_size, **eval_loader_kwargs(args))
 
     # if not celeba then get the union val dataset,
     if args.dataset not in ['celeba', 'gldk23', 'isic19']:
-        valset = DatasetFLViT(args, loaded_npy, phase = 'val')
-        val_loader = DataLoader(valset, sampler=SequentialSampler(valset), batch_size=args.batch_size, num_workers=args.num_workers)
+        valset = create_dataset(args, loaded_npy, 'val', feature_cache)
+        val_loader = DataLoader(valset, sampler=SequentialSampler(valset), batch_size=args.batch_size, **eval_loader_kwargs(args))
+
+    # global / local / frozen parameter groups, only the global group is exchanged and averaged
+    args.param_policy = build_param_policy(args, model)
+
+    # memory budget: activation checkpointing and gradient accumulation over micro-batches of each local batch
+    plan_micro_batches(args, model, testset[0][0])
 
     # Configuration for FedAVG, prepare model, optimizer, scheduler
     model_all, optimizer_all, scheduler_all = Partial_Client_Selection(args, model)
+    executor = CompiledExecutor(args, model) if args.compile else None
+    # lazy per-client state (optimizer, scheduler, local parameters) for federations with many clients
+    client_states = ClientStateManager(args, model, optimizer_all, scheduler_all) if args.client_state == 'lazy' else None
+    # flat server or aggregation tree (edge aggregators averaging more often than the root)
+    topology = build_topology(args)
+    # subsampled val every round, full val / test passes only when a new best is plausible (shared with the evaluation thread)
+    eval_policy = build_eval_policy(args)
+    # deduplicated best client checkpoints (--checkpoint_store), created before the evaluation thread copies args
+    store = checkpoint_store(args) if args.save_model_flag else None
+    # evaluation of round r overlapped with the training of round r + 1
+    evaluator = AsyncEvaluator(args, model) if args.async_eval else None
 
 
     #### Add server model ####
-    trainable_params_name, init_trainable_params = trainable_params(model.to('cpu'), requires_name=True)
+    trainable_params_name, init_trainable_params = global_params(args, model.to('cpu'), requires_name=True)
     global_params_dict: OrderedDict[str, torch.nn.Parameter] = OrderedDict(zip(trainable_params_name, deepcopy(init_trainable_params)))
 
     # c global 
-    c_global = [torch.zeros_like(param, device='cpu') for param in trainable_params(model)]
+    c_global = [torch.zeros_like(param, device='cpu') for param in global_params(args, model)]
     # c local 
     c_local = {}
     for proxy_single_client in args.proxy_clients:
         c_local[proxy_single_client] = [torch.zeros_like(c, device='cpu') for c in c_global] # c_local: Dict[List[torch.Tensor]]
 
+    # robust rules on large models: the model deltas of the round go to a memory-mapped file instead of RAM
+    spilled_deltas = SpilledUpdates(args, list(global_params_dict.values()), 'y_deltas') if args.robust_memmap and args.robust_aggregation != 'none' else None
+
     print("=============== Running training ===============")
     loss_fct = torch.nn.CrossEntropyLoss()
     tot_clients = args.dis_cvs_files
     epoch = -1
 
 
+    def record_round(epoch, round_pairs, metrics):
+        """ Metrics of the evaluated round: records, csv files and wandb (metrics: extra wandb entries) """
+        sync_client_metrics(args, round_pairs)
+
+        args.record_val_acc = pd.concat([args.record_val_acc, pd.DataFrame([args.current_acc])], ignore_index=True)
+        args.record_test_acc  = pd.concat([args.record_test_acc, pd.DataFrame([args.current_test_acc])], ignore_index=True)
+
+        if is_main_process(args):
+            args.record_val_acc.to_csv(os.path.join(args.output_dir, 'val_acc.csv'))
+            args.record_test_acc.to_csv(os.path.join(args.output_dir, 'test_acc.csv'))
+            np.save(args.output_dir + '/learning_rate.npy', args.learning_rate_record)
+
+        # save test acc
+        tmp_round_acc = [val for val in args.current_test_acc.values() if type(val) != list]
+        scalar_test_acc = np.asarray(tmp_round_acc).mean()
+        # save al acc 
+        tmp_round_val_acc =  [val for val in args.current_acc.values() if type(val) != list]
+        scalar_val_acc = np.asarray(tmp_round_val_acc).mean()
+        
+        print("Epoch {}: Avg test acc {}, Avg Val acc {}".format(epoch, scalar_test_acc, scalar_val_acc))
+
+
+        # log on wandb 
+        if args.use_wandb and is_main_process(args):
+            import wandb
+            metrics.update({"train/avg_test_acc": scalar_test_acc, 'train/avg_val_acc': scalar_val_acc})
+            wandb.log(metrics, step=epoch)
+
     while True:
         epoch += 1
         # randomly select partial clients
-        if args.num_local_clients == len(args.dis_cvs_files):
+        if client_states is not None:
+            cur_selected_clients = client_states.select_clients()
+        elif args.num_local_clients == len(args.dis_cvs_files):
             # just use all the local clients
             cur_selected_clients = args.proxy_clients
         else:
@@ -84,35 +209,48 @@ def train(args, model):
         for client in cur_selected_clients:
             cur_tot_client_Lens += args.clients_with_len[client]
 
+        # (client, proxy) pairs trained by this process: all of them, or this rank's share in distributed runs
+        round_pairs = rank_share(args, cur_selected_clients)
+        args.local_proxies = [proxy for client, proxy in round_pairs]
+
         val_loader_proxy_clients = {}
-        y_delta_cache = []
+        y_delta_cache = spilled_deltas.reset() if spilled_deltas is not None else []
         c_delta_cache = []
 
-        for cur_single_client, proxy_single_client in zip(cur_selected_clients, args.proxy_clients):
+        for cur_single_client, proxy_single_client in round_pairs:
             args.single_client = cur_single_client
             args.clients_weightes[proxy_single_client] = args.clients_with_len[cur_single_client] / cur_tot_client_Lens
 
             print('Loading trainset, phase train')
-            trainset = DatasetFLViT(args, loaded_npy, phase='train')
-            train_loader = DataLoader(trainset, sampler=RandomSampler(trainset), batch_size=args.batch_size, num_workers=args.num_workers)
+            trainset = create_dataset(args, loaded_npy, 'train', feature_cache)
+            train_loader = DataLoader(trainset, sampler=RandomSampler(trainset), batch_size=args.batch_size, **loader_kwargs(args))
 
             if args.dataset == 'celeba' or  args.dataset == 'gldk23' or args.dataset == 'isic19':
-                valset = DatasetFLViT(args, loaded_npy, phase='val')
+                valset = create_dataset(args, loaded_npy, 'val', feature_cache)
                 val_loader_proxy_clients[proxy_single_client] = DataLoader(valset, sampler=SequentialSampler(valset), batch_size=args.batch_size,
-                                          num_workers=args.num_workers)
+                                          **eval_loader_kwargs(args))
             else:
                 # for Cifar10 datasets we use union validation dataset
                 val_loader_proxy_clients[proxy_single_client] = val_loader
 
 
             model = model_all[proxy_single_client]
-            model = model.to(args.device).train()
             optimizer = optimizer_all[proxy_single_client]
             scheduler = scheduler_all[proxy_single_client]
+            if client_states is not None:
+                client_extra = client_states.load(cur_single_client, proxy_single_client, model, optimizer, scheduler)
+                c_local[proxy_single_client] = client_extra.get('c_local', [torch.zeros_like(c, device='cpu') for c in c_global])
+            topology.load_edge_model(cur_single_client, proxy_single_client, model)
+            unpack_optimizer_state(optimizer, args.device)
+            if args.compile:
+                model = executor.bind(model, optimizer).train()
+            else:
+                model = model.to(args.device).train()
             if args.decay_type == 'step':
                 scheduler.step()
 
             print('Train the client', cur_single_client, 'of communication round', epoch)
+            client_seed(args, epoch, cur_single_client)
 
             for inner_epoch in range(args.local_epochs):
                 for step, batch in enumerate(train_loader):  
@@ -120,10 +258,7 @@ def train(args, model):
                     batch = tuple(t.to(args.device) for t in batch)
 
                     x, y = batch
-                    predict = model(x)
-                    loss = loss_fct(predict.view(-1, args.num_classes), y.view(-1))
-
-                    loss.backward()
+                    loss = forward_backward(args, model, loss_fct, x, y)
 
                     if args.grad_clip:
                         torch.nn.utils.clip_grad_norm_(model.parameters(), args.max_grad_norm)
@@ -138,79 +273,86 @@ def train(args, model):
                               args.max_communication_rounds, 'loss', loss.item(), 'lr', optimizer.param_groups[0]['lr'])
 
 
+            if args.compile:
+                model = executor.unbind(model_all[proxy_single_client], optimizer)
+
             # we use frequent transfer of model between GPU and CPU due to limitation of GPU memory
             model.to('cpu')
+            pack_optimizer_state(optimizer, args.optimizer_state_precision)
 
-            with torch.no_grad():
-
-                y_delta = []
-                c_plus = []
-                c_delta = []
-                new_parameters = global_params_dict.values()
-
-                for x, y_i in zip(new_parameters, trainable_params(model)):
-                    y_delta.append(y_i - x)
-
-                # compute c_plus
-                coef = 1 / (args.local_epochs * args.learning_rate)
-                for c, c_i, x, y_i in zip(c_global, c_local[proxy_single_client], new_parameters, trainable_params(model)):
-                    c_plus.append(c_i - c + coef * (x - y_i))
-
-                # compute c_delta
-                for c_p, c_l in zip(c_plus, c_local[proxy_single_client]):
-                    c_delta.append(c_p - c_l)
-
-                c_local[proxy_single_client] = c_plus
+            # control variates and model deltas are exchanged with the root only, they cover every round since the last root round
+            if topology.is_root_round(epoch):
+                with torch.no_grad():
 
-                y_delta_cache.append(y_delta)
-                c_delta_cache.append(c_delta)
+                    y_delta = []
+                    c_plus = []
+                    c_delta = []
+                    new_parameters = global_params_dict.values()
 
-        average_model(args, model_all, global_params_dict, len(cur_selected_clients), c_global, y_delta_cache, c_delta_cache) # updates client model param
+                    for x, y_i in zip(new_parameters, global_params(args, model)):
+                        y_delta.append(y_i - x)
 
-        # then evaluate
-        for cur_single_client, proxy_single_client in zip(cur_selected_clients, args.proxy_clients):
-            args.single_client = cur_single_client
-            model = model_all[proxy_single_client]
-            model.to(args.device)
-            valid(args, model, val_loader_proxy_clients[proxy_single_client], test_loader, TestFlag=True)
-            model.cpu()
+                    # compute c_plus
+                    coef = 1 / (args.local_epochs * args.learning_rate * topology.root_period)
+                    for c, c_i, x, y_i in zip(c_global, c_local[proxy_single_client], new_parameters, global_params(args, model)):
+                        c_plus.append(c_i - c + coef * (x - y_i))
 
-        args.record_val_acc = pd.concat([args.record_val_acc, pd.DataFrame([args.current_acc])], ignore_index=True)
-        args.record_val_acc.to_csv(os.path.join(args.output_dir, 'val_acc.csv'))
+                    # compute c_delta
+                    for c_p, c_l in zip(c_plus, c_local[proxy_single_client]):
+                        c_delta.append(c_p - c_l)
 
+                    c_local[proxy_single_client] = c_plus
 
-        args.record_test_acc  = pd.concat([args.record_test_acc, pd.DataFrame([args.current_test_acc])], ignore_index=True)
-        args.record_test_acc.to_csv(os.path.join(args.output_dir, 'test_acc.csv'))
+                    y_delta_cache.append(y_delta)
+                    c_delta_cache.append(c_delta)
 
-        np.save(args.output_dir + '/learning_rate.npy', args.learning_rate_record)
+            if client_states is not None:
+                client_states.store(cur_single_client, model, optimizer, scheduler, c_local=c_local[proxy_single_client])
 
-        # save test acc
-        tmp_round_acc = [val for val in args.current_test_acc.values() if type(val) != list]
-        scalar_test_acc = np.asarray(tmp_round_acc).mean()
-        # save al acc 
-        tmp_round_val_acc =  [val for val in args.current_acc.values() if type(val) != list]
-        scalar_val_acc = np.asarray(tmp_round_val_acc).mean()
-        
-        print("Epoch {}: Avg test acc {}, Avg Val acc {}".format(epoch, scalar_test_acc, scalar_val_acc))
-
-
-        # log on wandb 
-        if args.use_wandb: 
-            metrics = {"train/avg_test_acc": scalar_test_acc, 'train/avg_val_acc': scalar_val_acc}
-            wandb.log(metrics, step=epoch)
+        if topology.is_root_round(epoch):
+            average_model(args, model_all, global_params_dict, len(cur_selected_clients), c_global, y_delta_cache, c_delta_cache) # updates client model param
+            topology.reset()
+        else:
+            topology.aggregate(epoch, round_pairs, model_all)
 
-        if args.global_step_per_client[proxy_single_client] >= args.t_total[proxy_single_client]:
+        # then evaluate, in the background with --async_eval (the records are still written in round order)
+        if evaluator is not None:
+            evaluator.submit(epoch, round_pairs, model_all, val_loader_proxy_clients, test_loader, partial(record_round, epoch, round_pairs, {}))
+        else:
+            for cur_single_client, proxy_single_client in round_pairs:
+                args.single_client = cur_single_client
+                model = model_all[proxy_single_client]
+                if args.compile:
+                    evaluate_client(args, executor.bind(model), val_loader_proxy_clients[proxy_single_client], test_loader, epoch)
+                else:
+                    model.to(args.device)
+                    evaluate_client(args, model, val_loader_proxy_clients[proxy_single_client], test_loader, epoch)
+                    model.cpu()
+            record_round(epoch, round_pairs, {})
+
+        # same proxy on every rank (the last one of the round)
+        if args.global_step_per_client[args.proxy_clients[-1]] >= args.t_total[args.proxy_clients[-1]]:
             break
 
 
 
+    if evaluator is not None:
+        evaluator.close()
+    if eval_policy is not None:
+        eval_policy.report()
+    if store is not None:
+        store.close()
     print("================End training! ================ ")
+    if client_states is not None:
+        client_states.close()
 
-    if args.use_wandb:
+    if args.use_wandb and is_main_process(args):
+        import wandb
         wandb.finish()
+    cleanup_distributed(args)
 
 
-def main():
+def main(argv=None):
     parser = argparse.ArgumentParser()
     # General DL parameters
     parser.add_argument("--FL_platform", type = str, default="ViT-FedAVG",  help="Choose of different FL platform. ")
@@ -223,9 +365,34 @@ def main():
 
     parser.add_argument('--pretrained', type=bool, default=True, help="Whether use pretrained or not")
     parser.add_argument("--pretrained_dir", type=str, default="checkpoint/swin_tiny_patch4_window7_224.pth", help="Where to search for pretrained ViT models. [ViT-B_16.npz,  imagenet21k+imagenet2012_R50+ViT-B_16.npz]")
-    parser.add_argument("--output_dir", default="output", type=str, help="The output directory where checkpoints/results/logs will be written.")
+    parser.add_argument("--model_cache_dir", type=str, default=None, help="Local cache of initialized model snapshots (architecture + norm + num_classes). Disabled if not set.")
+    parser.add_argument("--output_dir", default=None, type=str, help="The output directory where checkpoints/results/logs will be written (default: output/<FL_platform>/<dataset>/<run name>).")
     parser.add_argument("--optimizer_type", default="sgd",choices=["sgd", "adamw"], type=str, help="Ways for optimization.")
+    parser.add_argument("--optimizer_state_precision", default="fp32", choices=["fp32", "bf16", "int8"], type=str, help="Storage precision of the optimizer state of idle clients (int8 uses block-wise absmax scaling).")
     parser.add_argument("--num_workers", default=8, type=int, help="num_workers")
+    parser.add_argument("--resource_plan", default="off", choices=["off", "auto", "calibrate"], type=str, help="Pick threads, loader workers and cpu pinning from the cpu topology (auto: saved plan or heuristic, calibrate: time the thread counts and save the plan)")
+    parser.add_argument("--resource_plan_dir", type=str, default="resource_plans", help="Where the calibrated resource plans are saved, one per architecture")
+    parser.add_argument("--prefetch_factor", default=2, type=int, help="Batches loaded in advance by each DataLoader worker")
+    parser.add_argument('--pin_memory', action='store_true', default=False, help="Page-locked DataLoader batches")
+    parser.add_argument('--auto_loader', action='store_true', default=False, help="Use the DataLoader configuration measured by benchmark_dataloader.py (overrides the three options above and --num_workers)")
+    parser.add_argument("--loader_config_dir", type=str, default="loader_configs", help="Where benchmark_dataloader.py saves the DataLoader configurations")
+    parser.add_argument('--freeze_backbone', action='store_true', default=False, help="Freeze the backbone, cache its features once per sample and train only the tail of the network")
+    parser.add_argument("--trainable_blocks", default=0, type=int, help="With --freeze_backbone: number of last blocks trained with the head (0: head only, >0 needs ViT/DeiT/MLP-Mixer like models)")
+    parser.add_argument("--feature_cache_dir", type=str, default="feature_cache", help="Where the memory mapped frozen features are stored")
+    parser.add_argument("--adapter", default="none", choices=["none", "lora"], type=str, help="Adapter fine-tuning: freeze the base weights and train only LoRA adapters and the head (transformer backbones)")
+    parser.add_argument("--lora_rank", default=8, type=int, help="Rank of the LoRA adapters")
+    parser.add_argument("--lora_alpha", default=16, type=float, help="Scaling of the LoRA update (alpha / rank)")
+    parser.add_argument("--lora_dropout", default=0., type=float, help="Dropout on the input of the LoRA adapters")
+    parser.add_argument("--lora_targets", type=str, default="qkv,proj,fc1,fc2", help="Comma separated names of the linear layers (attention / MLP) that get an adapter")
+    parser.add_argument("--local_groups", nargs='*', default=[], choices=["norm", "head"], help="Parameter groups kept local to each client and never averaged (norm: FedBN style normalization layers)")
+    parser.add_argument("--local_params", type=str, default="", help="Regex on the parameter names, matching parameters are kept local to each client")
+    parser.add_argument("--frozen_params", type=str, default="", help="Regex on the parameter names, matching parameters are neither trained nor exchanged")
+    parser.add_argument('--grad_checkpointing', action='store_true', default=False, help="Activation checkpointing on the backbone blocks")
+    parser.add_argument("--memory_budget_mb", default=0, type=int, help="Memory budget of the local training, enables checkpointing and picks the micro-batch size (0: off)")
+    parser.add_argument("--micro_batch_size", default=0, type=int, help="Split each local batch in micro-batches of this size and accumulate the gradients (0: whole batch, or set by --memory_budget_mb)")
+    parser.add_argument('--compile', action='store_true', default=False, help="Compile the model once with torch.compile and share the compiled copy between all the clients")
+    parser.add_argument("--compile_mode", default="default", choices=["default", "reduce-overhead", "max-autotune"], type=str, help="torch.compile mode")
+    parser.add_argument("--compile_cache_dir", type=str, default="compile_cache", help="On-disk cache of the compiled kernels, reused across restarts")
     parser.add_argument("--weight_decay", default=0, choices=[0.05, 0], type=float, help="Weight deay if we apply some. 0 for SGD and 0.05 for AdamW in paper")
     parser.add_argument('--grad_clip', action='store_true', default=True, help="whether gradient clip to 1 or not")
 
@@ -251,11 +418,39 @@ def main():
     ## FL related parameters
     parser.add_argument("--local_epochs", default=1, type=int, help="Local training epoch in FL")
     parser.add_argument("--max_communication_rounds", default=100, type=int,  help="Total communication rounds")
-    parser.add_argument("--num_local_clients", default=-1, choices=[10, 20, -1], type=int, help="Num of local clients joined in each FL train. -1 indicates all clients")
+    parser.add_argument("--num_local_clients", default=-1, type=int, help="Num of local clients joined in each FL train. -1 indicates all clients")
     parser.add_argument("--split_type", type=str, choices=["split_1", "split_2", "split_3", "real", "central"], default="split_3", help="Which data partitions to use")
-
-
-    args = parser.parse_args()
+    parser.add_argument("--partition_file", type=str, default=None, help="Partition generated by make_partitions.py (cifar10, pacs), replaces the clients of --split_type")
+    parser.add_argument("--client_state", default="proxy", choices=["proxy", "lazy"], type=str, help="proxy: optimizer / scheduler state belongs to the proxy slots, lazy: every client keeps its own state, materialized when sampled")
+    parser.add_argument("--client_cache_size", default=64, type=int, help="With --client_state lazy: clients whose state is kept in RAM, the others are spilled to disk")
+    parser.add_argument("--client_state_dir", type=str, default=None, help="With --client_state lazy: where cold client states are spilled (default: <output_dir>/client_states)")
+    parser.add_argument('--per_client_seed', action='store_true', default=False, help="Reseed torch before each local training from (seed, round, client), always on in distributed runs: use it for single process reference runs")
+    parser.add_argument("--topology", default="flat", choices=["flat", "tree"], type=str, help="Aggregation topology: flat single server, or a tree of edge / intermediate aggregators given by --aggregation_levels")
+    parser.add_argument("--aggregation_levels", nargs='+', default=["4:1", "1:2"], help="With --topology tree: groups:period of every level from the edges to the root (one group), the period is in rounds. With gloo ranks the edges are the ranks")
+    parser.add_argument("--aggregation_workers", default=1, type=int, help="Split the aggregation (and the FedOpt server optimizer step) by parameter chunks over this many worker threads (single process runs)")
+    parser.add_argument("--robust_aggregation", default="none", choices=["none", "median", "trimmed_mean", "krum"], type=str, help="Robust aggregation rule over the flattened client updates (single process runs), none: weighted mean")
+    parser.add_argument("--trim_ratio", default=0.1, type=float, help="With trimmed_mean: share of the clients dropped at each end of every coordinate")
+    parser.add_argument("--krum_byzantine", default=1, type=int, help="With krum: number of byzantine clients tolerated")
+    parser.add_argument("--krum_selected", default=1, type=int, help="With krum: clients kept and averaged (1: Krum, more: Multi-Krum)")
+    parser.add_argument("--robust_chunk_mb", default=64, type=int, help="Working memory of the robust rules, a chunk of the flattened updates of every client")
+    parser.add_argument('--robust_memmap', action='store_true', default=False, help="FedOpt / SCAFFOLD with a robust rule: spill the client updates of the round to a memory-mapped file")
+    parser.add_argument("--robust_memmap_dir", type=str, default=None, help="Where the spilled client updates are written (default: <output_dir>/robust_updates)")
+    parser.add_argument('--secure_aggregation', action='store_true', default=False, help="Simulate secure aggregation: the server only sums pairwise masked fixed point client updates (single process runs)")
+    parser.add_argument("--secagg_neighbors", default=0, type=int, help="With --secure_aggregation: masks shared with this many clients (random k-regular graph, an odd k needs an even number of clients per round), 0: every other client")
+    parser.add_argument("--secagg_dropout", default=0., type=float, help="With --secure_aggregation: probability that a client drops after the key agreement, its masks are recovered from the survivors")
+    parser.add_argument("--secagg_precision_bits", default=24, type=int, help="With --secure_aggregation: fractional bits of the fixed point encoding over Z_2^64")
+    parser.add_argument("--secagg_chunk_mb", default=64, type=int, help="With --secure_aggregation: working memory, the updates are masked and summed chunk by chunk")
+    parser.add_argument('--async_eval', action='store_true', default=False, help="Evaluate round r in a background thread on a snapshot of the weights while round r + 1 trains (single process runs)")
+    parser.add_argument("--eval_max_pending", default=1, type=int, help="With --async_eval: rounds whose evaluation can be queued before the training waits")
+    parser.add_argument("--eval_subsample", default=1.0, type=float, help="Fraction of the val set (stratified) scored every round, 1: full evaluation every round")
+    parser.add_argument("--eval_confidence", default=0.99, type=float, help="With --eval_subsample: confidence of the interval that decides the full evaluation")
+    parser.add_argument("--full_eval_every", default=10, type=int, help="With --eval_subsample: rounds between two forced full evaluations")
+    parser.add_argument("--checkpoint_store", action='store_true', default=False, help="With --save_model_flag: content addressed checkpoints, identical tensors stored once and superseded versions kept as compressed deltas")
+    parser.add_argument("--checkpoint_compression_level", default=6, type=int, help="zlib level of the deltas of --checkpoint_store")
+
+
+    args = parser.parse_args(argv)
+    from utils.start_config import initization_configure
 
     # Initialization
 
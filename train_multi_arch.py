@@ -0,0 +1,166 @@
+# coding=utf-8
+from __future__ import absolute_import, division, print_function
+
+import os
+import random
+import argparse
+import itertools
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, RandomSampler, SequentialSampler
+from utils.data_utils import create_dataset, create_dataset_and_evalmetrix, loader_kwargs, eval_loader_kwargs
+from utils.util import average_model
+from utils.multi_arch import SweepRun, SlotScheduler, shared_valid
+
+DATASET_CLASSES = {'cifar10': 10, 'pacs': 7, 'gldk23': 203, 'isic19': 8}
+
+
+def record_round(args, runs, epoch):
+    """ val / test records of every run, one line per run in the sweep summary """
+    import pandas as pd
+    for run in runs:
+        run_args = run.args
+        run_args.record_val_acc = pd.concat([run_args.record_val_acc, pd.DataFrame([run_args.current_acc])], ignore_index=True)
+        run_args.record_test_acc = pd.concat([run_args.record_test_acc, pd.DataFrame([run_args.current_test_acc])], ignore_index=True)
+        run_args.record_val_acc.to_csv(os.path.join(run_args.output_dir, 'val_acc.csv'))
+        run_args.record_test_acc.to_csv(os.path.join(run_args.output_dir, 'test_acc.csv'))
+        np.save(run_args.output_dir + '/learning_rate.npy', run_args.learning_rate_record)
+
+    summary = pd.DataFrame([{
+        'run': run.args.name_run,
+        'round': epoch,
+        'avg_val_acc': np.asarray([val for val in run.args.current_acc.values() if type(val) != list]).mean(),
+        'avg_test_acc': np.asarray([val for val in run.args.current_test_acc.values() if type(val) != list]).mean(),
+        'step_seconds': run.cost,
+    } for run in runs])
+    summary.to_csv(os.path.join(args.output_dir, 'sweep_summary.csv'), index=False)
+    print(summary.to_string(index=False))
+
+
+def train(args):
+    """ FedAVG of every (architecture, seed, learning rate) of the sweep on the same client batches """
+    os.makedirs(args.output_dir, exist_ok=True)
+    loaded_npy = create_dataset_and_evalmetrix(args)
+
+    runs = [SweepRun(args, FL_platform, seed, learning_rate)
+            for FL_platform, seed, learning_rate in itertools.product(args.FL_platforms, args.seeds, args.learning_rates)]
+    # client sampling and proxy slots are common to all the runs
+    args.proxy_clients, args.num_local_clients = runs[0].args.proxy_clients, runs[0].args.num_local_clients
+    print('============ Multi-architecture sweep: %d runs on one data stream ============' % len(runs))
+
+    print('Loading testset, phase test')
+    testset = create_dataset(args, loaded_npy, 'test')
+    test_loader = DataLoader(testset, sampler=SequentialSampler(testset), batch_size=args.batch_size, **eval_loader_kwargs(args))
+    if args.dataset not in ['celeba', 'gldk23', 'isic19']:
+        print('Loading valset, phase val')
+        valset = create_dataset(args, loaded_npy, 'val')
+        val_loader = DataLoader(valset, sampler=SequentialSampler(valset), batch_size=args.batch_size, **eval_loader_kwargs(args))
+
+    # the runs are packed onto the cores from the cost of a training step of their architecture
+    x, y = next(iter(test_loader))
+    scheduler = SlotScheduler(args, runs, x[:2].to(args.device), y[:2].to(args.device))
+
+    print("=============== Running training ===============")
+    # client sampling and data order of the sweep (the runs seeded their initialization only)
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    epoch = -1
+    while True:
+        epoch += 1
+        if args.num_local_clients == len(args.dis_cvs_files):
+            cur_selected_clients = args.proxy_clients
+        else:
+            cur_selected_clients = np.random.choice(args.dis_cvs_files, args.num_local_clients, replace=False).tolist()
+        cur_tot_client_Lens = sum(args.clients_with_len[client] for client in cur_selected_clients)
+
+        val_loader_proxy_clients = {}
+        for cur_single_client, proxy_single_client in zip(cur_selected_clients, args.proxy_clients):
+            args.single_client = cur_single_client
+            weight = args.clients_with_len[cur_single_client] / cur_tot_client_Lens
+
+            # decoded and augmented once, every batch goes to all the runs
+            trainset = create_dataset(args, loaded_npy, 'train')
+            train_loader = DataLoader(trainset, sampler=RandomSampler(trainset), batch_size=args.batch_size, **loader_kwargs(args))
+            if args.dataset in ['celeba', 'gldk23', 'isic19']:
+                valset = create_dataset(args, loaded_npy, 'val')
+                val_loader_proxy_clients[proxy_single_client] = DataLoader(valset, sampler=SequentialSampler(valset), batch_size=args.batch_size,
+                                                                           **eval_loader_kwargs(args))
+            else:
+                val_loader_proxy_clients[proxy_single_client] = val_loader
+
+            scheduler.map(SweepRun.start_client, cur_single_client, proxy_single_client, weight)
+            print('Train the client', cur_single_client, 'of communication round', epoch)
+            for inner_epoch in range(args.local_epochs):
+                for step, (x, y) in enumerate(train_loader):
+                    x, y = x.to(args.device), y.to(args.device)
+                    losses = scheduler.map(SweepRun.train_step, proxy_single_client, x, y)
+                    if (step + 1) % 10 == 0:
+                        print(cur_single_client, step, ':', len(train_loader), 'inner epoch', inner_epoch, 'round', epoch, ': loss',
+                              ' '.join('%.4f' % loss.item() for loss in losses))
+            for run in runs:
+                run.model_all[proxy_single_client].cpu()
+
+        for run in runs:
+            average_model(run.args, run.model_avg, run.model_all)
+
+        for cur_single_client, proxy_single_client in zip(cur_selected_clients, args.proxy_clients):
+            for run in runs:
+                run.args.single_client = cur_single_client
+            shared_valid(scheduler, proxy_single_client, val_loader_proxy_clients[proxy_single_client], test_loader)
+            for run in runs:
+                run.model_all[proxy_single_client].cpu()
+        record_round(args, runs, epoch)
+
+        if all(run.finished() for run in runs):
+            break
+
+    scheduler.close()
+    print("================End training! ================ ")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="FedAVG sweep over architectures, seeds and learning rates, trained side by side on a single decoded data stream.")
+    parser.add_argument("--FL_platforms", type=str, nargs='+', default=["ViT-FedAVG", "ConvNeXt-FedAVG", "CAFormer-FedAVG"], help="Architectures of the sweep.")
+    parser.add_argument("--seeds", type=int, nargs='+', default=[42], help="Seeds of the model initialization, one run each.")
+    parser.add_argument("--learning_rates", type=float, nargs='+', default=[3e-2], help="Learning rates, one run each.")
+    parser.add_argument("--norm", type=str, default=None, help="Selects a normalization layer for the models. Options: BN, LN, GN")
+    parser.add_argument("--dataset", choices=["cifar10", "celeba", "pacs", "gldk23", "isic19"], default="cifar10", help="Which dataset.")
+    parser.add_argument("--data_path", type=str, default='./data/', help="Where is dataset located.")
+    parser.add_argument("--split_type", type=str, choices=["split_1", "split_2", "split_3", "real", "central"], default="split_3", help="Which data partitions to use")
+    parser.add_argument("--partition_file", type=str, default=None, help="Partition generated by make_partitions.py (cifar10, pacs), replaces the clients of --split_type")
+    parser.add_argument("--save_model_flag", action='store_true', default=False, help="Save the best model for each client.")
+    parser.add_argument('--pretrained', type=bool, default=True, help="Whether use pretrained or not")
+    parser.add_argument("--model_cache_dir", type=str, default=None, help="Local cache of initialized model snapshots (architecture + norm + num_classes). Disabled if not set.")
+    parser.add_argument("--output_dir", default="output/sweep", type=str, help="The sweep summary and one directory per run are written here.")
+    parser.add_argument("--optimizer_type", default="sgd", choices=["sgd", "adamw"], type=str, help="Ways for optimization.")
+    parser.add_argument("--num_workers", default=8, type=int, help="num_workers")
+    parser.add_argument("--prefetch_factor", default=2, type=int, help="Batches loaded in advance by each DataLoader worker")
+    parser.add_argument('--pin_memory', action='store_true', default=False, help="Page-locked DataLoader batches")
+    parser.add_argument("--local_groups", nargs='*', default=[], choices=["norm", "head"], help="Parameter groups kept local to each client and never averaged (norm: FedBN style normalization layers)")
+    parser.add_argument("--local_params", type=str, default="", help="Regex on the parameter names, matching parameters are kept local to each client")
+    parser.add_argument("--frozen_params", type=str, default="", help="Regex on the parameter names, matching parameters are neither trained nor exchanged")
+    parser.add_argument("--micro_batch_size", default=0, type=int, help="Split each local batch in micro-batches of this size and accumulate the gradients (0: whole batch)")
+    parser.add_argument("--weight_decay", default=0, choices=[0.05, 0], type=float, help="Weight deay if we apply some. 0 for SGD and 0.05 for AdamW in paper")
+    parser.add_argument('--grad_clip', action='store_true', default=True, help="whether gradient clip to 1 or not")
+    parser.add_argument("--img_size", default=224, type=int, help="Final train resolution, common to all the runs")
+    parser.add_argument("--batch_size", default=32, type=int, help="Local batch size for training.")
+    parser.add_argument("--gpu_ids", type=str, default='0', help="gpu ids: e.g. 0  0,1,2")
+    parser.add_argument('--seed', type=int, default=42, help="random seed of the client sampling and the data order")
+    parser.add_argument("--decay_type", choices=["cosine", "linear", "step"], default="cosine", help="How to decay the learning rate.")
+    parser.add_argument("--warmup_steps", default=100, type=int, help="Step of training to perform learning rate warmup for if set for cosine and linear deacy.")
+    parser.add_argument("--step_size", default=30, type=int, help="Period of learning rate decay for step size learning rate decay")
+    parser.add_argument("--max_grad_norm", default=1.0, type=float, help="Max gradient norm.")
+    parser.add_argument("--local_epochs", default=1, type=int, help="Local training epoch in FL")
+    parser.add_argument("--max_communication_rounds", default=100, type=int, help="Total communication rounds")
+    parser.add_argument("--num_local_clients", default=-1, type=int, help="Num of local clients joined in each FL train. -1 indicates all clients")
+    args = parser.parse_args(argv)
+
+    args.device = torch.device("cuda:{gpu_id}".format(gpu_id=args.gpu_ids) if torch.cuda.is_available() else "cpu")
+    args.num_classes = DATASET_CLASSES.get(args.dataset, 2)
+    args.best_acc, args.current_acc, args.current_test_acc = {}, {}, {}
+    train(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+import math
+
+import torch
+import torch.nn as nn
+from utils.model_registry import find_architecture, get_submodule
+
+
+class LoRALinear(nn.Module):
+    """
+    Frozen nn.Linear plus a trainable low-rank update: y = base(x) + alpha / rank * B(A(x)).
+    B starts at zero, so the adapted model is initially identical to the base model.
+    """
+    def __init__(self, base, rank=8, alpha=16., dropout=0.):
+        super(LoRALinear, self).__init__()
+        self.base = base
+        self.rank = rank
+        self.scaling = alpha / rank
+        self.lora_dropout = nn.Dropout(dropout) if dropout > 0 else nn.Identity()
+
+        device, dtype = base.weight.device, base.weight.dtype
+        self.lora_A = nn.Parameter(torch.empty(rank, base.in_features, device=device, dtype=dtype))
+        self.lora_B = nn.Parameter(torch.zeros(base.out_features, rank, device=device, dtype=dtype))
+        nn.init.kaiming_uniform_(self.lora_A, a=math.sqrt(5))
+
+        for param in self.base.parameters():
+            param.requires_grad = False
+
+    @property
+    def weight(self):
+        # effective weight, some blocks (e.g. Swin-V2 attention) call F.linear on qkv.weight instead of qkv(x)
+        return self.base.weight + self.scaling * self.lora_B @ self.lora_A
+
+    @property
+    def bias(self):
+        return self.base.bias
+
+    def forward(self, x):
+        return self.base(x) + (self.lora_dropout(x) @ self.lora_A.t() @ self.lora_B.t()) * self.scaling
+
+    def merged(self):
+        """ Plain nn.Linear with the low-rank update folded into the weight (for export / inference) """
+        linear = nn.Linear(self.base.in_features, self.base.out_features, bias=self.base.bias is not None)
+        linear.to(self.base.weight.device, self.base.weight.dtype)
+        with torch.no_grad():
+            linear.weight.copy_(self.weight)
+            if self.base.bias is not None:
+                linear.bias.copy_(self.base.bias)
+        return linear
+
+
+def inject_lora(module, targets, rank=8, alpha=16., dropout=0.):
+    """ Replace in place the nn.Linear layers whose name is in targets with LoRALinear, returns the number of replaced layers """
+    replaced = 0
+    for name, child in module.named_children():
+        if isinstance(child, nn.Linear) and name in targets:
+            setattr(module, name, LoRALinear(child, rank, alpha, dropout))
+            replaced += 1
+        elif not isinstance(child, LoRALinear):
+            replaced += inject_lora(child, targets, rank, alpha, dropout)
+    return replaced
+
+
+def merge_lora(module):
+    """ Fold every LoRALinear of module back into a plain nn.Linear, in place """
+    for name, child in module.named_children():
+        if isinstance(child, LoRALinear):
+            setattr(module, name, child.merged())
+        else:
+            merge_lora(child)
+    return module
+
+
+def add_adapters(args, model):
+    """
+    Adapter fine-tuning: freeze every base weight, inject LoRA adapters into the attention / MLP linear layers
+    and train only the adapters and the classification head. The frozen weights are shared by all the client
+    copies and only the trainable parameters are optimized, exchanged and aggregated by every algorithm.
+    """
+    if getattr(args, 'freeze_backbone', False):
+        raise ValueError('--adapter and --freeze_backbone can not be combined')
+
+    for param in model.parameters():
+        param.requires_grad = False
+
+    targets = [target for target in args.lora_targets.split(',') if target]
+    replaced = inject_lora(model, targets, args.lora_rank, args.lora_alpha, args.lora_dropout)
+    if replaced == 0:
+        raise ValueError('No linear layer named %s in %s, adapters are meant for the transformer backbones '
+                         '(ViT, DeiT, Swin-V1/V2, MaxViT)' % (args.lora_targets, args.FL_platform))
+
+    for param in get_submodule(model, find_architecture(args.FL_platform).head).parameters():
+        param.requires_grad = True
+
+    num_trainable = sum(p.numel() for p in model.parameters() if p.requires_grad)
+    print('============ LoRA adapters (rank %d) in %d layers: training %2.2fM of %2.2fM parameters ============' % (
+        args.lora_rank, replaced, num_trainable / 1000000, sum(p.numel() for p in model.parameters()) / 1000000))
+    return model
@@ -1,38 +1,117 @@
+from timm.layers import activations as timm_activations
 from timm.layers.norm_act import BatchNormAct2d, _create_act
 from torch.nn import functional as F
-import torch 
+import torch
 import torch.nn as nn
 
+
+def _identity(x):
+    return x
+
+
+def _gelu_tanh(x):
+    return F.gelu(x, approximate='tanh')
+
+
+# activation modules of the norm + act layers and their functional form
+ACT_FUNCTIONS = {
+    nn.Identity: _identity,
+    nn.ReLU: F.relu,
+    nn.SiLU: F.silu,
+    nn.Hardswish: F.hardswish,
+    nn.Mish: F.mish,
+    nn.Sigmoid: torch.sigmoid,
+}
+# timm's own activation layers (get_act_layer may return them instead of the torch ones)
+for _name, _function in (('GELU', F.gelu), ('GELUTanh', _gelu_tanh), ('Swish', F.silu), ('HardSwish', F.hardswish),
+                         ('Mish', F.mish), ('Sigmoid', torch.sigmoid)):
+    if hasattr(timm_activations, _name):
+        ACT_FUNCTIONS[getattr(timm_activations, _name)] = _function
+
+
+def functional_act(act):
+    """ Plain function of an activation module, None for modules without one (custom or parametrized activations) """
+    if type(act) is nn.GELU:
+        return _gelu_tanh if act.approximate == 'tanh' else F.gelu
+    return ACT_FUNCTIONS.get(type(act))
+
+
+def group_norm_act(x, num_groups, weight, bias, eps, act_fn):
+    return act_fn(F.group_norm(x, num_groups, weight, bias, eps))
+
+# compiled lazily on first use, set to False if the backend is not available on this machine
+_compiled_group_norm_act = None
+
+
+def fused_group_norm_act(x, num_groups, weight, bias, eps, act_fn):
+    """
+    GroupNorm + activation compiled into a single kernel (normalization, affine and activation in one pass).
+    act_fn is a module level function: the compiled graph is guarded on it and not on an activation module of
+    the layer, so the layers of a network share the graph as long as their activation and eps are the same.
+    """
+    global _compiled_group_norm_act
+    if _compiled_group_norm_act is not False and hasattr(torch, 'compile') and torch._dynamo.is_compiling():
+        # already traced as part of a compiled model, the outer graph fuses the ops
+        return group_norm_act(x, num_groups, weight, bias, eps, act_fn)
+
+    if _compiled_group_norm_act is None:
+        # dynamic shapes: one graph for every resolution and channel count instead of one per layer shape
+        _compiled_group_norm_act = torch.compile(group_norm_act, dynamic=True) if hasattr(torch, 'compile') else False
+
+    if _compiled_group_norm_act is not False:
+        try:
+            return _compiled_group_norm_act(x, num_groups, weight, bias, eps, act_fn)
+        except torch._dynamo.exc.BackendCompilerFailed as e:
+            # no working compiler toolchain for the backend on this machine, any other error is a real one
+            print('Fused GroupNorm + activation is not available, falling back to eager mode:', e)
+            _compiled_group_norm_act = False
+
+    return group_norm_act(x, num_groups, weight, bias, eps, act_fn)
+
+
 class GroupNormAct2d(nn.GroupNorm):
     """GroupNorm + Activation"""
     def __init__(
             self,
-            num_groups, 
+            num_groups,
             num_channels,
             eps=1e-5,
             act_layer=nn.SiLU,
             act_kwargs=None,
             apply_act=True,
             inplace=True,
-            weight= None, 
+            weight= None,
             bias= None,
-            drop_layer=None
+            drop_layer=None,
+            fused=True
     ):
 
         super(GroupNormAct2d, self).__init__(
-            num_groups = num_groups, 
+            num_groups = num_groups,
             num_channels = num_channels,
             eps=eps
         )
         self.drop = drop_layer() if drop_layer is not None else nn.Identity()
         self.act = _create_act(act_layer, act_kwargs=act_kwargs, inplace=inplace, apply_act=apply_act)
+        self.fused = fused
+
+        with torch.no_grad():
+            if weight is not None:
+                self.weight.copy_(weight)
+            if bias is not None:
+                self.bias.copy_(bias)
 
     def forward(self, x):
+        # dropout is an identity in all our configurations, only with an identity the three ops can be fused
+        act_fn = functional_act(self.act) if self.fused and isinstance(self.drop, nn.Identity) else None
+        if act_fn is not None:
+            return fused_group_norm_act(x, self.num_groups, self.weight, self.bias, self.eps, act_fn)
+
         # cut & paste of torch.nn.BatchNorm2d.forward impl to avoid issues with torchscript and tracing
         x = F.group_norm(
             x,
-            self.num_groups, 
-            self.weight, 
+            self.num_groups,
+            self.weight,
             self.bias,
             self.eps
         )
@@ -49,7 +128,7 @@ GROUP_NORM_LOOKUP = {
         128: 8,    # -> channels per group: 16
         192: 12,   # -> channels per group: 16
         256: 16,   # -> channels per group: 16
-        320: 20,   # -> channels per group: 16 
+        320: 20,   # -> channels per group: 16
         512: 32,   # -> channels per group: 16
         384:16,    # -> channels per group: 24
         768: 24,   # -> channels per group: 32
@@ -57,31 +136,63 @@ GROUP_NORM_LOOKUP = {
         2048: 32,  # -> channels per group: 64
     }
 
-def coatnet_to_group_norm(module: torch.nn.Module):
-
-    for name, child in module.named_children():
 
-        if isinstance(child, BatchNormAct2d):
-            num_channels = child.num_features
-            setattr(module, name, GroupNormAct2d(GROUP_NORM_LOOKUP[num_channels], num_channels))
-            
-        elif isinstance(child, nn.BatchNorm2d):
-            child: nn.BatchNorm2d = child
-            num_channels = child.num_features
-            setattr(module, name, torch.nn.GroupNorm(GROUP_NORM_LOOKUP[num_channels], num_channels))
+def num_groups_for(num_channels, lookup=GROUP_NORM_LOOKUP):
+    if num_channels in lookup:
+        return lookup[num_channels]
+    # channel counts outside of the table: most groups (at most 32) that keep at least 8 channels per group
+    for num_groups in range(min(32, num_channels // 8), 0, -1):
+        if num_channels % num_groups == 0:
+            return num_groups
+    return 1
 
-        else:
-            coatnet_to_group_norm(child)
 
+def _copy_affine(source, target):
+    with torch.no_grad():
+        if getattr(source, 'weight', None) is not None:
+            target.weight.copy_(source.weight)
+        if getattr(source, 'bias', None) is not None:
+            target.bias.copy_(source.bias)
 
-def poolformer_to_group_norm(module: torch.nn.Module):
 
+def convert_to_group_norm(module: torch.nn.Module, norm_types=(BatchNormAct2d, nn.BatchNorm2d, nn.GroupNorm),
+                          lookup=GROUP_NORM_LOOKUP, fused=True):
+    """
+    Replace in place every normalization layer of the given types with a GroupNorm over the same channels.
+    The affine parameters are carried over and norm + act layers keep their activation, the running statistics
+    of batch norms are dropped. Works on any timm model, returns the number of replaced layers.
+    """
+    replaced = 0
     for name, child in module.named_children():
-            
+
+        if isinstance(child, GroupNormAct2d) or not isinstance(child, norm_types):
+            replaced += convert_to_group_norm(child, norm_types, lookup, fused)
+            continue
+
         if isinstance(child, nn.GroupNorm):
-            child: torch.nn.GroupNorm = child
             num_channels = child.num_channels
-            setattr(module, name, torch.nn.GroupNorm(GROUP_NORM_LOOKUP[num_channels], num_channels))
+        else:
+            num_channels = child.num_features
 
+        if hasattr(child, 'act'):
+            # BatchNormAct2d, timm GroupNormAct, ...: keep the activation (and dropout) of the original layer
+            new_norm = GroupNormAct2d(num_groups_for(num_channels, lookup), num_channels, eps=child.eps, fused=fused)
+            new_norm.act = child.act
+            new_norm.drop = getattr(child, 'drop', nn.Identity())
         else:
-            poolformer_to_group_norm(child)
\ No newline at end of file
+            new_norm = torch.nn.GroupNorm(num_groups_for(num_channels, lookup), num_channels, eps=child.eps)
+
+        _copy_affine(child, new_norm)
+        new_norm.to(next(child.parameters(), torch.empty(0)).device)
+        setattr(module, name, new_norm)
+        replaced += 1
+
+    return replaced
+
+
+def coatnet_to_group_norm(module: torch.nn.Module):
+    return convert_to_group_norm(module, norm_types=(BatchNormAct2d, nn.BatchNorm2d))
+
+
+def poolformer_to_group_norm(module: torch.nn.Module):
+    return convert_to_group_norm(module, norm_types=(nn.GroupNorm,))
@@ -0,0 +1,68 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from copy import copy, deepcopy
+
+import torch
+from utils.eval_policy import evaluate_client
+
+
+class AsyncEvaluator(object):
+    """
+    Evaluation of round r in a background thread while round r + 1 trains. At submit time the weights of the
+    evaluated clients are snapshotted (trainable parameters and buffers, identical tensors of the round are
+    stored once, e.g. the global weights after averaging), the thread loads them in its own copy of the model
+    and runs evaluate_client() with a shallow copy of args: the best / current metrics, save_model and the
+    adaptive evaluation policy are the ones of the synchronous path. A single thread scores the rounds in
+    submission order, so the finish callback (records, csv files, wandb) also runs in round order. At most
+    max_pending rounds are queued.
+    """
+    def __init__(self, args, model):
+        if getattr(args, 'world_size', 1) > 1:
+            raise ValueError('--async_eval shares the metrics of the ranks with collectives, it needs a single process run')
+        self.args = args
+        # its own copy of the frozen parameters too: the training loop moves the shared ones between devices
+        self.eval_model = deepcopy(model).cpu()
+        self.worker = ThreadPoolExecutor(max_workers=1)
+        self.pending = deque()
+        self.max_pending = max(1, args.eval_max_pending)
+        print('============ Asynchronous evaluation, up to %d rounds queued ============' % self.max_pending)
+
+    def snapshot(self, model, reference=None):
+        state = {}
+        for name, value in model.state_dict(keep_vars=True).items():
+            if isinstance(value, torch.nn.Parameter) and not value.requires_grad:
+                continue
+            value = value.detach()
+            if reference is not None and name in reference and torch.equal(reference[name], value.cpu()):
+                state[name] = reference[name]
+            else:
+                state[name] = value.cpu().clone()
+        return state
+
+    def submit(self, epoch, round_pairs, model_all, val_loaders, test_loader, finish):
+        while len(self.pending) >= self.max_pending:
+            # re-raises an exception of the evaluation thread
+            self.pending.popleft().result()
+
+        snapshots, reference = [], None
+        for client, proxy in round_pairs:
+            state = self.snapshot(model_all[proxy], reference)
+            reference = reference or state
+            snapshots.append((client, state, val_loaders[proxy]))
+        self.pending.append(self.worker.submit(self._evaluate, epoch, snapshots, test_loader, finish))
+
+    def _evaluate(self, epoch, snapshots, test_loader, finish):
+        eval_args = copy(self.args)
+        for client, state, val_loader in snapshots:
+            eval_args.single_client = client
+            self.eval_model.load_state_dict(state, strict=False)
+            self.eval_model.to(self.args.device)
+            evaluate_client(eval_args, self.eval_model, val_loader, test_loader, epoch)
+        self.eval_model.cpu()
+        print('Evaluation of round', epoch, 'done')
+        finish()
+
+    def close(self):
+        while self.pending:
+            self.pending.popleft().result()
+        self.worker.shutdown(wait=True)
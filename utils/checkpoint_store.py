@@ -0,0 +1,180 @@
+import os
+import json
+import time
+import zlib
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+
+def tensor_bytes(tensor):
+    """ Raw bytes of a cpu tensor, any dtype (bfloat16 has no numpy counterpart) """
+    return tensor.contiguous().view(-1).view(torch.uint8).numpy().tobytes()
+
+
+def tensor_from_bytes(raw, dtype, shape):
+    return torch.frombuffer(bytearray(raw), dtype=torch.uint8).view(getattr(torch, dtype)).reshape(shape)
+
+
+def xor_delta(raw, base, itemsize):
+    """
+    Lossless delta of two same sized tensors: XOR of their bit patterns, byte-shuffled (all the first bytes of
+    the elements, then all the second bytes...) so that the zero high bytes of close weights form long runs
+    """
+    delta = np.bitwise_xor(np.frombuffer(raw, dtype=np.uint8), np.frombuffer(base, dtype=np.uint8))
+    return delta.reshape(-1, itemsize).T.tobytes()
+
+
+def xor_undelta(delta, base, itemsize):
+    delta = np.frombuffer(delta, dtype=np.uint8).reshape(itemsize, -1).T
+    return np.bitwise_xor(delta.reshape(-1), np.frombuffer(base, dtype=np.uint8)).tobytes()
+
+
+class CheckpointStore(object):
+    """
+    Content addressed store of the best client models. Every tensor is stored once under the hash of its bytes,
+    a checkpoint is a manifest {name: hash} per client and version: after averaging the clients of a round
+    share their global weights, which are written once. The latest version of every client is kept as raw
+    blobs. When it is superseded, the blobs that no latest manifest uses anymore are rewritten as compressed
+    XOR deltas against the blob of the same tensor in the new version, the older versions stay loadable
+    through the delta chain. The hashing and all writes run on a single background thread, save() only
+    copies the tensors to the cpu.
+
+    Layout of root: blobs/<hash>.bin (raw) or blobs/<hash>.delta, index.json (dtype, shape and delta base of
+    every blob), manifests/<client>/<version>.json and manifests/<client>/latest.json.
+    """
+    def __init__(self, root, compression_level=6):
+        self.root = root
+        self.compression_level = compression_level
+        self.blob_dir = os.path.join(root, 'blobs')
+        self.manifest_dir = os.path.join(root, 'manifests')
+        os.makedirs(self.blob_dir, exist_ok=True)
+        os.makedirs(self.manifest_dir, exist_ok=True)
+        self.index_path = os.path.join(root, 'index.json')
+        self.index = self._read_json(self.index_path) if os.path.exists(self.index_path) else {}
+        self.latest = {client: self._read_json(os.path.join(self.manifest_dir, client, 'latest.json'))
+                       for client in os.listdir(self.manifest_dir)
+                       if os.path.exists(os.path.join(self.manifest_dir, client, 'latest.json'))}
+        self.io = ThreadPoolExecutor(max_workers=1)
+        self.pending = []
+        self.written_bytes = self.deduplicated_bytes = 0
+
+    def _read_json(self, path):
+        with open(path) as f:
+            return json.load(f)
+
+    def _write_file(self, path, content, mode='wb'):
+        with open(path + '.tmp', mode) as f:
+            f.write(content)
+        os.replace(path + '.tmp', path)
+
+    def _blob_path(self, digest, delta=False):
+        return os.path.join(self.blob_dir, digest + ('.delta' if delta else '.bin'))
+
+    def save(self, client, state_dict, **metadata):
+        """ Queue a new version of the checkpoint of client """
+        client = os.path.basename(str(client)).split('.')[0]
+        tensors = {name: value.detach().cpu().clone() for name, value in state_dict.items()}
+        self.pending = [future for future in self.pending if not future.done()]
+        self.pending.append(self.io.submit(self._save, client, tensors, metadata))
+
+    def _save(self, client, tensors, metadata):
+        manifest = {}
+        for name, tensor in tensors.items():
+            raw = tensor_bytes(tensor)
+            digest = hashlib.blake2b(raw, digest_size=20, key=str((tensor.dtype, tuple(tensor.shape))).encode()[:64]).hexdigest()
+            manifest[name] = digest
+            if digest in self.index:
+                self.deduplicated_bytes += len(raw)
+                continue
+            self._write_file(self._blob_path(digest), raw)
+            self.index[digest] = {'dtype': str(tensor.dtype).split('.')[-1], 'shape': list(tensor.shape), 'base': None}
+            self.written_bytes += len(raw)
+
+        previous = self.latest.get(client)
+        version = previous['version'] + 1 if previous is not None else 0
+        entry = dict(metadata, version=version, time=time.time(), tensors=manifest)
+        client_dir = os.path.join(self.manifest_dir, client)
+        os.makedirs(client_dir, exist_ok=True)
+        self._write_file(os.path.join(client_dir, '%d.json' % version), json.dumps(entry), 'w')
+        self._write_file(os.path.join(client_dir, 'latest.json'), json.dumps(entry), 'w')
+        self.latest[client] = entry
+
+        if previous is not None:
+            self._compact(previous['tensors'], manifest)
+        self._write_file(self.index_path, json.dumps(self.index), 'w')
+
+    def _compact(self, old_manifest, new_manifest):
+        """ Blobs of the superseded version, not used by any latest manifest, become deltas against the new version """
+        in_use = set(digest for entry in self.latest.values() for digest in entry['tensors'].values())
+        for name, digest in old_manifest.items():
+            base = new_manifest.get(name)
+            info = self.index[digest]
+            # a base stored as a delta itself could close a cycle (weights back to an older version)
+            if digest in in_use or info['base'] is not None or base is None or self.index[base]['base'] is not None:
+                continue
+            if self.index[base]['dtype'] != info['dtype'] or self.index[base]['shape'] != info['shape']:
+                continue
+            itemsize = torch.empty(0, dtype=getattr(torch, info['dtype'])).element_size()
+            with open(self._blob_path(digest), 'rb') as f:
+                raw = f.read()
+            delta = zlib.compress(xor_delta(raw, self._read_blob(base), itemsize), self.compression_level)
+            self._write_file(self._blob_path(digest, delta=True), delta)
+            info['base'] = base
+            self._write_file(self.index_path, json.dumps(self.index), 'w')
+            os.remove(self._blob_path(digest))
+
+    def _read_blob(self, digest):
+        info = self.index[digest]
+        if info['base'] is None:
+            with open(self._blob_path(digest), 'rb') as f:
+                return f.read()
+        itemsize = torch.empty(0, dtype=getattr(torch, info['dtype'])).element_size()
+        with open(self._blob_path(digest, delta=True), 'rb') as f:
+            delta = zlib.decompress(f.read())
+        return xor_undelta(delta, self._read_blob(info['base']), itemsize)
+
+    def versions(self, client):
+        client_dir = os.path.join(self.manifest_dir, os.path.basename(str(client)).split('.')[0])
+        return sorted(int(name.split('.')[0]) for name in os.listdir(client_dir) if name != 'latest.json' and name.endswith('.json'))
+
+    def load(self, client, version=None):
+        """ state_dict of a version of the checkpoint of client (default: the latest one) """
+        self.flush()
+        client = os.path.basename(str(client)).split('.')[0]
+        name = 'latest.json' if version is None else '%d.json' % version
+        entry = self._read_json(os.path.join(self.manifest_dir, client, name))
+        return {name: tensor_from_bytes(self._read_blob(digest), self.index[digest]['dtype'], self.index[digest]['shape'])
+                for name, digest in entry['tensors'].items()}
+
+    def flush(self):
+        """ Wait for the queued writes, re-raises an exception of the writer thread """
+        while self.pending:
+            self.pending.pop(0).result()
+
+    def report(self):
+        self.flush()
+        sizes = [os.path.getsize(os.path.join(self.blob_dir, name)) for name in os.listdir(self.blob_dir)]
+        print('Checkpoint store %s: %d clients, %d blobs (%d deltas), %2.2fMB on disk, %2.2fMB written, %2.2fMB deduplicated' % (
+            self.root, len(self.latest), len(self.index), sum(info['base'] is not None for info in self.index.values()),
+            sum(sizes) / 2 ** 20, self.written_bytes / 2 ** 20, self.deduplicated_bytes / 2 ** 20))
+
+    def close(self):
+        self.report()
+        self.io.shutdown(wait=True)
+
+
+def checkpoint_store(args):
+    """ Store of the run under <output_dir>/checkpoint_store (args.checkpoint_store_instance), None when it is off """
+    if not getattr(args, 'checkpoint_store', False):
+        return None
+    if getattr(args, 'checkpoint_store_instance', None) is None:
+        root = os.path.join(args.output_dir, 'checkpoint_store', args.name_run)
+        if getattr(args, 'world_size', 1) > 1:
+            # one index per process, the ranks train disjoint clients
+            root = os.path.join(root, 'rank%d' % args.rank)
+        args.checkpoint_store_instance = CheckpointStore(root, args.checkpoint_compression_level)
+        print('============ Content addressed checkpoints in %s ============' % root)
+    return args.checkpoint_store_instance
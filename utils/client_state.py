@@ -0,0 +1,127 @@
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+
+import numpy as np
+import torch
+from utils.param_groups import LOCAL
+
+
+class ClientStateManager(object):
+    """
+    Per-client state for federations with many more clients than the ones sampled in a round. The proxy
+    models / optimizers / schedulers of Partial_Client_Selection are only working slots: when a client is
+    sampled its own state (optimizer moments, scheduler step, local parameters, SCAFFOLD c_local) is loaded
+    into the slot and stored back after its local training. A bounded LRU of hot clients stays in RAM, cold
+    clients are spilled to client_state_dir and the clients of the next round are prefetched in background.
+    Clients that were never sampled have no state at all.
+    """
+    def __init__(self, args, model, optimizer_all, scheduler_all):
+        self.args = args
+        self.capacity = args.client_cache_size
+        self.state_dir = args.client_state_dir or os.path.join(args.output_dir, 'client_states')
+        os.makedirs(self.state_dir, exist_ok=True)
+
+        policy = getattr(args, 'param_policy', {})
+        self.local_names = [name for name, group in policy.items() if group == LOCAL]
+        params = dict(model.named_parameters())
+        self.initial_local = {name: params[name].detach().cpu().clone() for name in self.local_names}
+        # fresh optimizer / scheduler of every slot, the starting point of a client sampled for the first time
+        self.initial_optimizer = {slot: deepcopy(optimizer.state_dict()['param_groups']) for slot, optimizer in optimizer_all.items()}
+        self.initial_scheduler = {slot: deepcopy(scheduler.state_dict()) for slot, scheduler in scheduler_all.items()}
+
+        self.hot = OrderedDict()
+        self.on_disk = set()
+        self.prefetched = {}
+        # a single background thread: spills and prefetches of the same client run in submission order
+        self.io = ThreadPoolExecutor(max_workers=1)
+        self.next_selection = None
+        print('============ Lazy client state: %d clients in RAM, cold clients spilled to %s ============' % (self.capacity, self.state_dir))
+
+    def _path(self, client):
+        return os.path.join(self.state_dir, '%s.pt' % os.path.basename(str(client)))
+
+    def _sample(self):
+        if self.args.num_local_clients == len(self.args.dis_cvs_files):
+            return list(self.args.proxy_clients)
+        return np.random.choice(self.args.dis_cvs_files, self.args.num_local_clients, replace=False).tolist()
+
+    def select_clients(self):
+        """ Clients of this round; the ones of the next round are drawn now and their state is prefetched """
+        selection = self.next_selection if self.next_selection is not None else self._sample()
+        self.next_selection = self._sample()
+        for client in self.next_selection:
+            if client not in self.hot and client in self.on_disk and client not in self.prefetched:
+                self.prefetched[client] = self.io.submit(self._read, client)
+        return selection
+
+    def _read(self, client):
+        return torch.load(self._path(client), map_location='cpu', weights_only=False)
+
+    def _write(self, client, state):
+        path = self._path(client)
+        torch.save(state, path + '.tmp')
+        os.replace(path + '.tmp', path)
+
+    def _fetch(self, client):
+        if client in self.hot:
+            return self.hot.pop(client)
+        if client in self.prefetched:
+            return self.prefetched.pop(client).result()
+        if client in self.on_disk:
+            # waits for a spill of this client still in the queue
+            return self.io.submit(self._read, client).result()
+        return None
+
+    def load(self, client, slot, model, optimizer, scheduler):
+        """ Move the state of client into the slot, returns its extra entries (e.g. c_local), empty for a new client """
+        state = self._fetch(client)
+        params = [param for group in optimizer.param_groups for param in group['params']]
+
+        optimizer.state.clear()
+        if state is None:
+            for group, initial in zip(optimizer.param_groups, self.initial_optimizer[slot]):
+                group.update({key: value for key, value in initial.items() if key != 'params'})
+            scheduler.load_state_dict(deepcopy(self.initial_scheduler[slot]))
+            local = self.initial_local
+            extra = {}
+        else:
+            for param, param_state in zip(params, state['optimizer']):
+                if param_state:
+                    optimizer.state[param] = param_state
+            scheduler.load_state_dict(state['scheduler'])
+            local = state['local']
+            extra = state['extra']
+
+        for group, lr in zip(optimizer.param_groups, scheduler.get_last_lr()):
+            group['lr'] = lr
+
+        if local:
+            named_params = dict(model.named_parameters())
+            with torch.no_grad():
+                for name, value in local.items():
+                    named_params[name].copy_(value)
+        return extra
+
+    def store(self, client, model, optimizer, scheduler, **extra):
+        """ Take the state of client out of the slot (after pack_optimizer_state) and keep it in the LRU """
+        params = [param for group in optimizer.param_groups for param in group['params']]
+        named_params = dict(model.named_parameters())
+        state = {
+            'optimizer': [optimizer.state.get(param, {}) for param in params],
+            'scheduler': scheduler.state_dict(),
+            'local': {name: named_params[name].detach().cpu().clone() for name in self.local_names},
+            'extra': extra,
+        }
+        optimizer.state.clear()
+
+        self.hot[client] = state
+        self.hot.move_to_end(client)
+        while len(self.hot) > self.capacity:
+            cold_client, cold_state = self.hot.popitem(last=False)
+            self.on_disk.add(cold_client)
+            self.io.submit(self._write, cold_client, cold_state)
+
+    def close(self):
+        self.io.shutdown(wait=True)
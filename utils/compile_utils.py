@@ -0,0 +1,79 @@
+import os
+from copy import deepcopy
+
+import torch
+import torch.nn as nn
+from utils.model_registry import find_architecture
+
+
+class ExecutorModule(nn.Module):
+    """ Wraps the shared model, optionally feeding it channels_last images (the layout used by its weights) """
+    def __init__(self, module, channels_last=False):
+        super(ExecutorModule, self).__init__()
+        # named module so that save_model stores the state dict of the wrapped model
+        self.module = module
+        self.channels_last = channels_last
+
+    def forward(self, x):
+        if self.channels_last and x.dim() == 4:
+            x = x.contiguous(memory_format=torch.channels_last)
+        return self.module(x)
+
+
+def configure_compile_cache(cache_dir):
+    # compiled kernels (and FX graphs when supported) are reused across restarts
+    cache_dir = os.path.abspath(cache_dir)
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', os.path.join(cache_dir, 'inductor'))
+    os.environ.setdefault('TRITON_CACHE_DIR', os.path.join(cache_dir, 'triton'))
+
+    import torch._inductor.config as inductor_config
+    if hasattr(inductor_config, 'fx_graph_cache'):
+        inductor_config.fx_graph_cache = True
+
+
+def swap_optimizer_params(optimizer, old_params, new_params):
+    """ Re-key the param groups and the state of the optimizer from old_params to new_params (same order) """
+    mapping = {id(old): new for old, new in zip(old_params, new_params)}
+    for group in optimizer.param_groups:
+        group['params'] = [mapping.get(id(p), p) for p in group['params']]
+
+    state = optimizer.state
+    for param in list(state.keys()):
+        if id(param) in mapping:
+            state[mapping[id(param)]] = state.pop(param)
+
+
+class CompiledExecutor(object):
+    """
+    A single compiled copy of the architecture shared by every client. All the clients have the same
+    architecture, so instead of compiling each client model (one compilation per client and per guard
+    failure) the weights and the optimizer of the active client are bound to the compiled copy while it
+    trains or evaluates and written back afterwards.
+    """
+    def __init__(self, args, model):
+        configure_compile_cache(args.compile_cache_dir)
+
+        self.channels_last = find_architecture(args.FL_platform).channels_last
+        self.inner = deepcopy(model).to(args.device)
+        if self.channels_last:
+            self.inner.to(memory_format=torch.channels_last)
+
+        self.compiled = torch.compile(ExecutorModule(self.inner, self.channels_last), mode=args.compile_mode)
+        print('============ Compiled executor created (channels_last: %s) ============' % self.channels_last)
+
+    def bind(self, model, optimizer=None):
+        """ Load the client weights into the compiled copy, the optimizer now updates the compiled copy """
+        with torch.no_grad():
+            self.inner.load_state_dict(model.state_dict())
+        if optimizer is not None:
+            swap_optimizer_params(optimizer, list(model.parameters()), list(self.inner.parameters()))
+        return self.compiled
+
+    def unbind(self, model, optimizer=None):
+        """ Write the trained weights back into the client model and give the optimizer back its parameters """
+        with torch.no_grad():
+            model.load_state_dict(self.inner.state_dict())
+        if optimizer is not None:
+            swap_optimizer_params(optimizer, list(self.inner.parameters()), list(model.parameters()))
+        return model
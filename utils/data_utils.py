@@ -1,52 +1,57 @@
 import os
+import json
 import random
 import numpy as np
-import pandas as pd
-from copy import deepcopy
 from PIL import Image
-from skimage.transform import resize
-from timm.data import Mixup
-from timm.data import create_transform
-
 
 import torch
-from torchvision import transforms
-
 import torch.utils.data as data
+from utils.model_registry import find_architecture
+from utils.partition import PARTITION_DATASETS, load_partition, partition_client_names, partition_client_data
 
 Image.LOAD_TRUNCATED_IMAGES = True
 
 CIFAR10_MEAN = (0.49139968, 0.48215841, 0.44653091)
 CIFAR10_STD = (0.24703223, 0.24348513, 0.26158784)
 
+# datasets loaded once by sweep.py before it forks the runs: the children share the pages (copy on write)
+RESIDENT_NPY = {}
+RESIDENT_EVAL = {}
+
+
+def build_transform(args, phase):
+    from torchvision import transforms
+    if phase == 'train':
+        return transforms.Compose([
+            transforms.RandomResizedCrop((args.img_size, args.img_size), scale=(0.05, 1.0)),
+            transforms.ToTensor(),
+            transforms.Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5]),
+        ])
+
+    return transforms.Compose([
+        transforms.Resize((args.img_size, args.img_size)),
+        transforms.ToTensor(),
+        transforms.Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5]),
+    ])
+
 
 class DatasetFLViT(data.Dataset):
     def __init__(self, args, loaded_npy, phase):
         super(DatasetFLViT, self).__init__()
         self.phase = phase
         self.loaded_npy = loaded_npy
-
-        if self.phase == 'train':
-            self.transform = transforms.Compose([
-                transforms.RandomResizedCrop((args.img_size, args.img_size), scale=(0.05, 1.0)),
-                transforms.ToTensor(),
-                transforms.Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5]),
-            ])
-        else:
-
-            self.transform = transforms.Compose([
-                transforms.Resize((args.img_size, args.img_size)),
-                transforms.ToTensor(),
-                transforms.Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5]),
-            ])
-
+        self.transform = build_transform(args, phase)
 
         data_all = self.loaded_npy
         data_all = data_all.item()
         self.data_all = data_all[args.split_type]
 
         if self.phase == 'train':
-            if args.dataset == 'cifar10' or args.dataset == "pacs" :
+            if getattr(args, 'partition', None) is not None:
+                # generated partition: the client samples are gathered from the pool by index
+                self.data, self.labels = partition_client_data(args.partition, args.single_client)
+
+            elif args.dataset == 'cifar10' or args.dataset == "pacs" :
                 self.data = self.data_all['data'][args.single_client]
                 self.labels = self.data_all['target'][args.single_client]
 
@@ -131,7 +136,116 @@ class DatasetFLViT(data.Dataset):
         return len(self.data)
 
 
+def loader_kwargs(args):
+    """ DataLoader options shared by all the loaders (workers and their cpu pinning come from the resource plan) """
+    kwargs = {'num_workers': args.num_workers, 'worker_init_fn': getattr(args, 'worker_init_fn', None),
+              'pin_memory': getattr(args, 'pin_memory', False)}
+    # prefetch_factor is only accepted with worker processes
+    if args.num_workers > 0 and getattr(args, 'prefetch_factor', None):
+        kwargs['prefetch_factor'] = args.prefetch_factor
+    return kwargs
+
+
+def eval_loader_kwargs(args):
+    """ loader_kwargs of the val / test loaders: their own generator, an evaluation (possibly on the --async_eval
+    thread) never draws from the global torch generator that seeds the training samplers and dropout """
+    return dict(loader_kwargs(args), generator=torch.Generator().manual_seed(args.seed))
+
+
+def loader_config_path(config_dir, dataset, split_type, FL_platform, img_size):
+    file_name = '%s_%s_%s_img_%d.json' % (dataset, split_type, find_architecture(FL_platform).key, img_size)
+    return os.path.join(config_dir, file_name)
+
+
+def apply_loader_config(args):
+    """ Use the DataLoader configuration measured by benchmark_dataloader.py for this dataset, split and architecture """
+    path = loader_config_path(args.loader_config_dir, args.dataset, args.split_type, args.FL_platform, args.img_size)
+    if not os.path.exists(path):
+        print('============ No DataLoader configuration in %s, run benchmark_dataloader.py first ============' % path)
+        return
+
+    with open(path) as f:
+        configs = json.load(f)
+    # configurations are measured per batch size, the closest one is used
+    batch_size = min(configs, key=lambda key: abs(int(key) - args.batch_size))
+    config = configs[batch_size]
+    args.num_workers = config['num_workers']
+    args.prefetch_factor = config['prefetch_factor']
+    args.pin_memory = config['pin_memory']
+    print('============ DataLoader configuration of batch size %s: %d workers, prefetch %s, pin_memory %s (stall fraction %.2f) ============' % (
+        batch_size, args.num_workers, args.prefetch_factor, args.pin_memory, config['stall_fraction']))
+
+
+class ResidentEvalDataset(data.Dataset):
+    """
+    Union val / test set decoded and resized once (uint8, channels first). __getitem__ only applies ToTensor and
+    Normalize(0.5, 0.5), the samples equal the ones of DatasetFLViT with the evaluation transform.
+    """
+    def __init__(self, dataset):
+        self.images = np.empty((len(dataset), 3, dataset.args.img_size, dataset.args.img_size), dtype=np.uint8)
+        self.labels = []
+        transform, dataset.transform = dataset.transform, transform_resize(dataset.args)
+        try:
+            for index in range(len(dataset)):
+                img, target = dataset[index]
+                self.images[index] = np.asarray(img, dtype=np.uint8).transpose(2, 0, 1)
+                self.labels.append(np.asarray(target).astype('int64'))
+        finally:
+            dataset.transform = transform
+        self.labels = np.stack(self.labels)
+
+    def __getitem__(self, index):
+        return torch.from_numpy(self.images[index]).float().div_(127.5).sub_(1.), self.labels[index]
+
+    def __len__(self):
+        return len(self.images)
+
+
+def transform_resize(args):
+    from torchvision import transforms
+    return transforms.Compose([transforms.Resize((args.img_size, args.img_size)), lambda img: img.convert('RGB')])
+
+
+def resident_key(args, phase):
+    return (os.path.abspath(args.data_path), args.dataset, args.split_type, phase, args.img_size)
+
+
+def load_npy(path):
+    """ The pickled dataset, from the copy made resident by sweep.py when there is one """
+    path = os.path.abspath(path)
+    if path in RESIDENT_NPY:
+        return RESIDENT_NPY[path]
+    return np.load(path, allow_pickle=True)
+
+
+def make_resident(args, eval_phases=()):
+    """ Load the dataset of args (and decode its union eval sets) in this process, for the processes forked afterwards """
+    path = os.path.abspath(os.path.join(args.data_path, args.dataset, args.dataset + '.npy'))
+    if path not in RESIDENT_NPY:
+        RESIDENT_NPY[path] = np.load(path, allow_pickle=True)
+    for phase in eval_phases:
+        if phase == 'val' and args.dataset in ['celeba', 'gldk23', 'isic19'] and args.split_type != 'central':
+            # one val set per client
+            continue
+        key = resident_key(args, phase)
+        if key not in RESIDENT_EVAL:
+            RESIDENT_EVAL[key] = ResidentEvalDataset(DatasetFLViT(args, RESIDENT_NPY[path], phase=phase))
+            print('Resident %s set of %s %s: %d images, %2.2fMB' % (
+                phase, args.dataset, args.split_type, len(RESIDENT_EVAL[key]), RESIDENT_EVAL[key].images.nbytes / 2 ** 20))
+
+
+def create_dataset(args, loaded_npy, phase, feature_cache=None):
+    """ Images of the current args.single_client, or their frozen backbone features when a feature cache is used """
+    if feature_cache is not None:
+        return feature_cache.dataset(loaded_npy, phase)
+    # union eval sets decoded once by the sweep executor (the per client val sets of the natural splits are not)
+    if phase != 'train' and resident_key(args, phase) in RESIDENT_EVAL:
+        return RESIDENT_EVAL[resident_key(args, phase)]
+    return DatasetFLViT(args, loaded_npy, phase=phase)
+
+
 def create_dataset_and_evalmetrix(args):
+    import pandas as pd
 
     ## get the joined clients
     if args.split_type == 'central':
@@ -141,16 +255,28 @@ def create_dataset_and_evalmetrix(args):
 
         # get the client with number
         print('Loading dataset and npy file')
-        data_all_loaded = np.load(os.path.join(args.data_path, args.dataset, args.dataset + '.npy'), allow_pickle=True)
+        data_all_loaded = load_npy(os.path.join(args.data_path, args.dataset, args.dataset + '.npy'))
         data_all = data_all_loaded.item()
 
-        data_all = data_all[args.split_type]
-        args.dis_cvs_files = [key for key in data_all['data'].keys() if 'train' in key]
-        args.clients_with_len = {name: data_all['data'][name].shape[0] for name in args.dis_cvs_files}
+        if getattr(args, 'partition_file', None):
+            # clients of a partition generated by make_partitions.py instead of the splits shipped in the .npy
+            args.partition = load_partition(args.partition_file, data_all)
+            args.dis_cvs_files = partition_client_names(args.partition)
+            args.clients_with_len = dict(zip(args.dis_cvs_files, np.diff(args.partition.offsets).tolist()))
+            print('Partition %s: %d clients' % (os.path.basename(args.partition_file), len(args.dis_cvs_files)))
+
+        else:
+            data_all = data_all[args.split_type]
+            args.dis_cvs_files = [key for key in data_all['data'].keys() if 'train' in key]
+            args.clients_with_len = {name: data_all['data'][name].shape[0] for name in args.dis_cvs_files}
 
 
     elif args.dataset in ['celeba', 'gldk23', 'isic19']:
-        data_all_loaded = np.load(os.path.join(args.data_path, args.dataset, args.dataset + '.npy'), allow_pickle=True)
+        if getattr(args, 'partition_file', None):
+            raise ValueError('Generated partitions are only available for %s, %s has natural clients (--split_type real)' % (
+                ', '.join(PARTITION_DATASETS), args.dataset))
+
+        data_all_loaded = load_npy(os.path.join(args.data_path, args.dataset, args.dataset + '.npy'))
         data_all = data_all_loaded.item()
         args.dis_cvs_files = list(data_all[args.split_type]['train'].keys())
 
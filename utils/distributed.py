@@ -0,0 +1,111 @@
+import os
+
+import torch
+import torch.distributed as dist
+
+
+def init_distributed(args):
+    """
+    Join the gloo process group when the script is started by launch_distributed.py (or torchrun), every rank
+    then trains its share of the selected clients. Single process runs get rank 0 of a world of size 1.
+    """
+    args.world_size = int(os.environ.get('WORLD_SIZE', 1))
+    args.rank = int(os.environ.get('RANK', 0))
+    args.local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    if args.world_size == 1:
+        return
+
+    dist.init_process_group(backend='gloo', rank=args.rank, world_size=args.world_size)
+    # the same seed stream for every client whatever the rank that trains it
+    args.per_client_seed = True
+
+    # ranks sharing a host share its cores
+    local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', 1))
+    if local_world_size > 1 and getattr(args, 'resource_plan', 'off') == 'off':
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // local_world_size))
+    print('============ Rank %d of %d (gloo) ============' % (args.rank, args.world_size))
+
+
+def is_main_process(args):
+    return getattr(args, 'rank', 0) == 0
+
+
+def client_seed(args, epoch, client):
+    """ Reseed torch before the local training of a client, the seed only depends on the round and the client """
+    if not getattr(args, 'per_client_seed', False):
+        return
+    if not hasattr(args, 'client_index'):
+        args.client_index = {name: index for index, name in enumerate(args.dis_cvs_files)}
+    torch.manual_seed((args.seed * 1000003 + epoch * 100003 + args.client_index[client]) % (2 ** 63))
+
+
+def rank_share(args, selected_clients):
+    """
+    (client, proxy) pairs of the round trained by this rank. Proxy slots stay on the same rank (their optimizer
+    and scheduler state live there); with --client_state lazy the state follows the client, so clients do.
+    """
+    pairs = list(zip(selected_clients, args.proxy_clients))
+    world_size = getattr(args, 'world_size', 1)
+    if world_size == 1:
+        return pairs
+
+    if args.client_state == 'lazy':
+        if not hasattr(args, 'client_index'):
+            args.client_index = {name: index for index, name in enumerate(args.dis_cvs_files)}
+        return [(client, proxy) for client, proxy in pairs if args.client_index[client] % world_size == args.rank]
+    return [(client, proxy) for position, (client, proxy) in enumerate(pairs) if position % world_size == args.rank]
+
+
+def all_reduce_weighted_sum(args, tensor_lists, weights, like, group=None):
+    """
+    sum_i weights[i] * tensor_lists[i] over the clients of all the ranks. The local clients are accumulated in a
+    single flat float64 buffer, reduced with one all_reduce (over `group`, all the ranks by default) and split back
+    into tensors shaped (and placed) like `like`.
+    """
+    flat = torch.zeros(sum(tensor.numel() for tensor in like), dtype=torch.float64)
+    for tensors, weight in zip(tensor_lists, weights):
+        flat += float(weight) * torch.cat([tensor.detach().reshape(-1).cpu().double() for tensor in tensors])
+
+    if getattr(args, 'world_size', 1) > 1:
+        dist.all_reduce(flat, op=dist.ReduceOp.SUM, group=group)
+
+    result, offset = [], 0
+    for tensor in like:
+        result.append(flat[offset:offset + tensor.numel()].view(tensor.shape).to(device=tensor.device, dtype=tensor.dtype))
+        offset += tensor.numel()
+    return result
+
+
+def all_reduce_scalar(args, value, group=None):
+    if getattr(args, 'world_size', 1) == 1:
+        return value
+    tensor = torch.tensor([float(value)], dtype=torch.float64)
+    dist.all_reduce(tensor, op=dist.ReduceOp.SUM, group=group)
+    return tensor.item()
+
+
+def sync_client_metrics(args, pairs):
+    """ Share the evaluation results and step counters of the clients of every rank, all ranks end the round equal """
+    if getattr(args, 'world_size', 1) == 1:
+        return
+
+    clients = {client: (args.best_acc[client], args.best_eval_loss[client], args.current_acc[client], args.current_test_acc[client])
+               for client, proxy in pairs}
+    proxies = {proxy: (args.global_step_per_client[proxy], args.learning_rate_record[proxy]) for client, proxy in pairs}
+
+    gathered = [None] * args.world_size
+    dist.all_gather_object(gathered, (clients, proxies))
+    for clients, proxies in gathered:
+        for client, (best_acc, best_eval_loss, current_acc, current_test_acc) in clients.items():
+            args.best_acc[client] = best_acc
+            args.best_eval_loss[client] = best_eval_loss
+            args.current_acc[client] = current_acc
+            args.current_test_acc[client] = current_test_acc
+        for proxy, (global_step, learning_rate_record) in proxies.items():
+            args.global_step_per_client[proxy] = global_step
+            args.learning_rate_record[proxy] = learning_rate_record
+
+
+def cleanup_distributed(args):
+    if getattr(args, 'world_size', 1) > 1:
+        dist.destroy_process_group()
@@ -0,0 +1,118 @@
+import math
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+# integer Renyi orders of the accountant
+RDP_ORDERS = list(range(2, 65)) + [80, 96, 128, 256]
+
+
+def check_dp_support(args, model):
+    """ Per-sample gradients with vmap need layers that treat every sample on its own """
+    batch_norms = [name for name, module in model.named_modules() if isinstance(module, nn.modules.batchnorm._BatchNorm)]
+    if batch_norms:
+        raise ValueError('--dp needs a model without batch norm (mixes the samples of a batch), %s has %s: use --norm LN or GN' % (
+            args.FL_platform, batch_norms[0]))
+    if args.compile or args.grad_checkpointing or args.memory_budget_mb > 0:
+        raise ValueError('--dp computes the per-sample gradients with torch.func, it cannot be combined with --compile, '
+                         '--grad_checkpointing or --memory_budget_mb (use --micro_batch_size to bound the memory)')
+    print('============ DP-SGD: clip %g, noise multiplier %g, delta %g ============' % (args.dp_clip, args.dp_noise_multiplier, args.dp_delta))
+
+
+def dp_backward(args, model, loss_fct, x, y, extra_loss=None):
+    """
+    Private counterpart of forward_backward: the gradient of every sample is computed in batched form with
+    torch.func (vmap over grad, one forward / backward for the whole micro-batch), clipped to an L2 norm of
+    args.dp_clip, summed and noised with N(0, (noise_multiplier * clip)^2) before the division by the batch
+    size. extra_loss (the FedProx proximal term) only depends on the parameters, its gradient is added as is.
+    Returns the detached batch loss.
+    """
+    from torch.func import functional_call, grad_and_value, vmap
+
+    params = {name: param.detach() for name, param in model.named_parameters() if param.requires_grad}
+    buffers = {name: buffer.detach() for name, buffer in model.named_buffers()}
+
+    def sample_loss(params, buffers, x_sample, y_sample):
+        predict = functional_call(model, (params, buffers), (x_sample.unsqueeze(0),))
+        return loss_fct(predict.view(-1, args.num_classes), y_sample.view(-1))
+
+    per_sample_grad = vmap(grad_and_value(sample_loss), in_dims=(None, None, 0, 0), randomness='different')
+
+    micro_batch_size = getattr(args, 'micro_batch_size', 0) or x.shape[0]
+    summed = {name: torch.zeros_like(param) for name, param in params.items()}
+    total_loss = 0.
+    for x_micro, y_micro in zip(x.split(micro_batch_size), y.split(micro_batch_size)):
+        grads, losses = per_sample_grad(params, buffers, x_micro, y_micro)
+        norms = torch.sqrt(sum(grad.reshape(grad.shape[0], -1).pow(2).sum(dim=1) for grad in grads.values()))
+        scale = (args.dp_clip / (norms + 1e-6)).clamp(max=1.)
+        for name, grad in grads.items():
+            summed[name] += torch.einsum('b,b...->...', scale, grad)
+        total_loss += losses.sum().detach() / x.shape[0]
+
+    named_params = dict(model.named_parameters())
+    for name, grad in summed.items():
+        noise = torch.randn_like(grad) * (args.dp_noise_multiplier * args.dp_clip)
+        named_params[name].grad = (grad + noise) / x.shape[0]
+
+    if extra_loss is not None:
+        loss = extra_loss()
+        loss.backward()
+        total_loss += loss.detach()
+    return total_loss
+
+
+def _log_add(a, b):
+    high, low = max(a, b), min(a, b)
+    if low == -np.inf:
+        return high
+    return high + math.log1p(math.exp(low - high))
+
+
+def sampled_gaussian_rdp(sample_rate, noise_multiplier, order):
+    """ RDP of one step of the subsampled Gaussian mechanism at an integer order (Mironov et al. 2019) """
+    if sample_rate == 0:
+        return 0.
+    if sample_rate == 1.:
+        return order / (2 * noise_multiplier ** 2)
+
+    log_a = -np.inf
+    for k in range(order + 1):
+        log_term = math.lgamma(order + 1) - math.lgamma(k + 1) - math.lgamma(order - k + 1) \
+            + k * math.log(sample_rate) + (order - k) * math.log(1 - sample_rate) + (k * k - k) / (2 * noise_multiplier ** 2)
+        log_a = _log_add(log_a, log_term)
+    return log_a / (order - 1)
+
+
+class PrivacyAccountant(object):
+    """
+    Renyi DP accountant of every client across the rounds: each local step is a subsampled Gaussian mechanism
+    with sample rate batch_size / client size. The batches come from a shuffled sampler, not Poisson sampling,
+    the usual approximation of DP-SGD implementations.
+    """
+    def __init__(self, args):
+        self.args = args
+        self.rdp = {}
+        self.step_rdp = {}
+
+    def record(self, client, sample_rate, steps):
+        if sample_rate not in self.step_rdp:
+            self.step_rdp[sample_rate] = np.array([sampled_gaussian_rdp(sample_rate, self.args.dp_noise_multiplier, order)
+                                                   for order in RDP_ORDERS])
+        self.rdp[client] = self.rdp.get(client, 0.) + steps * self.step_rdp[sample_rate]
+
+    def epsilon(self, client):
+        if client not in self.rdp:
+            return 0.
+        orders = np.array(RDP_ORDERS, dtype=np.float64)
+        return float(np.min(self.rdp[client] + math.log(1 / self.args.dp_delta) / (orders - 1)))
+
+    def max_epsilon(self):
+        return max([self.epsilon(client) for client in self.rdp] or [0.])
+
+    def report(self, epoch):
+        epsilons = [self.epsilon(client) for client in self.rdp]
+        if not epsilons:
+            return
+        print('Privacy after round %d: epsilon max %.3f, mean %.3f over %d clients (delta %g)' % (
+            epoch, max(epsilons), np.mean(epsilons), len(epsilons), self.args.dp_delta))
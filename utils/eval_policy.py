@@ -0,0 +1,111 @@
+import math
+import weakref
+from statistics import NormalDist
+
+import numpy as np
+from torch.utils.data import DataLoader, SequentialSampler, Subset
+from utils.data_utils import eval_loader_kwargs
+from utils.util import inner_valid, valid
+
+
+def dataset_labels(dataset):
+    """ Targets of every sample of a val set, in index order """
+    if isinstance(dataset, Subset):
+        return dataset_labels(dataset.dataset)[np.asarray(dataset.indices)]
+    labels = dataset.labels
+    if isinstance(labels, dict):
+        # celeba / gldk23 / isic19: labels of the whole dataset keyed by image name
+        labels = [labels[name] for name in dataset.data]
+    return np.asarray(labels).reshape(len(dataset), -1)[:, 0]
+
+
+def stratified_indices(labels, fraction, seed):
+    """ The same fraction of every class (at least one sample each), fixed across the rounds """
+    rng = np.random.default_rng(seed)
+    indices = []
+    for label in np.unique(labels):
+        members = np.flatnonzero(labels == label)
+        indices.append(rng.choice(members, max(1, int(round(fraction * len(members)))), replace=False))
+    return np.sort(np.concatenate(indices))
+
+
+class EvalPolicy(object):
+    """
+    Adaptive evaluation: every round a client is scored on a stratified subsample of its val set, the full val
+    pass (and the central test pass behind a new best) only runs when the upper bound of the confidence interval
+    of the subsample accuracy reaches the best accuracy of the client, or at the checkpoint rounds (every
+    full_eval_every rounds and the last one). A round whose interval stays below the best cannot hold the
+    best model at the chosen confidence, the best model and its test accuracy are still decided by full
+    passes only. Skipped rounds record the subsample estimate as current val accuracy.
+    """
+    def __init__(self, args):
+        self.fraction = args.eval_subsample
+        self.full_eval_every = args.full_eval_every
+        self.z = NormalDist().inv_cdf(0.5 + args.eval_confidence / 2)
+        self.seed = args.seed
+        # per client val sets are rebuilt every round: the subsample loaders go away with them
+        self.subsample_loaders = weakref.WeakKeyDictionary()
+        self.subsampled = self.escalated = self.checkpoints = 0
+        print('============ Adaptive evaluation: %g of val at %g confidence, full pass every %d rounds ============' % (
+            self.fraction, args.eval_confidence, self.full_eval_every))
+
+    def subsample_loader(self, args, val_loader):
+        dataset = val_loader.dataset
+        if dataset not in self.subsample_loaders:
+            subset = Subset(dataset, stratified_indices(dataset_labels(dataset), self.fraction, self.seed).tolist())
+            self.subsample_loaders[dataset] = DataLoader(subset, sampler=SequentialSampler(subset), batch_size=val_loader.batch_size,
+                                                         **eval_loader_kwargs(args))
+        return self.subsample_loaders[dataset]
+
+    def upper_bound(self, accuracy, size, population):
+        """ Normal interval of a proportion sampled without replacement (finite population correction) """
+        correction = (population - size) / max(population - 1, 1)
+        return accuracy + self.z * math.sqrt(max(accuracy * (1 - accuracy), 1. / size) / size * correction)
+
+    def is_checkpoint(self, args, epoch):
+        last = epoch + 1 >= args.max_communication_rounds or \
+            args.global_step_per_client[args.proxy_clients[-1]] >= args.t_total[args.proxy_clients[-1]]
+        return last or (epoch + 1) % self.full_eval_every == 0
+
+    def evaluate(self, args, model, val_loader, test_loader, epoch):
+        if self.is_checkpoint(args, epoch):
+            self.checkpoints += 1
+            return valid(args, model, val_loader, test_loader, TestFlag=True)
+
+        loader = self.subsample_loader(args, val_loader)
+        accuracy, _ = inner_valid(args, model, loader)
+        upper = self.upper_bound(accuracy, len(loader.dataset), len(val_loader.dataset))
+        if upper > args.best_acc[args.single_client]:
+            print('Subsampled val acc %f (upper bound %f) may beat the best %f of client %s: full evaluation' % (
+                accuracy, upper, args.best_acc[args.single_client], args.single_client))
+            self.escalated += 1
+            return valid(args, model, val_loader, test_loader, TestFlag=True)
+
+        print('Subsampled val acc %f (upper bound %f) below the best %f of client %s: full evaluation skipped' % (
+            accuracy, upper, args.best_acc[args.single_client], args.single_client))
+        self.subsampled += 1
+        args.current_acc[args.single_client] = accuracy
+
+    def report(self):
+        print('Adaptive evaluation: %d subsampled only, %d escalated, %d checkpoint passes' % (
+            self.subsampled, self.escalated, self.checkpoints))
+
+
+def build_eval_policy(args):
+    """ Adaptive evaluation of the run (args.eval_policy), None when every round runs the full passes """
+    args.eval_policy = None
+    if args.eval_subsample < 1:
+        if args.num_classes == 1 or args.dataset == 'celeba':
+            # the best model of these runs is chosen on the val loss / a regression metric, not an accuracy
+            print('--eval_subsample needs an accuracy metric, full evaluation every round')
+        else:
+            args.eval_policy = EvalPolicy(args)
+    return args.eval_policy
+
+
+def evaluate_client(args, model, val_loader, test_loader, epoch):
+    """ valid() of args.single_client after round epoch, through the adaptive policy when there is one """
+    policy = getattr(args, 'eval_policy', None)
+    if policy is None:
+        return valid(args, model, val_loader, test_loader, TestFlag=True)
+    return policy.evaluate(args, model, val_loader, test_loader, epoch)
@@ -0,0 +1,160 @@
+import os
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.utils.data as data
+from torch.utils.data import DataLoader, SequentialSampler
+from utils.data_utils import DatasetFLViT, build_transform, loader_kwargs
+from utils.model_registry import find_architecture, get_submodule
+
+
+class _StopForward(Exception):
+    pass
+
+
+class TrainableTail(nn.Module):
+    """
+    The trainable suffix of a model whose prefix is frozen. It takes the cached prefix features as input:
+    the input of the classification head, or the tokens entering the last trainable_blocks blocks.
+    """
+    def __init__(self, model, head_path, trainable_blocks=0):
+        super(TrainableTail, self).__init__()
+        self.model = model
+        self.head_path = head_path
+        self.trainable_blocks = trainable_blocks
+
+    def forward(self, features):
+        if self.trainable_blocks == 0:
+            return get_submodule(self.model, self.head_path)(features)
+
+        x = self.model.blocks[-self.trainable_blocks:](features)
+        x = self.model.norm(x)
+        return self.model.forward_head(x)
+
+
+class CachedFeatureDataset(data.Dataset):
+    def __init__(self, features_path, labels_path):
+        super(CachedFeatureDataset, self).__init__()
+        self.features_path = features_path
+        self.labels = np.load(labels_path)
+        self.features = None
+
+    def __getitem__(self, index):
+        # opened lazily so every DataLoader worker maps the file itself
+        if self.features is None:
+            self.features = np.load(self.features_path, mmap_mode='r')
+        features = torch.from_numpy(np.asarray(self.features[index], dtype=np.float32))
+        return features, self.labels[index]
+
+    def __len__(self):
+        return len(self.labels)
+
+
+class FeatureCache(object):
+    """
+    Freeze a prefix of the network and compute its output once per sample. The features are stored in
+    memory mapped .npy files and shared by all the clients and rounds, only the TrainableTail is trained,
+    exchanged and averaged. The training images use the deterministic evaluation transform.
+    """
+    def __init__(self, args, model):
+        self.args = args
+        self.model = model
+        self.trainable_blocks = args.trainable_blocks
+        arch = find_architecture(args.FL_platform)
+
+        if self.trainable_blocks == 0:
+            self.capture_module = get_submodule(model, arch.head)
+            trainable_modules = [self.capture_module]
+        else:
+            if not (hasattr(model, 'blocks') and hasattr(model, 'norm') and hasattr(model, 'forward_head')):
+                raise ValueError('--trainable_blocks > 0 needs a model with a sequence of blocks (ViT, DeiT, MLP-Mixer, ResMLP, gMLP), '
+                                 'use --trainable_blocks 0 to train only the head of %s' % args.FL_platform)
+            self.capture_module = model.blocks[-self.trainable_blocks]
+            trainable_modules = list(model.blocks[-self.trainable_blocks:]) + [model.norm, get_submodule(model, arch.head)]
+            if hasattr(model, 'fc_norm'):
+                trainable_modules.append(model.fc_norm)
+
+        for param in model.parameters():
+            param.requires_grad = False
+        for module in trainable_modules:
+            for param in module.parameters():
+                param.requires_grad = True
+
+        self.tail = TrainableTail(model, arch.head, self.trainable_blocks)
+
+        norm = args.norm if args.norm else 'default'
+        self.cache_dir = os.path.join(args.feature_cache_dir, '%s_%s_pretrained_%s_img_%d_blocks_%d' % (
+            arch.key, norm, args.pretrained, args.img_size, self.trainable_blocks), args.dataset, args.split_type)
+        if getattr(args, 'partition_file', None):
+            # the clients of every partition are named train_0, train_1...: one cache per partition
+            self.cache_dir = os.path.join(self.cache_dir, os.path.splitext(os.path.basename(args.partition_file))[0])
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        num_trainable = sum(p.numel() for p in model.parameters() if p.requires_grad)
+        print('============ Frozen backbone: training %2.2fM of %2.2fM parameters ============' % (
+            num_trainable / 1000000, sum(p.numel() for p in model.parameters()) / 1000000))
+
+    def features(self, x):
+        captured = {}
+
+        def hook(module, inputs):
+            captured['features'] = inputs[0]
+            raise _StopForward()
+
+        handle = self.capture_module.register_forward_pre_hook(hook)
+        try:
+            self.model(x)
+        except _StopForward:
+            pass
+        finally:
+            handle.remove()
+        return captured['features']
+
+    def _cache_name(self, phase):
+        per_client_val = self.args.dataset in ['celeba', 'gldk23', 'isic19'] and self.args.split_type == 'real'
+        if phase == 'train' or (phase == 'val' and per_client_val):
+            return '%s_%s' % (phase, os.path.basename(str(self.args.single_client)))
+        return phase
+
+    def dataset(self, loaded_npy, phase):
+        name = self._cache_name(phase)
+        features_path = os.path.join(self.cache_dir, name + '_features.npy')
+        labels_path = os.path.join(self.cache_dir, name + '_labels.npy')
+
+        if not os.path.exists(features_path):
+            image_set = DatasetFLViT(self.args, loaded_npy, phase=phase)
+            # random augmentations can not be cached, every phase uses the evaluation transform
+            image_set.transform = build_transform(self.args, 'test')
+            self._build(image_set, features_path, labels_path)
+
+        return CachedFeatureDataset(features_path, labels_path)
+
+    def _build(self, image_set, features_path, labels_path):
+        print('Computing frozen features of', len(image_set), 'samples to', features_path)
+        loader = DataLoader(image_set, sampler=SequentialSampler(image_set), batch_size=self.args.batch_size,
+                            **loader_kwargs(self.args))
+        self.model.to(self.args.device).eval()
+
+        features_file, labels = None, []
+        # per process temporary files: distributed ranks may build the same cache concurrently
+        tmp_path = features_path[:-len('.npy')] + '_tmp_%d.npy' % os.getpid()
+        tmp_labels_path = labels_path[:-len('.npy')] + '_tmp_%d.npy' % os.getpid()
+        start = 0
+        with torch.no_grad():
+            for x, y in loader:
+                features = self.features(x.to(self.args.device)).cpu().numpy()
+                if features_file is None:
+                    features_file = np.lib.format.open_memmap(
+                        tmp_path, mode='w+', dtype=np.float16, shape=(len(image_set),) + features.shape[1:])
+                features_file[start:start + len(features)] = features
+                labels.append(np.asarray(y).astype('int64'))
+                start += len(features)
+
+        features_file.flush()
+        del features_file
+        np.save(tmp_labels_path, np.concatenate(labels))
+        os.replace(tmp_labels_path, labels_path)
+        # renamed last, an interrupted run never leaves a truncated cache behind
+        os.replace(tmp_path, features_path)
+        self.model.train()
@@ -0,0 +1,94 @@
+import torch
+
+
+def enable_grad_checkpointing(model):
+    """ Activation checkpointing on the backbone blocks (timm models), the block activations are recomputed in backward """
+    if hasattr(model, 'set_grad_checkpointing'):
+        model.set_grad_checkpointing(True)
+        return True
+    print('============ %s does not support gradient checkpointing, only micro-batching is used ============' % type(model).__name__)
+    return False
+
+
+def activation_nbytes_per_sample(model, sample, device, probe_batch=2):
+    """
+    Bytes saved for backward per sample, measured with saved_tensors_hooks on a small probe batch. Parameters
+    saved by the layers are not counted, storages shared by several saved tensors are counted once.
+    """
+    param_storages = {param.untyped_storage().data_ptr() for param in model.parameters()}
+    saved = {}
+
+    def pack(tensor):
+        storage = tensor.untyped_storage()
+        if storage.data_ptr() not in param_storages:
+            saved[storage.data_ptr()] = storage.nbytes()
+        return tensor
+
+    # the probe must not change the batch norm statistics of the model
+    buffers = {name: buffer.clone() for name, buffer in model.named_buffers()}
+    was_training = model.training
+    model.train()
+
+    x = sample.unsqueeze(0).expand(probe_batch, *sample.shape).contiguous().to(device)
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        output = model(x)
+    del output
+
+    with torch.no_grad():
+        for name, buffer in model.named_buffers():
+            buffer.copy_(buffers[name])
+    model.train(was_training)
+    return sum(saved.values()) / probe_batch
+
+
+def plan_micro_batches(args, model, sample):
+    """
+    Memory budget mode: enable checkpointing and pick the largest micro-batch whose activations fit in
+    --memory_budget_mb next to the weights, gradients and optimizer state. The local loop accumulates the
+    gradients of the micro-batches, so the effective batch size stays args.batch_size.
+    """
+    if args.grad_checkpointing or args.memory_budget_mb > 0:
+        enable_grad_checkpointing(model)
+
+    if args.micro_batch_size > 0 or args.memory_budget_mb <= 0:
+        args.micro_batch_size = min(args.micro_batch_size, args.batch_size)
+        return args.micro_batch_size
+
+    states_per_param = 2 if args.optimizer_type != 'sgd' else 1
+    fixed_nbytes = sum(p.numel() * p.element_size() for p in model.parameters())
+    fixed_nbytes += (1 + states_per_param) * sum(p.numel() * p.element_size() for p in model.parameters() if p.requires_grad)
+
+    per_sample = activation_nbytes_per_sample(model, sample, args.device)
+    available = args.memory_budget_mb * 2 ** 20 - fixed_nbytes
+    if available < per_sample:
+        print('============ Memory budget of %dMB is below the weights + one sample (%2.2fMB), using micro-batches of 1 ============' % (
+            args.memory_budget_mb, (fixed_nbytes + per_sample) / 2 ** 20))
+    args.micro_batch_size = int(max(1, min(args.batch_size, available // max(per_sample, 1))))
+
+    print('============ Memory budget %dMB: %2.2fMB of activations per sample, micro-batch %d of %d (%d accumulation steps) ============' % (
+        args.memory_budget_mb, per_sample / 2 ** 20, args.micro_batch_size, args.batch_size,
+        -(-args.batch_size // args.micro_batch_size)))
+    return args.micro_batch_size
+
+
+def forward_backward(args, model, loss_fct, x, y, extra_loss=None):
+    """
+    Forward and backward of one batch, split in micro-batches of args.micro_batch_size (0: the whole batch).
+    Each micro-batch loss is weighted by its share of the batch, so the accumulated gradients equal the ones of
+    the full batch. extra_loss (e.g. the FedProx proximal term) does not depend on the data and is added once.
+    Returns the detached batch loss.
+    """
+    micro_batch_size = getattr(args, 'micro_batch_size', 0) or x.shape[0]
+
+    total_loss = 0.
+    for x_micro, y_micro in zip(x.split(micro_batch_size), y.split(micro_batch_size)):
+        predict = model(x_micro)
+        loss = loss_fct(predict.view(-1, args.num_classes), y_micro.view(-1)) * (x_micro.shape[0] / x.shape[0])
+        loss.backward()
+        total_loss += loss.detach()
+
+    if extra_loss is not None:
+        loss = extra_loss()
+        loss.backward()
+        total_loss += loss.detach()
+    return total_loss
@@ -0,0 +1,352 @@
+import os
+import time
+from collections import namedtuple
+
+import torch
+import torch.nn as nn
+
+try:
+    from safetensors.torch import load_file as safetensors_load_file
+    from safetensors.torch import save_model as safetensors_save_model
+except ImportError:
+    safetensors_load_file = None
+    safetensors_save_model = None
+
+
+# key: substring matched against args.FL_platform
+# norms: supported values of args.norm ('' is the default architecture)
+# head: dotted path of the classification layer that is replaced to match args.num_classes
+# channels_last: conv-heavy families that benefit from the channels_last memory format
+Architecture = namedtuple('Architecture', ['key', 'norms', 'head', 'builder', 'channels_last'])
+
+
+def _resnet(args, pretrained):
+    if 'LN' in args.norm:
+        print('Architecture: ResNet-50 with LN')
+        import torchvision.models as torch_models
+        model = torch_models.resnet50(norm_layer=nn.LayerNorm)
+        if pretrained:
+            # load BN weights from checkpoint, incompatible keys will be discarded
+            checkpoint = 'additional_weights/resnet50-0676ba61.pth'
+            model.load_state_dict(torch.load(checkpoint, map_location='cpu'), strict=False)
+
+    elif 'GN' in args.norm:
+        print('Architecture: ResNet-50 with GN')
+        from timm.models import resnet50_gn
+        model = resnet50_gn(pretrained=pretrained)
+
+    else:
+        print('Architecture: ResNet-50')
+        from timm.models import resnet50
+        model = resnet50(pretrained=pretrained)
+    return model
+
+
+def _efficientnet(args, pretrained):
+    print('Architecture: EfficientNet-B5')
+    from timm.models import efficientnet_b5
+    return efficientnet_b5(pretrained=pretrained)
+
+
+def _convnext(args, pretrained):
+    print('Architecture: ConvNeXt-tiny')
+    from timm.models import convnext_tiny
+    return convnext_tiny(pretrained=pretrained)
+
+
+def _maxvit(args, pretrained):
+    print('Architecture: MaxViT-tiny')
+    from timm.models.maxxvit import maxvit_tiny_rw_224
+    return maxvit_tiny_rw_224(pretrained=pretrained)
+
+
+def _mobilevit(args, pretrained):
+    print('Architecture: MobileViT-S')
+    from timm.models.mobilevit import mobilevit_s
+    return mobilevit_s(pretrained=pretrained)
+
+
+def _vit(args, pretrained):
+    print('Architecture: ViT-small')
+    from timm.models.vision_transformer import vit_small_patch16_224
+    return vit_small_patch16_224(pretrained=pretrained)
+
+
+def _deit(args, pretrained):
+    print('Architecture: DeiT-small')
+    from timm.models.deit import deit_small_patch16_224
+    return deit_small_patch16_224(pretrained=pretrained)
+
+
+def _swin_v1(args, pretrained):
+    print('Architecture: Swin-V1-tiny')
+    from timm.models.swin_transformer import swin_tiny_patch4_window7_224
+    return swin_tiny_patch4_window7_224(pretrained=pretrained)
+
+
+def _swin_v2(args, pretrained):
+    print('Architecture: Swin-V2-tiny')
+    from timm.models.swin_transformer_v2_cr import swinv2_cr_tiny_ns_224
+    return swinv2_cr_tiny_ns_224(pretrained=pretrained)
+
+
+def _convmixer(args, pretrained):
+    print('Architecture: ConvMixer-768_32')
+    from timm.models.convmixer import convmixer_768_32
+    return convmixer_768_32(pretrained=pretrained)
+
+
+def _caformer(args, pretrained):
+    print('Architecture: CAFormer-S18')
+    from metaformer.metaformer_baselines import caformer_s18
+    return caformer_s18(pretrained=pretrained)
+
+
+def _convformer(args, pretrained):
+    print('Architecture: ConvFormer-S18')
+    from metaformer.metaformer_baselines import convformer_s18
+    return convformer_s18(pretrained=pretrained)
+
+
+def _poolformer(args, pretrained):
+    if 'LN' in args.norm:
+        print('Architecture: Poolformer-S12 with LN')
+        from poolformer.models.poolformer import poolformer_s12
+        from poolformer.models.poolformer import LayerNormChannel
+        model = poolformer_s12(norm_layer=LayerNormChannel)
+        if pretrained:
+            model.load_state_dict(torch.load('additional_weights/poolformer_ln_s12.pth.tar', map_location='cpu'))
+
+    elif 'BN' in args.norm:
+        print('Architecture: Poolformer-S12 with BN')
+        from poolformer.models.poolformer import poolformer_s12
+        model = poolformer_s12(norm_layer=torch.nn.BatchNorm2d)
+        if pretrained:
+            model.load_state_dict(torch.load('additional_weights/poolformer_bn_s12.pth.tar', map_location='cpu'))
+
+    elif 'GN' in args.norm:
+        print('Architecture: Poolformer-S12 with GN')
+        from poolformer.models.poolformer import poolformer_s12
+        from utils.architectures_modifications import poolformer_to_group_norm
+        model = poolformer_s12()
+        if pretrained:
+            model.load_state_dict(torch.load('additional_weights/poolformer_s12.pth.tar', map_location='cpu'), strict=True)
+        poolformer_to_group_norm(model)
+
+    else:
+        print('Architecture: PoolFormer-S36')
+        from timm.models.metaformer import poolformer_s36
+        model = poolformer_s36(pretrained=pretrained)
+    return model
+
+
+def _coatnet(args, pretrained):
+    if 'BN' in args.norm:
+        print('Architecture: CoAtNet-0 with BN only')
+        from timm.models.maxxvit import coatnet_bn_0_rw_224
+        model = coatnet_bn_0_rw_224(pretrained=pretrained)
+
+    elif 'GN' in args.norm:
+        print('Architecture: CoAtNet-0 with GN only')
+        from timm.models.maxxvit import coatnet_bn_0_rw_224
+        from utils.architectures_modifications import coatnet_to_group_norm
+        model = coatnet_bn_0_rw_224(pretrained=pretrained)
+        coatnet_to_group_norm(model)
+
+    else:
+        print('Architecture: CoAtNet-0')
+        from timm.models.maxxvit import coatnet_0_rw_224
+        model = coatnet_0_rw_224(pretrained=pretrained)
+    return model
+
+
+def _identityformer(args, pretrained):
+    print('Architecture: IdentityFormer-S36')
+    from metaformer.metaformer_baselines import identityformer_s36
+    return identityformer_s36(pretrained=pretrained)
+
+
+def _randformer(args, pretrained):
+    print('Architecture: RandFormer-S36')
+    from metaformer.metaformer_baselines import randformer_s36
+    return randformer_s36(pretrained=pretrained)
+
+
+def _riformer(args, pretrained):
+    print('Architecture: RIFormer-S36')
+    from mmpretrain import get_model
+    return get_model("riformer-s36_in1k", pretrained=pretrained)
+
+
+def _resmlp(args, pretrained):
+    print('Architecture: ResMLP-24')
+    from timm.models.mlp_mixer import resmlp_24_224
+    return resmlp_24_224(pretrained=pretrained)
+
+
+def _gmlp(args, pretrained):
+    print('Architecture: GMLP-S16')
+    from timm.models.mlp_mixer import gmlp_s16_224
+    return gmlp_s16_224(pretrained=pretrained)
+
+
+def _mlpmixer(args, pretrained):
+    print('Architecture: MLPMixer-B16')
+    from timm.models.mlp_mixer import mixer_b16_224
+    return mixer_b16_224(pretrained=pretrained)
+
+
+def _mobilenetv3(args, pretrained):
+    print('Architecture: MobileNet-V3-small')
+    from timm.models.mobilenetv3 import mobilenetv3_small_100
+    return mobilenetv3_small_100(pretrained=pretrained)
+
+
+def _shufflenetv2(args, pretrained):
+    print('Architecture: ShuffleNetV2-X1')
+    import torchvision.models as torch_models
+    return torch_models.shufflenet_v2_x1_0(weights='DEFAULT' if pretrained else None)
+
+
+# Order matters: the first key contained in args.FL_platform wins (e.g. MaxViT and MobileViT before ViT).
+ARCHITECTURES = [
+    Architecture('ResNet', ('', 'LN', 'GN'), 'fc', _resnet, True),
+    Architecture('EfficientNet', ('',), 'classifier', _efficientnet, True),
+    Architecture('ConvNeXt', ('',), 'head.fc', _convnext, True),
+    Architecture('MaxViT', ('',), 'head.fc', _maxvit, False),
+    Architecture('MobileViT', ('',), 'head.fc', _mobilevit, True),
+    Architecture('ViT', ('',), 'head', _vit, False),
+    Architecture('DeiT', ('',), 'head', _deit, False),
+    Architecture('Swin-V1', ('',), 'head.fc', _swin_v1, False),
+    Architecture('Swin-V2', ('',), 'head.fc', _swin_v2, False),
+    Architecture('ConvMixer', ('',), 'head', _convmixer, True),
+    Architecture('CAFormer', ('',), 'head.fc2', _caformer, False),
+    Architecture('ConvFormer', ('',), 'head.fc2', _convformer, False),
+    Architecture('PoolFormer', ('', 'LN', 'BN', 'GN'), 'head.fc', _poolformer, False),
+    Architecture('CoAtNet', ('', 'BN', 'GN'), 'head.fc', _coatnet, True),
+    Architecture('IdentityFormer', ('',), 'head', _identityformer, False),
+    Architecture('RandFormer', ('',), 'head', _randformer, False),
+    Architecture('RIFormer', ('',), 'head.fc', _riformer, False),
+    Architecture('ResMLP', ('',), 'head', _resmlp, False),
+    Architecture('GMLP', ('',), 'head', _gmlp, False),
+    Architecture('MLPMixer', ('',), 'head', _mlpmixer, False),
+    Architecture('MobileNetV3', ('',), 'classifier', _mobilenetv3, True),
+    Architecture('ShuffleNetV2', ('',), 'fc', _shufflenetv2, True),
+]
+
+
+def find_architecture(FL_platform):
+    for arch in ARCHITECTURES:
+        if arch.key in FL_platform:
+            return arch
+    raise ValueError("Unknown architecture for FL platform %s, options: %s" %
+                     (FL_platform, ', '.join(arch.key for arch in ARCHITECTURES)))
+
+
+def get_submodule(model, path):
+    module = model
+    for attr in path.split('.'):
+        module = getattr(module, attr)
+    return module
+
+
+def replace_head(model, path, num_classes):
+    parent_path, _, attr = path.rpartition('.')
+    parent = get_submodule(model, parent_path) if parent_path else model
+    old_head = getattr(parent, attr)
+    setattr(parent, attr, nn.Linear(old_head.in_features, num_classes))
+
+
+def snapshot_path(args, arch):
+    norm = args.norm if args.norm else 'default'
+    file_name = '%s_%s_classes_%d_pretrained_%s' % (arch.key, norm, args.num_classes, args.pretrained)
+    extension = '.safetensors' if safetensors_load_file is not None else '.pth'
+    return os.path.join(args.model_cache_dir, file_name + extension)
+
+
+def save_snapshot(model, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp%d' % os.getpid()
+    if safetensors_save_model is not None:
+        safetensors_save_model(model, tmp_path)
+    else:
+        torch.save(model.state_dict(), tmp_path)
+    # atomic rename so that concurrent runs never read a half written snapshot
+    os.replace(tmp_path, path)
+
+
+def load_snapshot(model, path, skip_prefix=None):
+    """ Load the snapshot into model, False when it is unreadable or does not match the model (besides the skip_prefix head) """
+    try:
+        if path.endswith('.safetensors'):
+            # tensors are memory mapped and only paged in when copied into the model
+            state_dict = safetensors_load_file(path)
+        else:
+            state_dict = torch.load(path, map_location='cpu', mmap=True)
+    except Exception as error:
+        # truncated or corrupted file: torch / safetensors raise their own error types
+        print('Unreadable model snapshot %s (%s: %s)' % (path, type(error).__name__, error))
+        return False
+
+    if skip_prefix is not None:
+        state_dict = {k: v for k, v in state_dict.items() if not k.startswith(skip_prefix + '.')}
+    model_state = model.state_dict()
+    expected = {k for k in model_state if skip_prefix is None or not k.startswith(skip_prefix + '.')}
+    missing, unexpected = expected - set(state_dict), set(state_dict) - expected
+    # safetensors stores tied tensors once, under one of their names
+    stored = {model_state[k].data_ptr() for k in state_dict if k in model_state}
+    missing = {k for k in missing if model_state[k].data_ptr() not in stored}
+    if missing or unexpected:
+        print('Stale model snapshot %s: %d missing, %d unexpected keys (e.g. %s)' % (
+            path, len(missing), len(unexpected), sorted(missing | unexpected)[0]))
+        return False
+    try:
+        model.load_state_dict(state_dict, strict=False)
+    except RuntimeError as error:
+        # same keys, different shapes
+        print('Stale model snapshot %s: %s' % (path, error))
+        return False
+    return True
+
+
+def create_model(args):
+    """
+    Build the model selected by args.FL_platform / args.norm with a head of args.num_classes outputs.
+    When args.model_cache_dir is set, the initialized weights are read from (or written to) a local
+    snapshot instead of downloading pretrained weights and loading the additional checkpoints.
+    """
+    arch = find_architecture(args.FL_platform)
+    if args.norm is None:
+        args.norm = ''
+
+    cache_dir = getattr(args, 'model_cache_dir', None)
+    path = snapshot_path(args, arch) if cache_dir else None
+
+    model = None
+    if path is not None and os.path.exists(path):
+        # the skeleton consumes the same random numbers as the pretrained build, so the new head
+        # is initialized identically for a given seed and it is not taken from the snapshot
+        rng_state = torch.get_rng_state()
+        model = arch.builder(args, pretrained=False)
+        replace_head(model, arch.head, args.num_classes)
+        if load_snapshot(model, path, skip_prefix=arch.head):
+            print('Loaded model snapshot from', path)
+        else:
+            # rebuilt from the same random state, then the snapshot is written again
+            torch.set_rng_state(rng_state)
+            model = None
+
+    if model is None:
+        model = arch.builder(args, pretrained=args.pretrained)
+        replace_head(model, arch.head, args.num_classes)
+        if path is not None:
+            save_snapshot(model, path)
+            print('Saved model snapshot to', path)
+
+    return model
+
+
+def time_model_creation(args):
+    start = time.perf_counter()
+    model = create_model(args)
+    return model, time.perf_counter() - start
@@ -0,0 +1,183 @@
+import os
+import time
+from copy import copy
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+from utils.model_registry import create_model
+from utils.param_groups import build_param_policy
+from utils.memory_budget import forward_backward
+from utils.resource_planner import cpu_topology, pack_runs, _set_affinity
+from utils.util import Partial_Client_Selection, AverageMeter, simple_accuracy, metric_evaluation, save_model
+
+
+class SweepRun(object):
+    """
+    One FedAVG run of a sweep: its own args (architecture, seed, learning rate, metrics), client models,
+    optimizers and schedulers. The data of the rounds comes from the sweep, shared with the other runs.
+    """
+    def __init__(self, args, FL_platform, seed, learning_rate):
+        self.args = run_args = copy(args)
+        run_args.FL_platform, run_args.seed, run_args.learning_rate = FL_platform, seed, learning_rate
+        run_args.name_run = '%s_%s_%s_lr_%g_Seed_%d' % (FL_platform, args.dataset, args.split_type, learning_rate, seed)
+        run_args.output_dir = os.path.join(args.output_dir, run_args.name_run)
+        os.makedirs(run_args.output_dir, exist_ok=True)
+        # metrics of this run only
+        run_args.best_acc, run_args.current_acc = dict(args.best_acc), dict(args.current_acc)
+        run_args.current_test_acc, run_args.best_eval_loss = dict(args.current_test_acc), dict(args.best_eval_loss)
+        run_args.record_val_acc, run_args.record_test_acc = args.record_val_acc.copy(), args.record_test_acc.copy()
+
+        torch.manual_seed(seed)
+        model = create_model(run_args)
+        run_args.param_policy = build_param_policy(run_args, model)
+        self.model_all, self.optimizer_all, self.scheduler_all = Partial_Client_Selection(run_args, model)
+        self.model_avg = model.cpu()
+        self.loss_fct = torch.nn.CrossEntropyLoss()
+        self.cost = 0.
+
+    def start_client(self, client, proxy, weight):
+        self.args.single_client = client
+        self.args.clients_weightes[proxy] = weight
+        self.model_all[proxy].to(self.args.device).train()
+        if self.args.decay_type == 'step':
+            self.scheduler_all[proxy].step()
+
+    def train_step(self, proxy, x, y):
+        args, model, optimizer = self.args, self.model_all[proxy], self.optimizer_all[proxy]
+        args.global_step_per_client[proxy] += 1
+        loss = forward_backward(args, model, self.loss_fct, x, y)
+        if args.grad_clip:
+            torch.nn.utils.clip_grad_norm_(model.parameters(), args.max_grad_norm)
+        optimizer.step()
+        optimizer.zero_grad()
+        if not args.decay_type == 'step':
+            self.scheduler_all[proxy].step()
+        args.learning_rate_record[proxy].append(optimizer.param_groups[0]['lr'])
+        return loss
+
+    def predict(self, proxy, x, y):
+        """ Predictions and loss of one evaluation batch """
+        model = self.model_all[proxy]
+        with torch.no_grad():
+            logits = model(x)
+        if self.args.num_classes == 1:
+            return logits.cpu().numpy(), None
+        return torch.argmax(logits, dim=-1).cpu().numpy(), self.loss_fct(logits, y).item()
+
+    def finished(self):
+        return self.args.global_step_per_client[self.args.proxy_clients[-1]] >= self.args.t_total[self.args.proxy_clients[-1]]
+
+
+def measure_cost(run, x, y, repeats=2):
+    """ Seconds of a training step of the architecture of run (the weights and buffers are restored) """
+    model = run.model_avg.to(x.device).train()
+    state = {name: value.clone() for name, value in model.state_dict().items()}
+    for step in range(repeats + 1):
+        if step == 1:
+            start = time.time()
+        run.loss_fct(model(x), y).backward()
+        model.zero_grad(set_to_none=True)
+    model.load_state_dict(state)
+    model.cpu()
+    return (time.time() - start) / repeats
+
+
+def _pin_slot(cpus):
+    # linux affinity of the calling thread; with the OpenMP backend the intra-op thread count is per thread as well
+    _set_affinity(cpus)
+    torch.set_num_threads(max(1, len(cpus)))
+
+
+class SlotScheduler(object):
+    """
+    Runs of the sweep packed onto the cpu cores: a slot is a thread pinned to its own physical cores, with as many
+    intra-op threads as cores, that steps its runs one after the other on every shared batch. The slots work on
+    the same batch concurrently. The packing comes from the cost of a training step of every architecture.
+    """
+    def __init__(self, args, runs, x, y):
+        self.runs = runs
+        for run in runs:
+            run.cost = measure_cost(run, x, y)
+        if args.device.type == 'cuda':
+            # one device: the slots only serialize the kernels, the runs are stepped in turn
+            self.plan = [(list(range(len(runs))), [])]
+        else:
+            self.plan = pack_runs(cpu_topology(), [run.cost for run in runs])
+        self.slots = [ThreadPoolExecutor(max_workers=1, initializer=_pin_slot, initargs=(cpus,)) if cpus else
+                      ThreadPoolExecutor(max_workers=1) for _, cpus in self.plan]
+        for indices, cpus in self.plan:
+            print('Slot of %d cores: %s' % (len(cpus), ', '.join('%s (%.3fs / step)' % (runs[index].args.name_run, runs[index].cost)
+                                                                  for index in indices)))
+
+    def map(self, function, *args, subset=None):
+        """ function(run, *args) for every run (or the run indices of subset), the slots in parallel; results in run order """
+        selected = range(len(self.runs)) if subset is None else subset
+
+        def run_slot(indices):
+            return [(index, function(self.runs[index], *args)) for index in indices if index in selected]
+
+        futures = [slot.submit(run_slot, indices) for slot, (indices, _) in zip(self.slots, self.plan)]
+        results = {}
+        for future in futures:
+            results.update(future.result())
+        return [results[index] for index in selected]
+
+    def close(self):
+        for slot in self.slots:
+            slot.shutdown(wait=True)
+
+
+def shared_inner_valid(scheduler, proxy, loader, subset=None):
+    """ inner_valid of the client model of every run (of subset), each batch of loader is decoded once for all the runs """
+    runs = scheduler.runs if subset is None else [scheduler.runs[index] for index in subset]
+    predictions = [[] for _ in runs]
+    losses = [AverageMeter() for _ in runs]
+    labels = []
+    device = runs[0].args.device
+    for run in runs:
+        run.model_all[proxy].to(device).eval()
+    for x, y in loader:
+        x, y = x.to(device), y.to(device)
+        for index, (preds, loss) in enumerate(scheduler.map(SweepRun.predict, proxy, x, y, subset=subset)):
+            predictions[index].append(preds)
+            if loss is not None:
+                losses[index].update(loss)
+        labels.append(y.cpu().numpy())
+
+    labels = np.concatenate(labels)
+    results = []
+    for run, preds, loss in zip(runs, predictions, losses):
+        run.model_all[proxy].train()
+        preds = np.concatenate(preds)
+        if run.args.num_classes == 1:
+            from sklearn.metrics import mean_squared_error
+            results.append((mean_squared_error(preds, labels), loss))
+        else:
+            results.append((simple_accuracy(preds, labels), loss))
+    return results
+
+
+def shared_valid(scheduler, proxy, val_loader, test_loader):
+    """ valid(..., TestFlag=True) of every run: one val pass for all, one test pass for the runs with a new best """
+    improved = []
+    for index, (run, (eval_result, eval_losses)) in enumerate(zip(scheduler.runs, shared_inner_valid(scheduler, proxy, val_loader))):
+        args = run.args
+        if args.dataset == 'celeba':
+            better = args.best_eval_loss[args.single_client] > eval_losses.val
+        else:
+            better = metric_evaluation(args, eval_result)
+        if better:
+            if args.save_model_flag:
+                save_model(args, run.model_all[proxy])
+            args.best_acc[args.single_client] = eval_result
+            args.best_eval_loss[args.single_client] = eval_losses.val
+            improved.append(index)
+        print('%s: val %f, best %f of client %s' % (args.name_run, eval_result, args.best_acc[args.single_client], args.single_client))
+        args.current_acc[args.single_client] = eval_result
+
+    if improved:
+        for index, (test_result, _) in zip(improved, shared_inner_valid(scheduler, proxy, test_loader, subset=improved)):
+            args = scheduler.runs[index].args
+            args.current_test_acc[args.single_client] = test_result
+            print('%s: we also update the test acc of client %s as %f' % (args.name_run, args.single_client, test_result))
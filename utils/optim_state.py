@@ -0,0 +1,77 @@
+from collections import namedtuple
+
+import torch
+import torch.nn.functional as F
+from utils.util import optimizer_to
+
+# compressed copy of an optimizer state tensor, kept on the host while the client is idle
+PackedTensor = namedtuple('PackedTensor', ['data', 'scale', 'shape', 'dtype', 'numel'])
+
+# second moments are non-negative and span many orders of magnitude, a linear int8 grid loses the small
+# entries (and the step size is 1/sqrt of them) so they are kept in bf16 even in int8 mode
+SECOND_MOMENT_KEYS = ('exp_avg_sq', 'max_exp_avg_sq')
+
+
+def pack_tensor(tensor, precision, block_size=2048):
+    tensor = tensor.detach()
+    if precision == 'bf16':
+        return PackedTensor(tensor.to('cpu', torch.bfloat16), None, tensor.shape, tensor.dtype, tensor.numel())
+
+    # int8 with one absmax scale per block of block_size values
+    flat = tensor.float().flatten()
+    pad = (-flat.numel()) % block_size
+    if pad:
+        flat = F.pad(flat, (0, pad))
+    blocks = flat.view(-1, block_size)
+    scale = blocks.abs().amax(dim=1, keepdim=True).clamp(min=1e-12) / 127.
+    data = torch.round(blocks / scale).to(torch.int8)
+    return PackedTensor(data.cpu(), scale.cpu(), tensor.shape, tensor.dtype, tensor.numel())
+
+
+def unpack_tensor(packed, device):
+    if packed.scale is None:
+        return packed.data.to(device=device, dtype=packed.dtype).view(packed.shape)
+
+    data = packed.data.to(device)
+    values = (data.float() * packed.scale.to(device)).flatten()[:packed.numel]
+    return values.view(packed.shape).to(packed.dtype)
+
+
+def pack_optimizer_state(optimizer, precision='fp32', block_size=2048):
+    """
+    Move the optimizer state of an idle client to the host. With bf16 or int8 the momentum / moment buffers are
+    stored compressed, the optimizer can only be used again after unpack_optimizer_state.
+    """
+    if precision == 'fp32':
+        optimizer_to(optimizer, 'cpu')
+        return
+
+    for state in optimizer.state.values():
+        for key, value in state.items():
+            # scalars such as the Adam step count are kept as they are
+            if not isinstance(value, torch.Tensor) or not value.is_floating_point() or value.numel() <= 1:
+                continue
+            key_precision = 'bf16' if key in SECOND_MOMENT_KEYS else precision
+            state[key] = pack_tensor(value, key_precision, block_size)
+
+
+def unpack_optimizer_state(optimizer, device):
+    """ Expand the (possibly compressed) optimizer state of the client that is about to train on device """
+    for state in optimizer.state.values():
+        for key, value in state.items():
+            if isinstance(value, PackedTensor):
+                state[key] = unpack_tensor(value, device)
+    optimizer_to(optimizer, device)
+
+
+def optimizer_state_nbytes(optimizer):
+    nbytes = 0
+    for state in optimizer.state.values():
+        for value in state.values():
+            if isinstance(value, PackedTensor):
+                nbytes += value.data.numel() * value.data.element_size()
+                if value.scale is not None:
+                    nbytes += value.scale.numel() * value.scale.element_size()
+            elif isinstance(value, torch.Tensor):
+                nbytes += value.numel() * value.element_size()
+    return nbytes
@@ -0,0 +1,107 @@
+import re
+import time
+from collections import OrderedDict
+
+import torch
+import torch.nn as nn
+from utils.model_registry import find_architecture
+from utils.feature_cache import TrainableTail
+
+# global: averaged by the server and written back to every client
+# local: trained but never exchanged, every client keeps its own copy (e.g. FedBN style norm layers)
+# frozen: not trained and not exchanged
+GLOBAL, LOCAL, FROZEN = 'global', 'local', 'frozen'
+
+NORM_TYPES = (nn.modules.batchnorm._BatchNorm, nn.GroupNorm, nn.LayerNorm, nn.modules.instancenorm._InstanceNorm)
+
+
+def _norm_param_names(model):
+    names = set()
+    for module_name, module in model.named_modules():
+        # timm norm layers (LayerNorm2d, BatchNormAct2d, GroupNormAct2d, ...) subclass the torch ones
+        if isinstance(module, NORM_TYPES):
+            for param_name, _ in module.named_parameters(recurse=False):
+                names.add(module_name + '.' + param_name if module_name else param_name)
+    return names
+
+
+def build_param_policy(args, model):
+    """
+    Assign every parameter of model to the global, local or frozen group. --frozen_params (regex) also sets
+    requires_grad to False, so it has to run before the client models and optimizers are created.
+    """
+    frozen_regex = re.compile(args.frozen_params) if args.frozen_params else None
+    local_regex = re.compile(args.local_params) if args.local_params else None
+
+    group_names = {}
+    if 'norm' in args.local_groups:
+        group_names['norm'] = _norm_param_names(model)
+    if 'head' in args.local_groups:
+        # under --freeze_backbone the model is the TrainableTail, the modules of the architecture are under its .model
+        head = ('model.' if isinstance(model, TrainableTail) else '') + find_architecture(args.FL_platform).head
+        group_names['head'] = {name for name, _ in model.named_parameters() if name.startswith(head + '.')}
+    local_names = set().union(*group_names.values())
+
+    policy = OrderedDict()
+    for name, param in model.named_parameters():
+        if frozen_regex is not None and frozen_regex.search(name):
+            param.requires_grad = False
+
+        if not param.requires_grad:
+            policy[name] = FROZEN
+        elif name in local_names or (local_regex is not None and local_regex.search(name)):
+            policy[name] = LOCAL
+        else:
+            policy[name] = GLOBAL
+
+    for group, names in group_names.items():
+        if not any(policy[name] == LOCAL for name in names):
+            raise ValueError('--local_groups %s matches no trainable parameter of %s' % (group, args.FL_platform))
+    if local_regex is not None and LOCAL not in [policy[name] for name in policy if local_regex.search(name)]:
+        raise ValueError('--local_params %r matches no trainable parameter of %s' % (args.local_params, args.FL_platform))
+
+    nbytes = policy_nbytes(model, policy)
+    print('============ Parameter groups: global %2.2fMB, local %2.2fMB, frozen %2.2fMB ============' % (
+        nbytes[GLOBAL] / 2 ** 20, nbytes[LOCAL] / 2 ** 20, nbytes[FROZEN] / 2 ** 20))
+    args.global_param_nbytes = nbytes[GLOBAL]
+    return policy
+
+
+def policy_nbytes(model, policy):
+    nbytes = {GLOBAL: 0, LOCAL: 0, FROZEN: 0}
+    for name, param in model.named_parameters():
+        nbytes[policy[name]] += param.numel() * param.element_size()
+    return nbytes
+
+
+def is_global(args, name, param):
+    # without a policy (scripts that do not build one) every trainable parameter is global
+    policy = getattr(args, 'param_policy', None)
+    if policy is None:
+        return param.requires_grad
+    return policy.get(name) == GLOBAL
+
+
+def global_params(args, src, requires_name=False):
+    """ Same as trainable_params, restricted to the global group of args.param_policy """
+    if isinstance(src, torch.nn.Module):
+        src = src.state_dict(keep_vars=True)
+
+    keys, parameters = [], []
+    for name, param in src.items():
+        if is_global(args, name, param):
+            keys.append(name)
+            parameters.append(param)
+
+    if requires_name:
+        return keys, parameters
+    return parameters
+
+
+def aggregation_report(args, start_time, num_clients):
+    """ Print the time spent aggregating and the volume moved (client upload + server write back) """
+    nbytes = getattr(args, 'global_param_nbytes', None)
+    if nbytes is None:
+        return
+    print('Aggregation of %d clients: %2.2fMB moved in %.3fs' % (
+        num_clients, 2 * num_clients * nbytes / 2 ** 20, time.time() - start_time))
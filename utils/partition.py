@@ -0,0 +1,132 @@
+import json
+import os
+from collections import namedtuple
+
+import numpy as np
+
+# CSR layout: the samples of client k are pool[indices[offsets[k]:offsets[k + 1]]]
+# images / targets: the pool, filled when the partition is attached to a loaded dataset
+Partition = namedtuple('Partition', ['indices', 'offsets', 'meta', 'images', 'targets'])
+
+PARTITION_DATASETS = ['cifar10', 'pacs']
+
+
+def base_pool(data_all, source_split):
+    """ Every training sample of source_split, clients concatenated in sorted order """
+    split = data_all[source_split]
+    clients = sorted(key for key in split['data'].keys() if 'train' in key)
+    images = np.concatenate([split['data'][client] for client in clients])
+    targets = np.concatenate([np.asarray(split['target'][client]) for client in clients]).astype('int64')
+    return images, targets
+
+
+def dirichlet_partition(targets, num_clients, alpha, rng):
+    """ Label distribution skew: the share of each class held by every client follows Dir(alpha) """
+    client_of = np.empty(len(targets), dtype=np.int64)
+    for label in np.unique(targets):
+        samples = rng.permutation(np.flatnonzero(targets == label))
+        proportions = rng.dirichlet(np.full(num_clients, alpha))
+        bounds = np.floor(np.cumsum(proportions)[:-1] * len(samples)).astype(np.int64)
+        client_of[samples] = np.repeat(np.arange(num_clients), np.diff(np.concatenate([[0], bounds, [len(samples)]])))
+    return client_of
+
+
+def label_skew_partition(targets, num_clients, classes_per_client, rng):
+    """ Pathological non-IID: every client holds classes_per_client classes, each class is split evenly among its holders """
+    labels = np.unique(targets)
+    # cyclic assignment of a shuffled class sequence, every class has a holder as soon as num_clients * classes_per_client >= #classes
+    sequence = np.concatenate([rng.permutation(labels) for _ in range(-(-num_clients * classes_per_client // len(labels)))])
+    holders_of = sequence[:num_clients * classes_per_client].reshape(num_clients, classes_per_client)
+
+    client_of = np.full(len(targets), -1, dtype=np.int64)
+    for label in labels:
+        holders = np.flatnonzero((holders_of == label).any(axis=1))
+        samples = rng.permutation(np.flatnonzero(targets == label))
+        if len(holders) == 0:
+            holders = rng.choice(num_clients, 1)
+        client_of[samples] = holders[np.arange(len(samples)) * len(holders) // len(samples)]
+    return client_of
+
+
+def quantity_skew_partition(targets, num_clients, alpha, rng):
+    """ Quantity skew: IID labels, client sizes follow Dir(alpha) """
+    samples = rng.permutation(len(targets))
+    proportions = rng.dirichlet(np.full(num_clients, alpha))
+    bounds = np.floor(np.cumsum(proportions)[:-1] * len(samples)).astype(np.int64)
+    client_of = np.empty(len(targets), dtype=np.int64)
+    client_of[samples] = np.repeat(np.arange(num_clients), np.diff(np.concatenate([[0], bounds, [len(samples)]])))
+    return client_of
+
+
+def iid_partition(targets, num_clients, rng):
+    client_of = np.empty(len(targets), dtype=np.int64)
+    client_of[rng.permutation(len(targets))] = np.arange(len(targets)) % num_clients
+    return client_of
+
+
+def ensure_min_size(client_of, num_clients, min_size, rng):
+    """ Move random samples from the clients above min_size to the ones below, no donor drops below min_size """
+    if num_clients * min_size > len(client_of):
+        raise ValueError('%d clients with at least %d samples need more than the %d samples of the pool' % (
+            num_clients, min_size, len(client_of)))
+
+    counts = np.bincount(client_of, minlength=num_clients)
+    needy = np.flatnonzero(counts < min_size)
+    if len(needy) == 0:
+        return client_of
+
+    # rank of each sample inside its client (random order), samples ranked min_size or more can be donated
+    order = rng.permutation(len(client_of))
+    order = order[np.argsort(client_of[order], kind='stable')]
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    rank = np.arange(len(order)) - starts[client_of[order]]
+    donors = order[rank >= min_size]
+
+    receivers = np.repeat(needy, min_size - counts[needy])
+    client_of[rng.choice(donors, len(receivers), replace=False)] = receivers
+    return client_of
+
+
+def pack_partition(client_of, num_clients):
+    indices = np.argsort(client_of, kind='stable').astype(np.int32)
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(client_of, minlength=num_clients))]).astype(np.int64)
+    return indices, offsets
+
+
+def make_partition(targets, num_clients, method, alpha=0.5, classes_per_client=2, min_size=1, seed=0):
+    rng = np.random.default_rng(seed)
+    if method == 'dirichlet':
+        client_of = dirichlet_partition(targets, num_clients, alpha, rng)
+    elif method == 'label_skew':
+        client_of = label_skew_partition(targets, num_clients, classes_per_client, rng)
+    elif method == 'quantity_skew':
+        client_of = quantity_skew_partition(targets, num_clients, alpha, rng)
+    elif method == 'iid':
+        client_of = iid_partition(targets, num_clients, rng)
+    else:
+        raise ValueError('Unknown partition method %s' % method)
+
+    client_of = ensure_min_size(client_of, num_clients, min_size, rng)
+    return pack_partition(client_of, num_clients)
+
+
+def save_partition(path, indices, offsets, meta):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    np.savez(path, indices=indices, offsets=offsets, meta=np.array(json.dumps(meta)))
+
+
+def load_partition(path, data_all=None):
+    files = np.load(path)
+    meta = json.loads(str(files['meta']))
+    images, targets = base_pool(data_all, meta['source_split']) if data_all is not None else (None, None)
+    return Partition(files['indices'], files['offsets'], meta, images, targets)
+
+
+def partition_client_names(partition):
+    return ['train_%d' % client for client in range(len(partition.offsets) - 1)]
+
+
+def partition_client_data(partition, client_name):
+    client = int(client_name.split('_')[-1])
+    samples = partition.indices[partition.offsets[client]:partition.offsets[client + 1]]
+    return partition.images[samples], partition.targets[samples]
@@ -0,0 +1,216 @@
+import glob
+import json
+import os
+import time
+from functools import partial
+
+import torch
+from utils.model_registry import find_architecture
+
+
+def _parse_cpulist(text):
+    cpus = []
+    for part in text.strip().split(','):
+        if not part:
+            continue
+        if '-' in part:
+            start, end = part.split('-')
+            cpus.extend(range(int(start), int(end) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+
+def _read(path, default=None):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return default
+
+
+def cpu_topology():
+    """
+    CPUs this process may run on, grouped by NUMA node and by physical core (SMT siblings together),
+    read from sysfs. Falls back to one node with one core per logical cpu when sysfs is not available.
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        cpus = sorted(os.sched_getaffinity(0))
+    else:
+        cpus = list(range(os.cpu_count() or 1))
+    allowed = set(cpus)
+
+    nodes = []
+    for node_dir in sorted(glob.glob('/sys/devices/system/node/node[0-9]*')):
+        node_cpus = [cpu for cpu in _parse_cpulist(_read(os.path.join(node_dir, 'cpulist'), '')) if cpu in allowed]
+        if node_cpus:
+            nodes.append(node_cpus)
+    if not nodes:
+        nodes = [cpus]
+
+    cores = {}
+    for cpu in cpus:
+        topology_dir = '/sys/devices/system/cpu/cpu%d/topology' % cpu
+        key = (_read(os.path.join(topology_dir, 'physical_package_id'), '0'), _read(os.path.join(topology_dir, 'core_id'), str(cpu)))
+        cores.setdefault(key, []).append(cpu)
+
+    return {'cpus': cpus, 'nodes': nodes, 'cores': sorted(cores.values())}
+
+
+def heuristic_plan(topology, max_workers=8):
+    """
+    One logical cpu per physical core runs the intra-op threads of the training process, about one physical core
+    out of four (at most max_workers) is left to the DataLoader workers together with the SMT siblings.
+    parallel_clients is the number of NUMA nodes large enough to host a client process of their own.
+    """
+    cores = topology['cores']
+    num_workers = 0 if len(cores) <= 2 else min(max_workers, max(1, len(cores) // 4))
+
+    compute_cores = cores[:len(cores) - num_workers]
+    worker_cores = cores[len(cores) - num_workers:]
+    compute_cpus = [core[0] for core in compute_cores]
+    worker_cpus = [cpu for core in worker_cores for cpu in core] + [cpu for core in compute_cores for cpu in core[1:]]
+
+    return {
+        'intra_op_threads': len(compute_cpus),
+        'inter_op_threads': 1,
+        'num_workers': num_workers,
+        'compute_cpus': compute_cpus,
+        'worker_cpus': worker_cpus,
+        'parallel_clients': max(1, sum(1 for node in topology['nodes'] if len(node) >= 4)),
+    }
+
+
+def _time_step(model, x, y, repeats=3):
+    loss_fct = torch.nn.CrossEntropyLoss()
+    # first step warms up the allocator and the kernels
+    for step in range(repeats + 1):
+        if step == 1:
+            start = time.time()
+        loss = loss_fct(model(x), y)
+        loss.backward()
+        model.zero_grad(set_to_none=True)
+    return (time.time() - start) / repeats
+
+
+def calibrate(args, model, plan, batch_size=8):
+    """ Time a few training steps for several intra-op thread counts on the compute cpus and keep the fastest """
+    compute_cpus = plan['compute_cpus']
+    candidates = sorted({plan['intra_op_threads'], max(1, plan['intra_op_threads'] // 2), max(1, plan['intra_op_threads'] // 4)})
+
+    x = torch.randn(min(batch_size, args.batch_size), 3, args.img_size, args.img_size, device=args.device)
+    y = torch.randint(0, args.num_classes, (x.shape[0],), device=args.device)
+
+    # the probe must not change the batch norm statistics of the model
+    buffers = {name: buffer.clone() for name, buffer in model.named_buffers()}
+    was_training = model.training
+    model.train()
+
+    timings = {}
+    for threads in candidates:
+        torch.set_num_threads(threads)
+        _set_affinity(compute_cpus)
+        timings[threads] = _time_step(model, x, y)
+        print('Calibration: %d intra-op threads, %.3fs per step' % (threads, timings[threads]))
+
+    with torch.no_grad():
+        for name, buffer in model.named_buffers():
+            buffer.copy_(buffers[name])
+    model.train(was_training)
+
+    plan['intra_op_threads'] = min(timings, key=timings.get)
+    plan['calibration'] = {str(threads): seconds for threads, seconds in timings.items()}
+    return plan
+
+
+def _set_affinity(cpus):
+    if cpus and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpus)
+
+
+def pin_worker(worker_cpus, worker_id):
+    """ DataLoader worker_init_fn: workers run on their own cpus with a single intra-op thread """
+    _set_affinity(worker_cpus)
+    torch.set_num_threads(1)
+
+
+def apply_plan(args, plan):
+    torch.set_num_threads(plan['intra_op_threads'])
+    try:
+        torch.set_num_interop_threads(plan['inter_op_threads'])
+    except RuntimeError:
+        # can only be set before the first inter-op parallel work of the process
+        pass
+
+    args.num_workers = plan['num_workers']
+    args.worker_init_fn = partial(pin_worker, plan['worker_cpus']) if plan['worker_cpus'] else None
+    # the DataLoader workers are forked from this process and pin themselves afterwards
+    _set_affinity(plan['compute_cpus'][:plan['intra_op_threads']])
+
+
+def plan_path(args):
+    arch = find_architecture(args.FL_platform)
+    norm = args.norm if args.norm else 'default'
+    file_name = '%s_%s_img_%d_bs_%d.json' % (arch.key, norm, args.img_size, args.batch_size)
+    return os.path.join(args.resource_plan_dir, file_name)
+
+
+def plan_resources(args, model):
+    """
+    --resource_plan auto: reuse the plan saved for this architecture on this cpu topology, else compute the
+    heuristic plan. --resource_plan calibrate: also time the thread counts on the model and save the plan.
+    """
+    topology = cpu_topology()
+    path = plan_path(args)
+
+    plan = None
+    if args.resource_plan == 'auto' and os.path.exists(path):
+        with open(path) as f:
+            saved = json.load(f)
+        if saved.get('cpus') == topology['cpus']:
+            plan = saved
+            print('============ Resource plan loaded from %s ============' % path)
+
+    if plan is None:
+        plan = heuristic_plan(topology)
+        plan['cpus'] = topology['cpus']
+        plan['numa_nodes'] = len(topology['nodes'])
+        if args.resource_plan == 'calibrate':
+            plan = calibrate(args, model, plan)
+            os.makedirs(args.resource_plan_dir, exist_ok=True)
+            with open(path, 'w') as f:
+                json.dump(plan, f, indent=2)
+            print('============ Resource plan saved to %s ============' % path)
+
+    apply_plan(args, plan)
+    print('============ Resource plan: %d intra-op / %d inter-op threads, %d loader workers, %d cpus, %d NUMA nodes (%d parallel clients) ============' % (
+        plan['intra_op_threads'], plan['inter_op_threads'], plan['num_workers'], len(plan['cpus']), plan['numa_nodes'], plan['parallel_clients']))
+    args.resource_plan_info = plan
+    return plan
+
+
+def pack_runs(topology, costs):
+    """
+    Slots for runs that train side by side in one process: at most one slot per physical core, the runs are
+    assigned longest first to the least loaded slot, then the physical cores are shared between the slots in
+    proportion to their load (at least one each). Returns [(run indices, cpus)], one logical cpu per core.
+    """
+    cores = topology['cores']
+    num_slots = max(1, min(len(costs), len(cores)))
+    slots = [[] for _ in range(num_slots)]
+    loads = [0.] * num_slots
+    for index in sorted(range(len(costs)), key=lambda index: -costs[index]):
+        slot = loads.index(min(loads))
+        slots[slot].append(index)
+        loads[slot] += costs[index]
+
+    # one core each, the remaining cores go one by one to the slot with the highest load per core
+    counts = [1] * num_slots
+    for _ in range(len(cores) - num_slots):
+        counts[max(range(num_slots), key=lambda slot: loads[slot] / counts[slot])] += 1
+
+    plan, start = [], 0
+    for runs, count in zip(slots, counts):
+        plan.append((sorted(runs), [core[0] for core in cores[start:start + count]]))
+        start += count
+    return plan
@@ -0,0 +1,155 @@
+import os
+import time
+
+import numpy as np
+import torch
+
+
+class TensorUpdates(object):
+    """ Client updates kept as they are (lists of tensors aligned with the global parameters), read by column chunks """
+    def __init__(self, tensor_lists):
+        self.tensor_lists = [list(tensors.values()) if isinstance(tensors, dict) else list(tensors) for tensors in tensor_lists]
+        sizes = [tensor.numel() for tensor in self.tensor_lists[0]] if self.tensor_lists else []
+        self.offsets = np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64)
+        self.total = int(self.offsets[-1])
+
+    def __len__(self):
+        return len(self.tensor_lists)
+
+    def chunk(self, start, end):
+        """ (clients, end - start) float32 block of the flattened updates, only the slices of the chunk are copied """
+        block = torch.empty(len(self.tensor_lists), end - start)
+        for index in range(len(self.offsets) - 1):
+            low, high = max(start, self.offsets[index]), min(end, self.offsets[index + 1])
+            if low >= high:
+                continue
+            for row, tensors in enumerate(self.tensor_lists):
+                source = tensors[index].detach().reshape(-1)[low - self.offsets[index]:high - self.offsets[index]]
+                block[row, low - start:high - start] = source.cpu().float()
+        return block
+
+
+class SpilledUpdates(object):
+    """
+    Flattened client updates in a memory-mapped file, one row per client: the update of a client leaves RAM as
+    soon as it is appended, the robust rules then read the file column chunk by column chunk. reset() reuses
+    the same file every round.
+    """
+    def __init__(self, args, like, name):
+        directory = args.robust_memmap_dir or os.path.join(args.output_dir, 'robust_updates')
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, '%s_%d.npy' % (name, os.getpid()))
+        sizes = [tensor.numel() for tensor in like]
+        self.offsets = np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64)
+        self.total = int(self.offsets[-1])
+        self.buffer = np.lib.format.open_memmap(self.path, mode='w+', dtype=np.float32, shape=(args.num_local_clients, self.total))
+        self.rows = 0
+        print('============ Client updates of the round spilled to %s (%2.2fMB) ============' % (self.path, self.buffer.nbytes / 2 ** 20))
+
+    def reset(self):
+        self.rows = 0
+        return self
+
+    def append(self, tensors):
+        if isinstance(tensors, dict):
+            tensors = list(tensors.values())
+        for index, tensor in enumerate(tensors):
+            self.buffer[self.rows, self.offsets[index]:self.offsets[index + 1]] = tensor.detach().reshape(-1).cpu().float().numpy()
+        self.rows += 1
+
+    def __len__(self):
+        return self.rows
+
+    def chunk(self, start, end):
+        return torch.from_numpy(np.ascontiguousarray(self.buffer[:self.rows, start:end]))
+
+
+def median_rule(block):
+    """ Coordinate-wise median, kthvalue only does the partial sort needed by the middle element(s) """
+    num_clients = block.shape[0]
+    lower = block.kthvalue((num_clients + 1) // 2, dim=0).values
+    if num_clients % 2 == 1:
+        return lower
+    return (lower + block.kthvalue(num_clients // 2 + 1, dim=0).values) / 2
+
+
+def trimmed_mean_rule(block, num_trimmed):
+    """ Coordinate-wise mean without the num_trimmed largest and smallest values, found with two topk """
+    if num_trimmed == 0:
+        return block.mean(dim=0)
+    total = block.sum(dim=0) - block.topk(num_trimmed, dim=0).values.sum(dim=0) \
+        - block.topk(num_trimmed, dim=0, largest=False).values.sum(dim=0)
+    return total / (block.shape[0] - 2 * num_trimmed)
+
+
+def krum_selection(updates, chunk_columns, num_byzantine, num_selected):
+    """
+    (Multi-)Krum: the pairwise squared distances are accumulated over the column chunks (Gram matrix of each
+    block), every client is scored by the sum of its n - f - 2 closest distances and the best ones are kept.
+    """
+    num_clients = len(updates)
+    if num_clients <= 2 * num_byzantine + 2:
+        raise ValueError('Krum with %d byzantine clients needs more than %d clients, got %d' % (
+            num_byzantine, 2 * num_byzantine + 2, num_clients))
+
+    distances = torch.zeros(num_clients, num_clients, dtype=torch.float64)
+    for start in range(0, updates.total, chunk_columns):
+        block = updates.chunk(start, min(start + chunk_columns, updates.total)).double()
+        gram = block @ block.t()
+        squared_norms = gram.diagonal()
+        distances += squared_norms[:, None] + squared_norms[None, :] - 2 * gram
+
+    # the distance of each client to itself is the smallest of its row, skipped
+    closest = distances.clamp(min=0).sort(dim=1).values[:, 1:num_clients - num_byzantine - 1]
+    scores = closest.sum(dim=1)
+    return scores.argsort()[:num_selected].tolist()
+
+
+def robust_aggregate(args, updates, weights, out, scale=1., accumulate=False):
+    """
+    out = rule(updates) (out += scale * rule(updates) with accumulate), out: tensors aligned with the updates.
+    The flattened updates are processed by chunks of columns, the working memory is bounded by
+    robust_chunk_mb (a chunk of every client) whatever the size of the model. Median and trimmed mean ignore
+    the client weights, Multi-Krum averages the selected clients with their renormalized weights.
+    """
+    start_time = time.time()
+    if not isinstance(updates, SpilledUpdates):
+        updates = TensorUpdates(updates)
+    num_clients = len(updates)
+    chunk_columns = max(1, args.robust_chunk_mb * 2 ** 20 // (4 * num_clients))
+
+    rule = args.robust_aggregation
+    if rule == 'krum':
+        selected = krum_selection(updates, chunk_columns, args.krum_byzantine, args.krum_selected)
+        selected_weights = torch.tensor([float(weights[client]) for client in selected])
+        selected_weights = (selected_weights / selected_weights.sum())[:, None]
+        print('Krum kept the clients', selected)
+    num_trimmed = int(args.trim_ratio * num_clients)
+    if rule == 'trimmed_mean' and num_clients - 2 * num_trimmed <= 0:
+        raise ValueError('--trim_ratio %g leaves no client out of %d' % (args.trim_ratio, num_clients))
+
+    offsets = np.concatenate([[0], np.cumsum([tensor.numel() for tensor in out])]).astype(np.int64)
+    for start in range(0, updates.total, chunk_columns):
+        end = min(start + chunk_columns, updates.total)
+        block = updates.chunk(start, end)
+        if rule == 'median':
+            values = median_rule(block)
+        elif rule == 'trimmed_mean':
+            values = trimmed_mean_rule(block, num_trimmed)
+        else:
+            values = (block[selected] * selected_weights).sum(dim=0)
+
+        # scatter the chunk back into the layers it overlaps
+        for index in range(len(out)):
+            low, high = max(start, offsets[index]), min(end, offsets[index + 1])
+            if low >= high:
+                continue
+            target = out[index].data.view(-1)[low - offsets[index]:high - offsets[index]]
+            source = values[low - start:high - start].to(device=target.device, dtype=target.dtype)
+            if accumulate:
+                target.add_(source, alpha=scale)
+            else:
+                target.copy_(source * scale if scale != 1. else source)
+
+    print('Robust aggregation (%s) of %d clients: chunks of %2.2fMB in %.3fs' % (
+        rule, num_clients, chunk_columns * num_clients * 4 / 2 ** 20, time.time() - start_time))
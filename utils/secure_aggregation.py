@@ -0,0 +1,148 @@
+import time
+
+import numpy as np
+import torch
+from utils.robust_aggregation import TensorUpdates
+
+
+class SecureAggregator(object):
+    """
+    Simulation of secure aggregation with pairwise masks (Bonawitz et al. 2017, with the sparse neighbour graphs
+    of Bell et al. 2020): every client encodes its weighted update in fixed point over Z_2^64 and adds, for each
+    neighbour j, +PRG(s_ij) if i < j and -PRG(s_ij) otherwise. The server only sees masked vectors, their sum
+    cancels the masks. When clients drop after the masks were agreed, the survivors reveal their seeds with the
+    dropped ones (the Shamir share recovery of the protocol) and the server removes the dangling masks.
+    The masks are drawn in bulk from counter based PCG64 streams, advanced to the chunk being processed, so a
+    round only holds a chunk of the flattened model at a time. Client and server CPU time, the working memory
+    and the upload expansion are reported every round.
+    """
+    def __init__(self, args):
+        self.args = args
+        self.scale = float(2 ** args.secagg_precision_bits)
+        self.rounds = 0
+        self.sums = 0
+        self.rng = np.random.default_rng(args.seed)
+
+    def neighbours(self, num_clients):
+        """ Pairs (i, j), i < j, that share a mask: complete graph, or a random k-regular (Harary) graph """
+        k = self.args.secagg_neighbors
+        if k <= 0 or k >= num_clients - 1:
+            return [(i, j) for i in range(num_clients) for j in range(i + 1, num_clients)]
+        if k % 2 and num_clients % 2:
+            raise ValueError('No %d-regular graph on %d clients (odd degree needs an even number of clients), '
+                             'use an even --secagg_neighbors' % (k, num_clients))
+        order = self.rng.permutation(num_clients)
+        pairs = set()
+        # ring offsets 1..k/2 give degree 2 * (k // 2), an odd k adds the antipodal client
+        offsets = list(range(1, k // 2 + 1)) + ([num_clients // 2] if k % 2 else [])
+        for position in range(num_clients):
+            for offset in offsets:
+                i, j = order[position], order[(position + offset) % num_clients]
+                pairs.add((min(i, j), max(i, j)))
+        return sorted(pairs)
+
+    def mask(self, pair, start, size):
+        # the seed stands for the key agreed by the two clients, the stream is advanced to the chunk
+        # one stream per sum of the round: a mask is never reused on two vectors
+        generator = np.random.PCG64(np.random.SeedSequence([self.args.seed, self.rounds, self.sums, int(pair[0]), int(pair[1])]))
+        generator.advance(start)
+        return generator.random_raw(size)
+
+    def encode(self, values):
+        return np.round(values.astype(np.float64) * self.scale).astype(np.int64).view(np.uint64)
+
+    def decode(self, values):
+        return values.view(np.int64).astype(np.float64) / self.scale
+
+    def begin_round(self, num_clients):
+        """ Mask graph and dropped clients of a round, shared by all its sums (e.g. the model and control variate deltas of SCAFFOLD) """
+        self.rounds += 1
+        self.sums = 0
+        pairs = self.neighbours(num_clients)
+        partners = [[] for _ in range(num_clients)]
+        for i, j in pairs:
+            partners[i].append((i, j))
+            partners[j].append((i, j))
+
+        # clients that drop after the key agreement: none of their masked vectors of the round arrives
+        dropped = set(np.flatnonzero(self.rng.random(num_clients) < self.args.secagg_dropout).tolist())
+        if len(dropped) == num_clients:
+            dropped.discard(min(dropped))
+        return num_clients, partners, dropped
+
+    def weighted_sum(self, tensor_lists, weights, like, round_state=None):
+        """
+        sum_i weights[i] * tensor_lists[i] over the surviving clients (renormalized), through masked fixed point vectors.
+        round_state: the begin_round() of the round when it has several sums, a new round otherwise.
+        """
+        args = self.args
+        if round_state is None:
+            round_state = self.begin_round(len(tensor_lists))
+        num_clients, partners, dropped = round_state
+        if len(tensor_lists) != num_clients:
+            raise ValueError('Round of %d clients, %d updates to sum' % (num_clients, len(tensor_lists)))
+        self.sums += 1
+        survivors = [client for client in range(num_clients) if client not in dropped]
+        total_weight = sum(weights[client] for client in survivors)
+
+        updates = TensorUpdates(tensor_lists)
+        offsets, total = updates.offsets, updates.total
+        chunk = max(1, args.secagg_chunk_mb * 2 ** 20 // (8 + 4 * num_clients))
+        result = np.empty(total, dtype=np.float64)
+
+        client_time = server_time = 0.
+        for start in range(0, total, chunk):
+            end = min(start + chunk, total)
+            block = updates.chunk(start, end).numpy()
+            accumulator = np.zeros(end - start, dtype=np.uint64)
+
+            # client side: encode and mask, uint64 arithmetic wraps modulo 2^64
+            begin = time.process_time()
+            for client in survivors:
+                masked = self.encode(weights[client] * block[client])
+                for pair in partners[client]:
+                    if client == pair[0]:
+                        masked += self.mask(pair, start, end - start)
+                    else:
+                        masked -= self.mask(pair, start, end - start)
+                client_time += time.process_time() - begin
+                begin = time.process_time()
+                accumulator += masked
+                server_time += time.process_time() - begin
+                begin = time.process_time()
+
+            # server side: remove the masks shared with the dropped clients from the seeds revealed by the survivors
+            for client in dropped:
+                for pair in partners[client]:
+                    survivor = pair[1] if client == pair[0] else pair[0]
+                    if survivor in dropped:
+                        continue
+                    if survivor == pair[0]:
+                        accumulator -= self.mask(pair, start, end - start)
+                    else:
+                        accumulator += self.mask(pair, start, end - start)
+            result[start:end] = self.decode(accumulator) / total_weight
+            server_time += time.process_time() - begin
+
+        # per client masking time and server time of the last round, read by benchmark_secure_aggregation.py
+        self.last_client_time = client_time / max(len(survivors), 1)
+        self.last_server_time = server_time
+        print('Secure aggregation of %d clients (%d dropped, %d masks per client): client %.3fs, server %.3fs CPU, '
+              'working memory %2.2fMB, upload x%d' % (
+                  num_clients, len(dropped), max(len(shared) for shared in partners), self.last_client_time, server_time,
+                  min(chunk, total) * (3 * 8 + 4 * num_clients) / 2 ** 20, 8 // like[0].element_size()))
+
+        return [torch.from_numpy(result[offsets[index]:offsets[index + 1]]).view(tensor.shape).to(device=tensor.device, dtype=tensor.dtype)
+                for index, tensor in enumerate(like)]
+
+
+def secure_aggregator(args):
+    """ Secure aggregation layer of the run, None when it is off """
+    if not getattr(args, 'secure_aggregation', False):
+        return None
+    if getattr(args, 'secure_aggregator', None) is None:
+        args.secure_aggregator = SecureAggregator(args)
+        print('============ Secure aggregation: %d bit fixed point, %s mask graph, dropout %g ============' % (
+            args.secagg_precision_bits, 'complete' if args.secagg_neighbors <= 0 else '%d-regular' % args.secagg_neighbors,
+            args.secagg_dropout))
+    return args.secure_aggregator
@@ -0,0 +1,122 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+
+def shard_segments(like, num_shards):
+    """
+    Split the flattened concatenation of the tensors of `like` in num_shards contiguous ranges of (almost) equal
+    size. Each shard is a list of (tensor index, start, end) segments, a layer may be cut between two shards.
+    """
+    sizes = [tensor.numel() for tensor in like]
+    total = sum(sizes)
+    bounds = [total * shard // num_shards for shard in range(num_shards + 1)]
+
+    shards = []
+    for low, high in zip(bounds[:-1], bounds[1:]):
+        segments, offset = [], 0
+        for index, size in enumerate(sizes):
+            start, end = max(low, offset), min(high, offset + size)
+            if start < end:
+                segments.append((index, start - offset, end - offset))
+            offset += size
+        shards.append(segments)
+    return shards
+
+
+class ShardedAggregator(object):
+    """
+    Aggregation split by parameter chunks: the flattened global model is cut in one shard per worker and every
+    worker reduces the clients over its shard only, in place (no per layer torch.stack of all the clients).
+    The in-place torch kernels release the GIL, so threads are enough to run the shards in parallel.
+    """
+    def __init__(self, num_workers):
+        self.num_workers = num_workers
+        self.pool = ThreadPoolExecutor(max_workers=num_workers)
+        self.shards = {}
+
+    def segments(self, like):
+        key = tuple(tensor.numel() for tensor in like)
+        if key not in self.shards:
+            self.shards[key] = shard_segments(like, self.num_workers)
+        return self.shards[key]
+
+    def map(self, fn, shards):
+        # list() re-raises the exception of a failed worker
+        return list(self.pool.map(fn, shards))
+
+    def weighted_sum(self, tensor_lists, weights, out, accumulate=False):
+        """ out = sum_i weights[i] * tensor_lists[i] (out += ... with accumulate), tensors aligned with out """
+        def reduce(segments):
+            for index, start, end in segments:
+                target = out[index].data.view(-1)[start:end]
+                if not accumulate:
+                    target.zero_()
+                for tensors, weight in zip(tensor_lists, weights):
+                    source = tensors[index].detach().reshape(-1)[start:end]
+                    target.add_(source.to(device=target.device, dtype=target.dtype), alpha=float(weight))
+
+        self.map(reduce, self.segments(out))
+
+
+class ShardedServerOptimizer(object):
+    """
+    Server optimizer (FedOpt) run per shard: the global parameters are moved into one flat buffer, every shard
+    of it is a parameter with its own optimizer, so the reduction of the client deltas and the optimizer step
+    of a shard run on the same worker. SGD (momentum) and Adam are element-wise, the result is the one of a
+    single optimizer over the whole model.
+    """
+    def __init__(self, aggregator, global_params_dict, make_optimizer):
+        self.aggregator = aggregator
+        like = list(global_params_dict.values())
+        self.flat = torch.cat([param.detach().reshape(-1) for param in like])
+
+        # the entries of global_params_dict become views of the flat buffer
+        offset = 0
+        for name, param in list(global_params_dict.items()):
+            global_params_dict[name] = torch.nn.Parameter(self.flat[offset:offset + param.numel()].view(param.shape))
+            offset += param.numel()
+
+        self.segments = aggregator.segments(like)
+        self.shard_params, self.optimizers = [], []
+        offset = 0
+        for shard, segments in enumerate(self.segments):
+            size = sum(end - start for index, start, end in segments)
+            param = torch.nn.Parameter(self.flat[offset:offset + size])
+            self.shard_params.append(param)
+            self.optimizers.append(make_optimizer(OrderedDict([('shard_%d' % shard, param)])))
+            offset += size
+        print('============ Server optimizer split in %d shards of %2.2fMB ============' % (
+            len(self.segments), self.flat.numel() * self.flat.element_size() / len(self.segments) / 2 ** 20))
+
+    def step(self, delta_lists, weights):
+        """ One server step on the weighted sum of the client deltas, each worker reduces and steps its own shard """
+        def reduce_and_step(shard):
+            param, optimizer = self.shard_params[shard], self.optimizers[shard]
+            grad = torch.zeros_like(param)
+            position = 0
+            for index, start, end in self.segments[shard]:
+                target = grad[position:position + end - start]
+                for deltas, weight in zip(delta_lists, weights):
+                    source = deltas[index].detach().reshape(-1)[start:end]
+                    target.add_(source.to(device=target.device, dtype=target.dtype), alpha=float(weight))
+                position += end - start
+
+            optimizer.zero_grad()
+            param.grad = grad
+            optimizer.step()
+
+        self.aggregator.map(reduce_and_step, range(len(self.segments)))
+
+
+def sharded_aggregator(args):
+    """ Aggregator of the run, None when aggregation is not sharded (one worker, gloo ranks that all_reduce, robust rules or secure aggregation, which chunk by themselves) """
+    if getattr(args, 'aggregation_workers', 1) <= 1 or getattr(args, 'world_size', 1) > 1:
+        return None
+    if getattr(args, 'robust_aggregation', 'none') != 'none' or getattr(args, 'secure_aggregation', False):
+        return None
+    if getattr(args, 'aggregator', None) is None:
+        args.aggregator = ShardedAggregator(args.aggregation_workers)
+        print('============ Sharded aggregation over %d workers ============' % args.aggregation_workers)
+    return args.aggregator
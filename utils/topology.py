@@ -0,0 +1,207 @@
+import time
+
+import torch
+import torch.distributed as dist
+from utils.param_groups import is_global
+from utils.distributed import all_reduce_weighted_sum, all_reduce_scalar
+
+
+def parse_levels(levels):
+    """ ['8:1', '2:2', '1:4'] -> [(8, 1), (2, 2), (1, 4)], (groups, period in rounds) from the edges up to the root """
+    parsed = []
+    for level in levels:
+        groups, _, period = level.partition(':')
+        parsed.append((int(groups), int(period or 1)))
+
+    for (groups, period), (upper_groups, upper_period) in zip(parsed[:-1], parsed[1:]):
+        if upper_groups > groups or upper_period % period != 0:
+            raise ValueError('--aggregation_levels %s: every level needs at most the groups of the level below and a '
+                             'period multiple of its period' % ' '.join(levels))
+    if parsed[-1][0] != 1:
+        raise ValueError('--aggregation_levels %s: the last level is the root and has a single group' % ' '.join(levels))
+    return parsed
+
+
+class FlatTopology(object):
+    """ A single server that aggregates every client in every round, the original behaviour """
+    levels = [(1, 1)]
+
+    def __init__(self, args):
+        self.args = args
+
+    @property
+    def root_period(self):
+        return self.levels[-1][1]
+
+    def is_root_round(self, epoch):
+        return (epoch + 1) % self.root_period == 0
+
+    def load_edge_model(self, client, proxy, model):
+        pass
+
+    def aggregate(self, epoch, round_pairs, model_all):
+        pass
+
+    def reset(self):
+        pass
+
+    def report(self, num_clients):
+        pass
+
+
+class TreeTopology(FlatTopology):
+    """
+    Aggregation tree: the clients are reduced by the edge aggregators of level 0, the edges by the groups of
+    level 1 and so on up to the root. Each level has its own period: on a round where level l is the highest
+    level due, the clients below every group of l are averaged (same result as reducing the averages of the
+    levels below it, weighted by data size) and the group model is sent back to its whole subtree. On root
+    rounds the algorithm's own server (average_model / server optimizer / SCAFFOLD) runs instead.
+    With gloo ranks every rank is one edge aggregator, the upper levels all_reduce over sub groups of ranks.
+    """
+    def __init__(self, args):
+        super(TreeTopology, self).__init__(args)
+        self.levels = parse_levels(args.aggregation_levels)
+        self.num_edges = self.levels[0][0]
+        self.world_size = getattr(args, 'world_size', 1)
+        self.position = {proxy: position for position, proxy in enumerate(args.proxy_clients)}
+        # last model sent down to each edge, the starting point of its clients until the next root round
+        self.edge_models = {}
+
+        if args.client_state == 'lazy' and self.levels[0][1] != 1:
+            raise ValueError('--client_state lazy needs an edge level that aggregates every round (period 1)')
+        if self.num_edges > args.num_local_clients:
+            raise ValueError('%d edge aggregators for %d clients per round' % (self.num_edges, args.num_local_clients))
+
+        # process groups of the levels below the root, created in the same order on every rank
+        self.process_groups = {}
+        if self.world_size > 1:
+            if self.num_edges != self.world_size:
+                raise ValueError('the ranks stand in for the edge aggregators: %d edges need %d ranks, got %d' % (
+                    self.num_edges, self.num_edges, self.world_size))
+            for level, (groups, period) in enumerate(self.levels[1:-1], 1):
+                for group in range(groups):
+                    ranks = [rank for rank in range(self.world_size) if self.group_of(level, rank) == group]
+                    process_group = dist.new_group(ranks) if len(ranks) > 1 else None
+                    if args.rank in ranks:
+                        self.process_groups[level] = process_group
+
+    def edge_of(self, client, proxy):
+        # same key as rank_share, so that the clients of an edge are the ones of its rank
+        if self.args.client_state == 'lazy':
+            if not hasattr(self.args, 'client_index'):
+                self.args.client_index = {name: index for index, name in enumerate(self.args.dis_cvs_files)}
+            return self.args.client_index[client] % self.num_edges
+        return self.position[proxy] % self.num_edges
+
+    def group_of(self, level, edge):
+        # contiguous ranges of edges, the groups of a level are always nested in the ones above
+        return edge * self.levels[level][0] // self.num_edges
+
+    def level_of_round(self, epoch):
+        """ Highest level that aggregates after round epoch, None when the clients just keep training """
+        due = [level for level, (groups, period) in enumerate(self.levels) if (epoch + 1) % period == 0]
+        return due[-1] if due else None
+
+    def load_edge_model(self, client, proxy, model):
+        edge_model = self.edge_models.get(self.edge_of(client, proxy))
+        if edge_model is None:
+            return
+        named_params = dict(model.named_parameters())
+        with torch.no_grad():
+            for name, value in edge_model.items():
+                named_params[name].copy_(value)
+
+    def _weighted_average(self, level, tensor_lists, weights, like):
+        if self.world_size > 1:
+            # level 0: every rank is its own edge, nothing to exchange
+            process_group = self.process_groups.get(level)
+            if process_group is None:
+                return self._local_sum(tensor_lists, [weight / sum(weights) for weight in weights], like) if weights else None
+            total_weight = all_reduce_scalar(self.args, sum(weights), group=process_group)
+            if total_weight == 0:
+                return None
+            return all_reduce_weighted_sum(self.args, tensor_lists, [weight / total_weight for weight in weights], like, group=process_group)
+
+        if not weights:
+            return None
+        return self._local_sum(tensor_lists, [weight / sum(weights) for weight in weights], like)
+
+    @staticmethod
+    def _local_sum(tensor_lists, weights, like):
+        result = [torch.zeros(tensor.shape, dtype=torch.float64) for tensor in like]
+        for tensors, weight in zip(tensor_lists, weights):
+            for accumulator, tensor in zip(result, tensors):
+                accumulator += float(weight) * tensor.detach().cpu().double()
+        return [accumulator.to(dtype=tensor.dtype) for accumulator, tensor in zip(result, like)]
+
+    def aggregate(self, epoch, round_pairs, model_all):
+        """ Intermediate aggregation of a non root round, the slots of round_pairs get the model of their group """
+        level = self.level_of_round(epoch)
+        if level is None:
+            print('No aggregation in round', epoch)
+            return
+
+        start_time = time.time()
+        groups = {}
+        for client, proxy in round_pairs:
+            groups.setdefault(self.group_of(level, self.edge_of(client, proxy)), []).append(proxy)
+        if self.world_size > 1:
+            # one group per rank: the one of its edge, possibly without clients this round
+            groups = {self.group_of(level, self.args.rank): groups.get(self.group_of(level, self.args.rank), [])}
+
+        names, like = [], []
+        for name, param in model_all[self.args.proxy_clients[0]].named_parameters():
+            if is_global(self.args, name, param):
+                names.append(name)
+                like.append(param)
+
+        for group, proxies in groups.items():
+            params = [dict(model_all[proxy].named_parameters()) for proxy in proxies]
+            averaged = self._weighted_average(level, [[param[name] for name in names] for param in params],
+                                              [self.args.clients_weightes[proxy] for proxy in proxies], like)
+            if averaged is None:
+                continue
+
+            group_model = dict(zip(names, averaged))
+            for param in params:
+                with torch.no_grad():
+                    for name, value in group_model.items():
+                        param[name].copy_(value)
+            for edge in range(self.num_edges):
+                if self.group_of(level, edge) == group:
+                    self.edge_models[edge] = group_model
+
+        nbytes = getattr(self.args, 'global_param_nbytes', 0)
+        print('Level %d aggregation (%d groups) of %d clients: %2.2fMB moved in %.3fs' % (
+            level, self.levels[level][0], len(round_pairs), 2 * len(round_pairs) * nbytes / 2 ** 20, time.time() - start_time))
+
+    def reset(self):
+        # after a root round every client starts from the global model again
+        self.edge_models = {}
+
+    def report(self, num_clients):
+        """ Fan-in, buffer memory and traffic of every level, the root compared to the flat topology """
+        nbytes = getattr(self.args, 'global_param_nbytes', 0) / 2 ** 20
+        print('============ Aggregation tree, %d levels ============' % len(self.levels))
+        print('%-8s %8s %8s %10s %12s %12s' % ('level', 'groups', 'period', 'fan-in', 'buffer MB', 'MB / round'))
+        children = num_clients
+        for level, (groups, period) in enumerate(self.levels):
+            # every aggregator receives its children before reducing them, traffic is upload + write back
+            fan_in = children / groups
+            name = 'root' if level == len(self.levels) - 1 else str(level)
+            print('%-8s %8d %8d %10.1f %12.2f %12.2f' % (name, groups, period, fan_in, fan_in * nbytes, 2 * children * nbytes / period))
+            children = groups
+
+        root_fan_in = self.levels[-2][0] if len(self.levels) > 1 else num_clients
+        print('root fan-in %d vs %d flat | root buffer %.2fMB vs %.2fMB flat | root traffic %.2fMB vs %.2fMB flat per round' % (
+            root_fan_in, num_clients, root_fan_in * nbytes, num_clients * nbytes,
+            2 * root_fan_in * nbytes / self.root_period, 2 * num_clients * nbytes))
+
+
+TOPOLOGIES = {'flat': FlatTopology, 'tree': TreeTopology}
+
+
+def build_topology(args):
+    topology = TOPOLOGIES[args.topology](args)
+    topology.report(args.num_local_clients)
+    return topology
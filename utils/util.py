@@ -1,12 +1,18 @@
 from __future__ import absolute_import, division, print_function
 import os
 import math
+import time
 import numpy as np
 from copy import deepcopy
-from sklearn.metrics import mean_absolute_error, mean_squared_error
 from typing import List, Tuple, Union, OrderedDict
 import torch
 from utils.scheduler import setup_scheduler
+from utils.param_groups import LOCAL, is_global, aggregation_report
+from utils.distributed import all_reduce_weighted_sum
+from utils.sharded_aggregation import sharded_aggregator
+from utils.robust_aggregation import robust_aggregate
+from utils.secure_aggregation import secure_aggregator
+from utils.checkpoint_store import checkpoint_store
 from torch import optim as optim
 
 def build_optimizer(config, model):
@@ -89,8 +95,14 @@ def simple_accuracy(preds, labels):
 
 def save_model(args, model):
     model_to_save = model.module if hasattr(model, 'module') else model
+    store = checkpoint_store(args)
+    if store is not None:
+        # identical tensors of the clients are stored once, written in background
+        store.save(args.single_client, model_to_save.state_dict(), best_acc=float(args.best_acc[args.single_client]))
+        return
+
     client_name = os.path.basename(args.single_client).split('.')[0]
-    model_checkpoint = os.path.join(args.output_dir, "%s_%s_checkpoint.pth" % (args.name, client_name))
+    model_checkpoint = os.path.join(args.output_dir, "%s_%s_checkpoint.pth" % (args.name_run, client_name))
 
     torch.save(model_to_save.state_dict(), model_checkpoint)
 
@@ -137,6 +149,7 @@ def inner_valid(args, model, test_loader, test = False):
     if not args.num_classes == 1:
         eval_result = simple_accuracy(all_preds, all_label)
     else:
+        from sklearn.metrics import mean_squared_error
         eval_result =  mean_squared_error(all_preds, all_label)
 
     model.train()
@@ -200,22 +213,33 @@ def valid(args, model, val_loader,  test_loader = None, TestFlag = False):
 
 def optimization_fun(args, model):
 
+    # frozen parameters (frozen backbone, adapters) are left out of the optimizer and its state
+    parameters = [param for param in model.parameters() if param.requires_grad]
+
     # Prepare optimizer, scheduler
     if args.optimizer_type == 'sgd':
-        optimizer = torch.optim.SGD(model.parameters(), lr=args.learning_rate, momentum=0.9, weight_decay=args.weight_decay)
+        optimizer = torch.optim.SGD(parameters, lr=args.learning_rate, momentum=0.9, weight_decay=args.weight_decay)
     elif args.optimizer_type == 'adamw':
-        optimizer = torch.optim.AdamW(model.parameters(), eps=1e-8, betas=(0.9, 0.999), lr=args.learning_rate, weight_decay=0.05)
+        optimizer = torch.optim.AdamW(parameters, eps=1e-8, betas=(0.9, 0.999), lr=args.learning_rate, weight_decay=0.05)
 
     else:
-        optimizer = torch.optim.AdamW(model.parameters(), eps=1e-8, betas=(0.9, 0.999), lr=args.learning_rate, weight_decay=0.05)
+        optimizer = torch.optim.AdamW(parameters, eps=1e-8, betas=(0.9, 0.999), lr=args.learning_rate, weight_decay=0.05)
 
         print("===============Not implemented optimization type, we used default adamw optimizer ===============")
     return optimizer
 
 
+def shared_frozen_memo(model):
+    """ deepcopy memo that makes the copies share the frozen parameters of model instead of duplicating them """
+    return {id(param): param for param in model.parameters() if not param.requires_grad}
+
+
 def Partial_Client_Selection(args, model):
 
     # Select partial clients join in FL train
+    if args.num_local_clients > len(args.dis_cvs_files):
+        raise ValueError('--num_local_clients %d but the split only has %d clients' % (args.num_local_clients, len(args.dis_cvs_files)))
+
     if args.num_local_clients == -1: # all the clients joined in the train
         args.proxy_clients = args.dis_cvs_files
         args.num_local_clients =  len(args.dis_cvs_files) # update the true number of clients
@@ -226,6 +250,11 @@ def Partial_Client_Selection(args, model):
     else:
         args.proxy_clients = ['train_' + str(i) for i in range(args.num_local_clients)]
 
+    # local parameters live in the proxy slots: with partial participation a slot would hand them to another client
+    has_local = LOCAL in getattr(args, 'param_policy', {}).values()
+    if has_local and args.num_local_clients < len(args.dis_cvs_files) and getattr(args, 'client_state', 'proxy') != 'lazy':
+        raise ValueError('--local_groups / --local_params with %d of %d clients per round need --client_state lazy, '
+                         'which keeps the local parameters of every client' % (args.num_local_clients, len(args.dis_cvs_files)))
     
     model_all = {}
     optimizer_all = {}
@@ -235,7 +264,7 @@ def Partial_Client_Selection(args, model):
 
 
     for proxy_single_client in args.proxy_clients:
-        model_all[proxy_single_client] = deepcopy(model).cpu()
+        model_all[proxy_single_client] = deepcopy(model, shared_frozen_memo(model)).cpu()
         optimizer_all[proxy_single_client] = optimization_fun(args, model_all[proxy_single_client])
 
         if not args.dataset == 'celeba' or (args.dataset == 'celeba' and args.split_type == 'central'):
@@ -254,33 +283,61 @@ def Partial_Client_Selection(args, model):
 
 
 def average_model(args,  model_avg, model_all):
+    start_time = time.time()
     model_avg.cpu()
     print('Calculate the model avg----')
-    params = dict(model_avg.named_parameters())
+    # only the global parameter group is averaged, frozen and local (e.g. FedBN norms) ones stay on the clients
+    params = {name: param for name, param in model_avg.named_parameters() if is_global(args, name, param)}
+    client_params = {single_client: dict(model_all[single_client].named_parameters()) for single_client in args.proxy_clients}
+
+    if getattr(args, 'robust_aggregation', 'none') != 'none':
+        # median / trimmed mean / Krum over the flattened client models, chunk by chunk
+        robust_aggregate(args, [[client_params[single_client][name] for name in params] for single_client in args.proxy_clients],
+                         [args.clients_weightes[single_client] for single_client in args.proxy_clients], list(params.values()))
+
+    elif getattr(args, 'world_size', 1) > 1:
+        # every rank sums its own clients, one all_reduce over the flattened global parameters
+        local_clients = args.local_proxies
+        averaged = all_reduce_weighted_sum(args, [[client_params[single_client][name] for name in params] for single_client in local_clients],
+                                           [args.clients_weightes[single_client] for single_client in local_clients], list(params.values()))
+        for param, value in zip(params.values(), averaged):
+            param.data.copy_(value)
+
+    elif secure_aggregator(args) is not None:
+        # the server only gets the sum of the pairwise masked client models
+        averaged = secure_aggregator(args).weighted_sum([[client_params[single_client][name] for name in params] for single_client in args.proxy_clients],
+                                                        [args.clients_weightes[single_client] for single_client in args.proxy_clients], list(params.values()))
+        for param, value in zip(params.values(), averaged):
+            param.data.copy_(value)
+
+    elif sharded_aggregator(args) is not None:
+        # the flattened model is cut in chunks, each worker reduces all the clients over its chunk in place
+        sharded_aggregator(args).weighted_sum([[client_params[single_client][name] for name in params] for single_client in args.proxy_clients],
+                                              [args.clients_weightes[single_client] for single_client in args.proxy_clients], list(params.values()))
 
-    for name, param in params.items():
-        for client in range(len(args.proxy_clients)):
-            single_client = args.proxy_clients[client]
+    else:
+        for name, param in params.items():
+            for client in range(len(args.proxy_clients)):
+                single_client = args.proxy_clients[client]
 
-            single_client_weight = args.clients_weightes[single_client]
-            single_client_weight = torch.from_numpy(np.array(single_client_weight)).float()
+                single_client_weight = args.clients_weightes[single_client]
+                single_client_weight = torch.from_numpy(np.array(single_client_weight)).float()
 
-            if client == 0:
-                tmp_param_data = dict(model_all[single_client].named_parameters())[
-                                     name].data * single_client_weight
-            else:
-                tmp_param_data = tmp_param_data + \
-                                 dict(model_all[single_client].named_parameters())[
-                                     name].data * single_client_weight
-        params[name].data.copy_(tmp_param_data)
+                if client == 0:
+                    tmp_param_data = client_params[single_client][name].data * single_client_weight
+                else:
+                    tmp_param_data = tmp_param_data + client_params[single_client][name].data * single_client_weight
+            params[name].data.copy_(tmp_param_data)
 
     print('Update each client model parameters----')
 
     for single_client in args.proxy_clients:
-        tmp_params = dict(model_all[single_client].named_parameters())
+        tmp_params = client_params[single_client]
         for name, param in params.items():
             tmp_params[name].data.copy_(param.data)
 
+    aggregation_report(args, start_time, len(args.proxy_clients))
+
 def trainable_params(
     src: Union[OrderedDict[str, torch.Tensor], torch.nn.Module], requires_name=False
     ) -> Union[List[torch.Tensor], Tuple[List[str], List[torch.Tensor]]]: